@@ -1,11 +1,25 @@
 import asyncio
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-from src.config.config import data_config
-from src.run import main
+# The same module paths as in run.py (not src....), otherwise the modules and their shared clients would be imported twice
+from config.config import data_config
+from run import main
+from utils.helper import metrics
+from utils.response.image_fetcher import image_fetcher
+from utils.response.llm import llm_client
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Close the shared connection pools when the app exits
+    await image_fetcher.aclose()
+    await llm_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 is_running = False  # shared app-level state
 
 @app.get("/")
@@ -36,3 +50,7 @@ async def start_processing():
 @app.get("/status")
 def status():
     return {"running": is_running}
+
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
@@ -29,6 +29,21 @@ class OpenAIConfig(BaseSettings):
 openai_config = OpenAIConfig()
 
 
+class LLMClientConfig(BaseSettings):
+    """
+    Configuration for the (long-lived) LLM client and its connection pool.
+    """
+
+    max_connections: int = os.environ["LLM_MAX_CONNECTIONS"]
+    max_keepalive_connections: int = os.environ["LLM_MAX_KEEPALIVE_CONNECTIONS"]
+    keepalive_expiry: float = os.environ["LLM_KEEPALIVE_EXPIRY"]
+    timeout: float = os.environ["LLM_TIMEOUT"]
+    connect_timeout: float = os.environ["LLM_CONNECT_TIMEOUT"]
+
+
+llm_client_config = LLMClientConfig()
+
+
 class ResponseConfig(BaseSettings):
     """
     Configuration for response.
@@ -38,12 +53,170 @@ class ResponseConfig(BaseSettings):
     system_prompt_color: str = os.environ["SYSTEM_PROMPT_COLOR"]
     prompt_template_attribute: str = os.environ["PROMPT_TEMPLATE_ATTRIBUTE"]
     prompt_template_color: str = os.environ["PROMPT_TEMPLATE_COLOR"]
+    prompt_template_product_context: str = os.environ["PROMPT_TEMPLATE_PRODUCT_CONTEXT"]
     verify_certificate: bool = os.environ["VERIFY_CERTIFICATE"]
+    extraction_mode: Literal['per_attribute', 'multi_attribute'] = os.environ["EXTRACTION_MODE"]
+    prompt_template_multi_attribute: str = os.environ["PROMPT_TEMPLATE_MULTI_ATTRIBUTE"]
+    multi_attribute_tokens_per_attribute: int = os.environ["MULTI_ATTRIBUTE_TOKENS_PER_ATTRIBUTE"]
 
 
 response_config = ResponseConfig()
 
 
+class ImageFetchConfig(BaseSettings):
+    """
+    Configuration for the (async, pooled) image downloads.
+    """
+
+    max_connections: int = os.environ["IMAGE_FETCH_MAX_CONNECTIONS"]
+    max_connections_per_host: int = os.environ["IMAGE_FETCH_MAX_CONNECTIONS_PER_HOST"]
+    keepalive_expiry: float = os.environ["IMAGE_FETCH_KEEPALIVE_EXPIRY"]
+    timeout: float = os.environ["IMAGE_FETCH_TIMEOUT"]
+    max_retries: int = os.environ["IMAGE_FETCH_MAX_RETRIES"]
+    http2: bool = os.environ["IMAGE_FETCH_HTTP2"]
+
+
+image_fetch_config = ImageFetchConfig()
+
+
+class ImagePreprocessConfig(BaseSettings):
+    """
+    Configuration for the preprocessing (decode, resize, JPEG encode) of the downloaded images.
+    """
+
+    max_size: int = os.environ["IMAGE_MAX_SIZE"]
+    jpeg_quality: int = os.environ["IMAGE_JPEG_QUALITY"]
+    fast_decode: bool = os.environ["IMAGE_FAST_DECODE"]
+    draft_reducing_gap: float = os.environ["IMAGE_DRAFT_REDUCING_GAP"]
+    resampling: Literal['nearest', 'box', 'bilinear', 'hamming', 'bicubic', 'lanczos'] = os.environ["IMAGE_RESAMPLING"]
+    executor: Literal['inline', 'thread', 'process'] = os.environ["IMAGE_PROCESS_EXECUTOR"]
+    workers: int = os.environ["IMAGE_PROCESS_WORKERS"]
+
+
+image_preprocess_config = ImagePreprocessConfig()
+
+
+class ImageDedupConfig(BaseSettings):
+    """
+    Configuration for the deduplication of the processed images of an article (dHash preselection, pixel comparison).
+    """
+
+    enabled: bool = os.environ["IMAGE_DEDUP_ENABLED"]
+    max_distance: int = os.environ["IMAGE_DEDUP_MAX_DISTANCE"]
+    max_pixel_difference: float = os.environ["IMAGE_DEDUP_MAX_PIXEL_DIFFERENCE"]
+
+
+image_dedup_config = ImageDedupConfig()
+
+
+class ImagePolicyConfig(BaseSettings):
+    """
+    Configuration for the per attribute image policies (which images, resolution, detail and crop).
+    """
+
+    policies: str = os.environ["IMAGE_POLICIES"]
+
+
+image_policy_config = ImagePolicyConfig()
+
+
+class AttributeRulesConfig(BaseSettings):
+    """
+    Configuration for the deterministic attribute rules (answers without an LLM call).
+    """
+
+    enabled: bool = os.environ["ATTRIBUTE_RULES_ENABLED"]
+    category_rules: str = os.environ["ATTRIBUTE_RULES_CATEGORY"]
+    supplier_field_rules: str = os.environ["ATTRIBUTE_RULES_SUPPLIER_FIELDS"]
+
+
+attribute_rules_config = AttributeRulesConfig()
+
+
+class ColourEngineConfig(BaseSettings):
+    """
+    Configuration for the local colour engine (colour attributes without an LLM call).
+    """
+
+    modes: str = os.environ["COLOUR_ENGINE_MODES"]
+    min_confidence: float = os.environ["COLOUR_ENGINE_MIN_CONFIDENCE"]
+    max_colours: int = os.environ["COLOUR_ENGINE_MAX_COLOURS"]
+
+
+colour_engine_config = ColourEngineConfig()
+
+
+class ResponseCacheConfig(BaseSettings):
+    """
+    Configuration for the persistent LLM response cache.
+    """
+
+    mode: Literal['on', 'off', 'refresh'] = os.environ["LLM_CACHE_MODE"]
+    max_entries: int = os.environ["LLM_CACHE_MAX_ENTRIES"]
+    ttl_days: float = os.environ["LLM_CACHE_TTL_DAYS"]
+
+
+response_cache_config = ResponseCacheConfig()
+
+
+class ImageCacheConfig(BaseSettings):
+    """
+    Configuration for the on-disk cache of the downloaded and processed images.
+    """
+
+    mode: Literal['on', 'off'] = os.environ["IMAGE_CACHE_MODE"]
+    max_mb: float = os.environ["IMAGE_CACHE_MAX_MB"]
+    revalidate_after_hours: float = os.environ["IMAGE_CACHE_REVALIDATE_AFTER_HOURS"]
+
+
+image_cache_config = ImageCacheConfig()
+
+
+class BatchAPIConfig(BaseSettings):
+    """
+    Configuration for the bulk mode (OpenAI Batch API).
+    """
+
+    poll_interval: float = os.environ["BATCH_API_POLL_INTERVAL"]
+    completion_window: str = os.environ["BATCH_API_COMPLETION_WINDOW"]
+    max_wait_hours: float = os.environ["BATCH_API_MAX_WAIT_HOURS"]
+    max_requests_per_file: int = os.environ["BATCH_API_MAX_REQUESTS_PER_FILE"]
+    max_file_mb: float = os.environ["BATCH_API_MAX_FILE_MB"]
+
+
+batch_api_config = BatchAPIConfig()
+
+
+class RateLimitConfig(BaseSettings):
+    """
+    Configuration for the client-side rate limiter of the LLM calls (requests and tokens per minute).
+    """
+
+    enabled: bool = os.environ["RATE_LIMIT_ENABLED"]
+    requests_per_minute: int = os.environ["RATE_LIMIT_REQUESTS_PER_MINUTE"]
+    tokens_per_minute: int = os.environ["RATE_LIMIT_TOKENS_PER_MINUTE"]
+
+
+rate_limit_config = RateLimitConfig()
+
+
+class ConcurrencyConfig(BaseSettings):
+    """
+    Configuration for the concurrent attribute extraction.
+    """
+
+    concurrent_attributes: bool = os.environ["CONCURRENT_ATTRIBUTES"]
+    max_concurrent_attributes_per_article: int = os.environ["MAX_CONCURRENT_ATTRIBUTES_PER_ARTICLE"]
+    max_concurrent_llm_calls: int = os.environ["MAX_CONCURRENT_LLM_CALLS"]
+    adaptive_concurrency: bool = os.environ["ADAPTIVE_CONCURRENCY"]
+    min_concurrent_llm_calls: int = os.environ["MIN_CONCURRENT_LLM_CALLS"]
+    initial_concurrent_llm_calls: int = os.environ["INITIAL_CONCURRENT_LLM_CALLS"]
+    llm_latency_tolerance: float = os.environ["LLM_LATENCY_TOLERANCE"]
+
+
+concurrency_config = ConcurrencyConfig()
+
+
 class DataConfig(BaseSettings):
     """
     Configuration for the data ingestion.
@@ -58,6 +231,36 @@ class DataConfig(BaseSettings):
 data_config = DataConfig()
 
 
+class JournalConfig(BaseSettings):
+    """
+    Configuration for the processing journal (resume of interrupted batches).
+    """
+
+    enabled: bool = os.environ["JOURNAL_ENABLED"]
+    retention_days: float = os.environ["JOURNAL_RETENTION_DAYS"]
+
+
+journal_config = JournalConfig()
+
+
+class PipelineConfig(BaseSettings):
+    """
+    Configuration for the article pipeline in run.main (number of workers per stage, size of the queues between the stages).
+    """
+
+    queue_size: int = os.environ["PIPELINE_QUEUE_SIZE"]
+    download_workers: int = os.environ["PIPELINE_DOWNLOAD_WORKERS"]
+    parse_workers: int = os.environ["PIPELINE_PARSE_WORKERS"]
+    image_workers: int = os.environ["PIPELINE_IMAGE_WORKERS"]
+    llm_workers: int = os.environ["PIPELINE_LLM_WORKERS"]
+    save_workers: int = os.environ["PIPELINE_SAVE_WORKERS"]
+    upload_workers: int = os.environ["PIPELINE_UPLOAD_WORKERS"]
+    upload_mode: Literal['per_article', 'batched'] = os.environ["PIPELINE_UPLOAD_MODE"]
+
+
+pipeline_config = PipelineConfig()
+
+
 class FTPConfig(BaseSettings):
     """
     Configuration for the data ingestion from the FTP Server.
@@ -73,3 +276,41 @@ class FTPConfig(BaseSettings):
 
 
 ftp_config = FTPConfig()
+
+
+class SFTPPoolConfig(BaseSettings):
+    """
+    Configuration for the shared SFTP session pool.
+    """
+
+    max_size: int = os.environ["SFTP_POOL_MAX_SIZE"]
+    health_check_interval: float = os.environ["SFTP_POOL_HEALTH_CHECK_INTERVAL"]
+    max_idle_time: float = os.environ["SFTP_POOL_MAX_IDLE_TIME"]
+
+
+sftp_pool_config = SFTPPoolConfig()
+
+
+class ShardingConfig(BaseSettings):
+    """
+    Configuration for several replicas draining '/out' together (claims via rename into '/out/processing/<worker-id>/').
+    """
+
+    enabled: bool = os.environ["SHARDING_ENABLED"]
+    worker_id: str = os.environ["WORKER_ID"]
+    lease_timeout: float = os.environ["LEASE_TIMEOUT"]
+
+
+sharding_config = ShardingConfig()
+
+
+class SFTPDownloadConfig(BaseSettings):
+    """
+    Configuration for the SFTP downloads (chunk size and prefetched read requests per file).
+    """
+
+    read_size: int = os.environ["SFTP_DOWNLOAD_READ_SIZE"]
+    max_concurrent_requests: int = os.environ["SFTP_DOWNLOAD_MAX_CONCURRENT_REQUESTS"]
+
+
+sftp_download_config = SFTPDownloadConfig()
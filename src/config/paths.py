@@ -18,3 +18,5 @@ response_env_file = config / "response.settings.env"
 data_path_in = data / "in"
 data_path_out = data / "out"
 data_path_temp_img = data / "temp_images"
+data_path_cache = data / "cache"
+data_path_state = data / "state"
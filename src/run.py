@@ -1,13 +1,29 @@
 import asyncio
+import posixpath
 import signal
+import sys
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
 
 from loguru import logger
 
-from config.config import data_config
+from config.config import data_config, journal_config, pipeline_config, sharding_config
 from config.paths import data_path_in, data_path_out
 from utils.data_preprocessing import ftp_data_loader, ftp_data_post, json_article_loader
+from utils.data_preprocessing.sftp_pool import sftp_pool
+from utils.data_preprocessing.work_claims import work_claimer
 from utils.helper import cleanup_files
-from utils.response import process_article
+from utils.helper.journal import journal
+from utils.helper.pipeline import PipelineResult, Stage, run_pipeline
+from utils.response import batch_api, process_article
+from utils.response.adaptive_concurrency import llm_concurrency
+from utils.response.article_images import ArticleImages
+from utils.response.image_cache import image_cache
+from utils.response.image_fetcher import image_fetcher
+from utils.response.image_policy import image_policies
+from utils.response.llm import llm_client
+from utils.response.preprocess_images import image_processor
+from utils.response.response_cache import response_cache
 
 # Global flag for graceful shutdown
 shutdown_requested = False
@@ -22,72 +38,390 @@ signal.signal(signal.SIGTERM, signal_handler)
 signal.signal(signal.SIGINT, signal_handler)
 
 
-async def main(seconds_wait: str = 60, batch_size: int = 100):
-    global shutdown_requested
+@dataclass
+class ArticleJob:
+    """
+    A single article file on its way through the pipeline.
+    """
+
+    file_name: str
+    remote_path: str
+    article: Optional[dict] = field(default=None, repr=False)
+    article_images: Optional[ArticleImages] = field(default=None, repr=False)
+    # State of the file in the processing journal when the batch started (None = not seen before)
+    resumed_state: Optional[str] = None
+
+
+def _build_stages(article_reader: json_article_loader.ArticleLoaderFromJson) -> dict[str, Stage]:
+    """
+    Returns the pipeline stages by name: download, parse, images, llm, save, upload.
+    """
+
+    async def download(job: ArticleJob) -> ArticleJob:
+        # Downloaded before an interruption (see the processing journal)
+        if job.resumed_state is not None and (data_path_out / job.file_name).is_file():
+            logger.info(f"Article file {job.file_name} is already downloaded")
+            return job
+
+        def _download():
+            with sftp_pool.session() as sftp:
+                ftp_data_loader.download_json_file(sftp, job.remote_path)
+
+        await asyncio.to_thread(_download)
+        await asyncio.to_thread(journal.record_article, job.file_name, "downloaded")
+        return job
+
+    async def parse(job: ArticleJob) -> ArticleJob:
+        logger.info(f"This is article file: {job.file_name}")
+        job.article = await asyncio.to_thread(article_reader.load_article_data, article_file_name=job.file_name)
+        return job
+
+    async def fetch_images(job: ArticleJob) -> ArticleJob:
+        job.article_images = ArticleImages(
+            product_id=job.article.get("ProduktID"),
+            image_urls=process_article.get_image_urls(job.article),
+            supplier_colour=job.article.get("FarbID", None),
+            image_roles=process_article.get_image_roles(job.article),
+        )
+        if job.article_images.image_urls:
+            await job.article_images.prepare()
+        return job
+
+    async def extract(job: ArticleJob) -> Optional[ArticleJob]:
+        try:
+            await process_article.process_article(
+                article=job.article,
+                article_images=job.article_images,
+                should_stop=lambda: shutdown_requested,
+                journal_key=job.file_name,
+            )
+        except process_article.ArticleProcessingInterrupted as e:
+            logger.info(f"Article was not finished and will not be saved: {e}")
+            return None
+        finally:
+            job.article_images.cleanup()
+            job.article_images = None
+        return job
+
+    async def save(job: ArticleJob) -> ArticleJob:
+        await asyncio.to_thread(
+            article_reader.save_article_as_json,
+            file_path=data_path_in,
+            article_file_name=job.file_name,
+            processed_article=job.article,
+        )
+        await asyncio.to_thread(journal.record_article, job.file_name, "extracted")
+        return job
+
+    async def upload(job: ArticleJob) -> ArticleJob:
+        # Posting the json file of this article to FTP-Server
+        logger.info('Posting data to the FTP Server (to "in/" folder)')
+        await asyncio.to_thread(ftp_data_post.FTPDataPoster().upload_files, paths=[data_path_in / job.file_name])
+        await asyncio.to_thread(journal.record_article, job.file_name, "uploaded")
+        logger.success(f'Finished posting article (article id: {job.article["ProduktID"]}) to FTP ("in/" folder)')
+        job.article = None  # Free memory, only the file name is needed from here on
+        return job
+
+    stages = [
+        Stage(
+            name="download",
+            handler=download,
+            workers=pipeline_config.download_workers,
+        ),
+        Stage(name="parse", handler=parse, workers=pipeline_config.parse_workers),
+        Stage(name="images", handler=fetch_images, workers=pipeline_config.image_workers),
+        Stage(name="llm", handler=extract, workers=pipeline_config.llm_workers),
+        Stage(name="save", handler=save, workers=pipeline_config.save_workers),
+        Stage(name="upload", handler=upload, workers=pipeline_config.upload_workers),
+    ]
+
+    return {stage.name: stage for stage in stages}
+
+
+async def _upload_batch(result: PipelineResult) -> PipelineResult:
+    """
+    Upload the saved files of all completed jobs over one SFTP session (pipeline_config.upload_mode == "batched").
+    If the upload fails, the jobs are moved to the failed ones (their files stay in "out/" and are retried).
+    """
+    if not result.completed:
+        return result
+
+    logger.info(f'Posting {len(result.completed)} articles to the FTP Server (to "in/" folder) in one batch')
+    try:
+        await asyncio.to_thread(
+            ftp_data_post.FTPDataPoster().upload_files,
+            paths=[data_path_in / job.file_name for job in result.completed],
+        )
+    except Exception as e:
+        result.failed.extend((job, "upload", e) for job in result.completed)
+        result.completed = []
+        return result
+
+    await asyncio.to_thread(journal.record_articles, [job.file_name for job in result.completed], "uploaded")
+    for job in result.completed:
+        job.article = None
+    logger.success(f'Finished posting {len(result.completed)} articles to FTP ("in/" folder)')
+    return result
+
+
+async def _create_jobs(remote_paths: list[str]) -> list[ArticleJob]:
+    states = await asyncio.to_thread(journal.article_states, [posixpath.basename(remote_path) for remote_path in remote_paths])
+    return [
+        ArticleJob(
+            file_name=posixpath.basename(remote_path),
+            remote_path=remote_path,
+            resumed_state=states.get(posixpath.basename(remote_path)),
+        )
+        for remote_path in remote_paths
+    ]
+
+
+async def _resume_from_journal(remote_paths: list[str]) -> tuple[PipelineResult, list[str]]:
+    """
+    Skips the work which has been done for the listed files before an interruption (see the processing journal):
+    uploaded files only have to be moved, extracted files (result still in data/in) only have to be uploaded.
+    Files which had been moved to done/ before are delivered again and are processed anew.
+
+    Returns:
+        tuple[PipelineResult, list[str]]: The resumed jobs, and the remote paths which still have to go through the pipeline.
+    """
+    resumed = PipelineResult(completed=[], failed=[])
+    to_upload = []
+    remaining_paths = []
+
+    jobs = await _create_jobs(remote_paths)
+    delivered_again = [job.file_name for job in jobs if job.resumed_state == "moved"]
+    if delivered_again:
+        await asyncio.to_thread(journal.forget, delivered_again)
+
+    for job in jobs:
+        if job.resumed_state == "uploaded":
+            resumed.completed.append(job)
+        elif job.resumed_state == "extracted" and (data_path_in / job.file_name).is_file():
+            to_upload.append(job)
+        else:
+            remaining_paths.append(job.remote_path)
 
-    while True and not shutdown_requested:
-        # Step 1: Load data from the API and merge with attributes (in batches)
-        files_downloaded = ftp_data_loader.load_json_from_ftp(batch_size=batch_size)
-        logger.info(f"Downloaded {files_downloaded} files in this batch")
+    if to_upload:
+        upload_result = await _upload_batch(PipelineResult(completed=to_upload, failed=[]))
+        resumed.completed.extend(upload_result.completed)
+        resumed.failed.extend(upload_result.failed)
 
-        # Step 2: Create Article Reader Object and iterate over each article individually
-        article_reader = json_article_loader.ArticleLoaderFromJson(
-            json_dir_path=data_path_out
+    if resumed.completed or resumed.failed:
+        logger.info(
+            f"Resumed {len(resumed.completed) + len(resumed.failed)} article file(s) from the processing journal "
+            f"({len(to_upload)} only had to be uploaded)"
         )
 
-        logger.debug(f"Here are the files we read in: {article_reader.article_files}. Batch size set: {data_config.batch_size}.")
+    return resumed, remaining_paths
+
+
+async def process_batch(remote_paths: list[str]) -> PipelineResult:
+    """
+    Streams the article files of one batch through the pipeline stages:
+    SFTP download -> JSON parse -> image fetch -> LLM extraction -> local save -> SFTP upload (per article, or all at the end
+    if pipeline_config.upload_mode is "batched").
+
+    Args:
+        remote_paths (list[str]): The remote paths of the article files in '/out'.
+
+    Returns:
+        PipelineResult: The jobs which have been uploaded and the failed jobs.
+    """
+    article_reader = json_article_loader.ArticleLoaderFromJson(
+        json_dir_path=data_path_out
+    )
+    stages = _build_stages(article_reader)
+    batched_upload = pipeline_config.upload_mode == "batched"
+    if batched_upload:
+        del stages["upload"]
+
+    result = await run_pipeline(
+        items=await _create_jobs(remote_paths),
+        stages=list(stages.values()),
+        queue_size=pipeline_config.queue_size,
+        should_stop=lambda: shutdown_requested,
+    )
+
+    return await _upload_batch(result) if batched_upload else result
+
+
+async def process_batch_bulk(remote_paths: list[str]) -> PipelineResult:
+    """
+    Processes one batch with the OpenAI Batch API instead of interactive calls (for large backlogs, no interactive latency needed):
+    download, parse and fetch the images of all articles, send all attribute requests as Batch API jobs, wait for them and merge
+    the results, then save and upload the articles.
+
+    Args:
+        remote_paths (list[str]): The remote paths of the article files in '/out'.
+
+    Returns:
+        PipelineResult: The jobs which have been uploaded and the failed jobs.
+    """
+    article_reader = json_article_loader.ArticleLoaderFromJson(
+        json_dir_path=data_path_out
+    )
+    stages = _build_stages(article_reader)
+
+    prepared = await run_pipeline(
+        items=await _create_jobs(remote_paths),
+        stages=[stages["download"], stages["parse"], stages["images"]],
+        queue_size=pipeline_config.queue_size,
+        should_stop=lambda: shutdown_requested,
+    )
+
+    articles = [(job.file_name, job.article, job.article_images) for job in prepared.completed]
+    try:
+        requests = await asyncio.to_thread(batch_api.build_batch_requests, articles)
+        results = await batch_api.run_batch(requests, should_stop=lambda: shutdown_requested)
+    except batch_api.BatchInterrupted as e:
+        # The articles are not saved, the batch is polled again after the restart
+        logger.info(f"Batch was not finished, its articles will not be saved: {e}")
+        return PipelineResult(completed=[], failed=prepared.failed)
+    finally:
+        for job in prepared.completed:
+            job.article_images.cleanup()
+            job.article_images = None
+
+    batch_api.merge_batch_results(articles, results, requests=requests)
+
+    batched_upload = pipeline_config.upload_mode == "batched"
+    finished = await run_pipeline(
+        items=prepared.completed,
+        stages=[stages["save"]] if batched_upload else [stages["save"], stages["upload"]],
+        queue_size=pipeline_config.queue_size,
+    )
+    if batched_upload:
+        finished = await _upload_batch(finished)
+    finished.failed = prepared.failed + finished.failed
+
+    return finished
+
+
+def _source_dir() -> str:
+    """
+    The directory below "out/" which holds the files of this replica ("." without sharding).
+    """
+    if sharding_config.enabled:
+        return posixpath.relpath(work_claimer.processing_dir, work_claimer.base_dir)
+    return "."
+
+
+async def _renew_lease_periodically() -> None:
+    """
+    Keeps the claims of this replica alive while a batch is processed (sharding only).
+    """
+    while True:
+        await asyncio.sleep(work_claimer.lease_timeout / 3)
+        try:
+            await asyncio.to_thread(_renew_lease)
+        except Exception as e:
+            logger.error(f"Could not renew the lease of replica '{work_claimer.worker_id}': {e}")
+
+
+def _renew_lease() -> None:
+    with sftp_pool.session() as sftp:
+        work_claimer.renew_lease(sftp)
+
+
+def _release_claims(file_names: list[str]) -> None:
+    with sftp_pool.session() as sftp:
+        work_claimer.release(sftp, file_names)
 
-        # Get a list of the article filenames that have been found on the FTP-Server and iterate through them (if any present)
+
+async def main(seconds_wait: str = 60, batch_size: int = 100):
+    await _run(process_batch, seconds_wait=seconds_wait, batch_size=batch_size)
+
+
+async def main_bulk(seconds_wait: str = 60, batch_size: int = 100):
+    """
+    Same as main, but the attributes of each batch are extracted with the OpenAI Batch API (higher throughput, lower cost).
+    """
+    await _run(process_batch_bulk, seconds_wait=seconds_wait, batch_size=batch_size)
+
+
+async def _run(batch_processor: Callable[[list[str]], Awaitable[PipelineResult]], seconds_wait: str = 60, batch_size: int = 100):
+    try:
+        await run_loop(batch_processor=batch_processor, seconds_wait=seconds_wait, batch_size=batch_size)
+    finally:
+        # Close the shared connection pools
+        await image_fetcher.aclose()
+        await llm_client.aclose()
+        await asyncio.to_thread(sftp_pool.close_all)
+        await asyncio.to_thread(image_processor.shutdown)
+
+    logger.info("Program exiting...")
+
+
+async def run_loop(
+    batch_processor: Callable[[list[str]], Awaitable[PipelineResult]] = process_batch,
+    seconds_wait: str = 60,
+    batch_size: int = 100,
+):
+    # Drop the journal entries of articles which have been finished long ago
+    await asyncio.to_thread(journal.prune, journal_config.retention_days * 24 * 3600)
+
+    lease_task = asyncio.create_task(_renew_lease_periodically()) if sharding_config.enabled else None
+    try:
+        await _run_batches(batch_processor=batch_processor, seconds_wait=seconds_wait, batch_size=batch_size)
+    finally:
+        if lease_task is not None:
+            lease_task.cancel()
+
+
+async def _run_batches(
+    batch_processor: Callable[[list[str]], Awaitable[PipelineResult]] = process_batch,
+    seconds_wait: str = 60,
+    batch_size: int = 100,
+):
+    global shutdown_requested
+
+    while True and not shutdown_requested:
         # Number of checks during work hours where no new data had been added
         number_of_idle_checks = 0
 
-        list_article_filenames = article_reader.article_files
-        if len(list_article_filenames) > 0:
+        # Step 1: List the article files on the FTP-Server (in batches)
+        remote_paths = await asyncio.to_thread(ftp_data_loader.list_json_files_on_ftp, batch_size=batch_size)
+        logger.info(f"Found {len(remote_paths)} files in this batch. Batch size set: {data_config.batch_size}.")
+
+        if len(remote_paths) > 0:
             number_of_idle_checks = 0  # Back to 0
 
-            for file_name in article_reader.article_files:
-                # Check for shutdown request before processing each article
-                if shutdown_requested:
-                    logger.info("Shutdown requested, stopping article processing")
-                    break
+            # Skip what has already been done before an interruption (processing journal)
+            result, remaining_paths = await _resume_from_journal(remote_paths)
 
-                logger.info(f"This is article file: {file_name}")
+            # Step 2-5: Download, read, process, save and post each article (stages run concurrently, one article per stage worker)
+            if remaining_paths:
+                pipeline_result = await batch_processor(remaining_paths)
+                result.completed.extend(pipeline_result.completed)
+                result.failed.extend(pipeline_result.failed)
+            processed_files = [job.file_name for job in result.completed]
 
-                # Step 3: Read raw article data
-                logger.info("Getting article and attribute data")
-                article = article_reader.load_article_data(
-                    article_file_name=file_name
-                )
-                # logger.debug(f"This is the current article: {article}")
+            for job, stage_name, error in result.failed:
+                logger.error(f"Article file {job.file_name} failed in stage '{stage_name}': {error}")
 
-                # Step 4: Send full article dict to process each attribute and save as new JSON file
-                processed_article = await process_article.process_article(
-                    article=article
-                )
+            if result.failed and not processed_files and not shutdown_requested:
+                raise RuntimeError(f"None of the {len(result.failed)} article files of the batch could be processed")
 
-                article_reader.save_article_as_json(
-                    file_path=data_path_in,
-                    article_file_name=file_name,
-                    processed_article=processed_article,
+            # Several replicas: on shutdown, finished files are moved and the unfinished claims are given back to "out/" right away
+            if shutdown_requested and sharding_config.enabled:
+                moved_files = await asyncio.to_thread(
+                    ftp_data_post.FTPDataPoster().move_to_done, files=processed_files, source_dir=_source_dir()
                 )
-
-                # Step 5: Posting data to "in" folder and delete data from "out" folder on FTP-Server
-                # Initialize ftp handler
-                ftp_data_poster = ftp_data_post.FTPDataPoster()
-
-                # Posting json files to FTP-Server
-                logger.info('Posting data to the FTP Server (to "in/" folder)')
-                ftp_data_poster.post_json_to_ftp()
-                logger.success(f'Finished posting article (article id: {article["ProduktID"]}) to FTP ("in/" folder)')
+                await asyncio.to_thread(journal.record_articles, moved_files, "moved")
+                unfinished_files = [posixpath.basename(path) for path in remote_paths if posixpath.basename(path) not in processed_files]
+                await asyncio.to_thread(_release_claims, unfinished_files)
+                logger.info(f"Released {len(unfinished_files)} unfinished claim(s) of replica '{work_claimer.worker_id}'")
 
             # Only do cleanup and FTP operations if we weren't interrupted
             if not shutdown_requested:
-                # Deleting files on FTP-Server, which have been fully processed
+                # Moving files on FTP-Server, which have been fully processed (failed files stay in "out/" and are retried)
                 logger.info('Deleting data from FTP Server (from "out/" folder)')
-                ftp_data_poster.move_to_done(
-                    files=article_reader.article_files
+                moved_files = await asyncio.to_thread(
+                    ftp_data_post.FTPDataPoster().move_to_done, files=processed_files, source_dir=_source_dir()
                 )
-                logger.success(f'Finished moving articles ({article_reader.article_files}) from FTP ("out/" folder) to "out/done/" folder')
+                await asyncio.to_thread(journal.record_articles, moved_files, "moved")
+                logger.success(f'Finished moving articles ({processed_files}) from FTP ("out/" folder) to "out/done/" folder')
 
                 # Step 6: Delete article from ./data/out/ locally
                 cleanup_files.cleanup_files(
@@ -99,13 +433,17 @@ async def main(seconds_wait: str = 60, batch_size: int = 100):
                     dir_path_to_delete=data_path_in
                 )
 
-                logger.success(f"Done processing {len(article_reader.article_files)} articles")
+                logger.success(f"Done processing {len(processed_files)} articles")
+                logger.info(f"LLM response cache: {response_cache.stats()}")
+                logger.info(f"Image cache: {image_cache.stats()}")
+                logger.info(f"Image tokens saved per attribute (image policies): {image_policies.tokens_saved}")
+                logger.info(f"LLM concurrency limit: {llm_concurrency.limit} (p95 latency baseline: {llm_concurrency.baseline_p95})")
 
                 # Check if there might be more files to process
-                if files_downloaded == batch_size:
+                if len(remote_paths) == batch_size:
                     logger.info(f"Processed full batch of {batch_size} files. There might be more files available.")
                 else:
-                    logger.info(f"Processed {files_downloaded} files (less than batch size). Likely processed all available files.")
+                    logger.info(f"Processed {len(remote_paths)} files (less than batch size). Likely processed all available files.")
 
         else:
             # Add to the number of tries without new data during working hours
@@ -123,9 +461,11 @@ async def main(seconds_wait: str = 60, batch_size: int = 100):
             logger.info("Shutdown requested, exiting main loop")
             break
 
-    logger.info("Program exiting...")
-
 
 if __name__ == "__main__":
     # Process X files at a time - can be changed under config
-    asyncio.run(main(batch_size=data_config.batch_size))
+    # Use "--bulk" for large backlogs (OpenAI Batch API, e.g. for overnight runs)
+    if "--bulk" in sys.argv:
+        asyncio.run(main_bulk(batch_size=data_config.batch_size))
+    else:
+        asyncio.run(main(batch_size=data_config.batch_size))
@@ -1,118 +1,133 @@
-import io
 import os
 import posixpath
+import shutil
 import stat
 
 import paramiko
 from loguru import logger
 
-from config.config import ftp_config
+from config.config import ftp_config, sftp_download_config, sharding_config
 from config.paths import data_path_out
+from utils.data_preprocessing.sftp_pool import _get_host_and_password, sftp_pool
+from utils.data_preprocessing.work_claims import work_claimer
+
+
+def list_remote_json_files(sftp: paramiko.SFTPClient, batch_size: int = None, base_dir: str = '/out') -> list[str]:
+    """
+    List the JSON files in the remote base directory (no subfolders).
+
+    Args:
+        sftp (paramiko.SFTPClient): An open SFTP session.
+        batch_size (int, optional): Maximum number of files to return. Defaults to None (no limit).
+        base_dir (str, optional): The remote directory. Defaults to '/out'.
+
+    Returns:
+        list[str]: The absolute remote paths of the JSON files.
+    """
+    entries = sftp.listdir_attr(base_dir)
+
+    jsons = [
+        e.filename
+        for e in entries
+        if stat.S_ISREG(e.st_mode) and e.filename.endswith('.json')
+    ]
+    logger.info(f"Folder {base_dir}: {len(jsons)} JSON file(s)") #{jsons}
+    json_remote_paths = [posixpath.join(base_dir, n) for n in jsons]
+
+    # batch limit
+    if batch_size is not None:
+        json_remote_paths = json_remote_paths[:batch_size]
+        logger.info(
+            f'Processing batch of {len(json_remote_paths)} files (batch_size={batch_size})'
+        )
+    else:
+        logger.info(f'Processing {len(json_remote_paths)} files (no   limit)')
+
+    return json_remote_paths
+
+
+def download_json_file(
+    sftp: paramiko.SFTPClient,
+    remote_path: str,
+    local_dir: str = data_path_out,
+    read_size: int = sftp_download_config.read_size,
+) -> str:
+    """
+    Download a single remote file into the local directory. The file is prefetched (pipelined read requests) and streamed in
+    chunks of read_size into a temporary file next to the target, so it is never held in memory as a whole.
+
+    Returns:
+        str: The local path of the downloaded file.
+    """
+    filename = posixpath.basename(remote_path)
+    logger.info(f"Reading '{remote_path}'")
+
+    os.makedirs(local_dir, exist_ok=True)
+    local_path = os.path.join(local_dir, filename)
+    temp_path = f'{local_path}.part'
+
+    try:
+        with sftp.open(remote_path, 'rb') as rf, open(temp_path, 'wb') as lf:
+            rf.prefetch(max_concurrent_requests=sftp_download_config.max_concurrent_requests)
+            shutil.copyfileobj(rf, lf, read_size)
+        os.replace(temp_path, local_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    logger.info(f"Saved to '{local_path}'")
+    return local_path
+
+
+def _list_or_claim(sftp: paramiko.SFTPClient, batch_size: int = None, base_dir: str = '/out') -> list[str]:
+    # Several replicas: only the files claimed by this replica (in its processing directory) are returned
+    if sharding_config.enabled:
+        return work_claimer.claim(sftp, batch_size=batch_size)
+    return list_remote_json_files(sftp, batch_size=batch_size, base_dir=base_dir)
+
+
+def list_json_files_on_ftp(batch_size: int = None) -> list[str]:
+    """
+    List the JSON files under '/out' on the SFTP server (pooled session). With sharding enabled, the files are claimed for this
+    replica first and their paths in '/out/processing/<worker-id>/' are returned.
+    """
+    with sftp_pool.session() as sftp:
+        return _list_or_claim(sftp, batch_size=batch_size)
 
 
 def load_json_from_ftp(batch_size: int = None) -> int:
     """
     Load JSON files from SFTP server, only from date-based subfolders (YYYYMMDD) under '/out'.
     """
-    host_address = (
-        ftp_config.host_address_integ
-        if ftp_config.integ_or_prod == 'integ'
-        else ftp_config.host_address_prod
-    )
-    password = (
-        ftp_config.integ_password
-        if ftp_config.integ_or_prod == 'integ'
-        else ftp_config.prod_password
-    )
- 
-    client = None
-    sftp = None
+    host_address, _ = _get_host_and_password()
+
     files_downloaded = 0
     base_dir = '/out'  # absolute path; avoids relative confusion
- 
+
     try:
-        logger.info(
-            f'Connecting to SFTP with host_address: {host_address} and user: {ftp_config.username}'
-        )
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(
-            hostname=host_address,
-            port=ftp_config.port,
-            username=ftp_config.username,
-            password=password,
-        )
- 
-        sftp = client.open_sftp()
-        
-        # Change to base directory
-        try:
-            sftp.chdir(base_dir)  # "cd" into /out on the SFTP server
-            logger.info(f"Changed directory to '{base_dir}'")
-        except IOError as e:
-            logger.error(f"Cannot chdir to '{base_dir}': {e}")
-            raise
-        
-        # Find all json files in out/ folder
-        json_remote_paths = []
-        entries = sftp.listdir_attr('.')
-
-        jsons = [
-            e.filename
-            for e in entries
-            if stat.S_ISREG(e.st_mode) and e.filename.endswith('.json')
-        ]
-        logger.info(f"Folder {base_dir}: {len(jsons)} JSON file(s)") #{jsons}
-        json_remote_paths.extend([posixpath.join(base_dir, n) for  n in jsons])
- 
-        # batch limit
-        if batch_size is not None:
-            json_remote_paths = json_remote_paths[:batch_size]
-            logger.info(
-                f'Processing batch of {len(json_remote_paths)} files (batch_size={batch_size})'
-            )
-        else:
-            logger.info(f'Processing {len(json_remote_paths)} files (no   limit)')
- 
-        if not json_remote_paths:
-            logger.info('No JSON files found in the date folders; nothing to download.')
-            return 0
- 
-        # --- download ---
-        os.makedirs(data_path_out, exist_ok=True)
- 
-        for remote_path in json_remote_paths:
-            filename = posixpath.basename(remote_path)
-            logger.info(f"Reading '{remote_path}'")
-            try:
-                buf = io.BytesIO()
-                with sftp.open(remote_path, 'rb') as rf:
-                    buf.write(rf.read())
-                buf.seek(0)
- 
-                local_path = os.path.join(data_path_out, filename)
-                with open(local_path, 'wb') as lf:
-                    lf.write(buf.getvalue())
- 
-                logger.info(f"Saved to '{local_path}'")
-                files_downloaded += 1
- 
-            except Exception as e:
-                logger.error(f"Error retrieving or saving '{remote_path}': {e}")
- 
+        with sftp_pool.session() as sftp:
+            # Find all json files in out/ folder
+            json_remote_paths = _list_or_claim(sftp, batch_size=batch_size, base_dir=base_dir)
+
+            if not json_remote_paths:
+                logger.info('No JSON files found in the date folders; nothing to download.')
+                return 0
+
+            # --- download (streamed to disk) ---
+            for remote_path in json_remote_paths:
+                try:
+                    download_json_file(sftp, remote_path)
+                    files_downloaded += 1
+                except Exception as e:
+                    logger.error(f"Error retrieving or saving '{remote_path}': {e}")
+
         return files_downloaded
- 
+
     except Exception as e:
         logger.error(
             f'FTP error (host: {host_address}, user: {ftp_config.username}): {e}'
         )
         raise
     finally:
-        try:
-            if sftp:
-                sftp.close()
-        finally:
-            if client:
-                client.close()
-        logger.info(f'SFTP connection closed. Downloaded {files_downloaded} files.')
-        
\ No newline at end of file
+        logger.info(f'Downloaded {files_downloaded} files.')
@@ -1,12 +1,14 @@
+import io
 import os
-import re
+import posixpath
 import stat
+from typing import Iterable, Optional
 
-import paramiko
 from loguru import logger
 
 from config.config import ftp_config
 from config.paths import data_path_in
+from utils.data_preprocessing.sftp_pool import sftp_pool
 
 
 class FTPDataPoster:
@@ -30,28 +32,24 @@ class FTPDataPoster:
         return os.path.join(*parts).replace("\\", "/")
 
     def connect(self):
+        """
+        Borrow a session from the shared SFTP pool (a new connection is only opened if no healthy idle session exists).
+        """
         try:
-            logger.info(f"Connecting to SFTP with host_address: {self.host_address} and user: {ftp_config.username}")
-            self.client = paramiko.SSHClient()
-            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.client.connect(
-                hostname=self.host_address,
-                port=ftp_config.port,
-                username=ftp_config.username,
-                password=self.password,
-            )
-            self.sftp_client = self.client.open_sftp()
+            self.client, self.sftp_client = sftp_pool.acquire()
         except Exception as e:
             logger.error(f'Unable to login to host_address: {self.host_address} with user: {ftp_config.username}')
             raise Exception(f'Unable to login to SFTP server. Error: {e}')
 
     def close(self):
-        if self.sftp_client:
-            self.sftp_client.close()
-            logger.info("SFTP connection closed.")
-        if self.client:
-            self.client.close()
-            logger.info("SSH client closed.")
+        """
+        Return the session to the pool (it stays open for the next upload/move).
+        """
+        if self.client and self.sftp_client:
+            sftp_pool.release((self.client, self.sftp_client))
+            logger.info("SFTP session returned to the pool.")
+        self.client = None
+        self.sftp_client = None
 
     def _ensure_done_dir(self):
         """
@@ -72,41 +70,59 @@ class FTPDataPoster:
         # go back to /out for sanity
         sftp.chdir('..')
 
-    def post_json_to_ftp(self) -> int:
+    @staticmethod
+    def _put(sftp, file_obj, remote_path: str) -> None:
+        # putfo writes pipelined (no round trip per chunk) and confirms the size afterwards
+        sftp.putfo(file_obj, remote_path, confirm=True)
+
+    def upload_files(
+        self,
+        paths: Optional[Iterable[str]] = None,
+        payloads: Optional[dict[str, bytes]] = None,
+        remote_dir: str = 'in/',
+    ) -> int:
         """
-        Upload JSON files from local data_path_in to remote in/ directory.
-        Returns the number of files uploaded.
+        Upload exactly the given local files and/or in-memory files to the remote in/ directory, all over one pooled session.
+
+        Args:
+            paths (Iterable[str], optional): Local file paths, uploaded under their file name.
+            payloads (dict[str, bytes], optional): File name -> content, uploaded without a local file.
+            remote_dir (str, optional): The remote directory (relative to the SFTP root). Defaults to 'in/'.
+
+        Returns:
+            int: The number of uploaded files.
         """
+        paths = list(paths or [])
+        payloads = payloads or {}
+        if not paths and not payloads:
+            return 0
+
         try:
             self.connect()
             sftp = self.sftp_client
 
-            # Change to in/ directory
             try:
-                sftp.chdir('in/')
+                sftp.chdir(remote_dir)
                 current_remote_dir = sftp.getcwd()
-                logger.info(f"Changed directory to: {current_remote_dir}")
             except IOError:
-                logger.error("Remote directory 'in/' does not exist")
+                logger.error(f"Remote directory '{remote_dir}' does not exist")
                 raise
 
-            if not data_path_in or not os.path.isdir(data_path_in):
-                raise ValueError(f"'{data_path_in}' is not a valid local directory")
-
             uploaded = 0
-            for filename in os.listdir(data_path_in):
-                if not filename.endswith('.json'):
-                    continue
-                local_file_path = os.path.join(data_path_in, filename)
-                if not os.path.isfile(local_file_path):
-                    continue
+            for local_file_path in paths:
+                remote_path = self._rjoin(current_remote_dir, os.path.basename(local_file_path))
+                logger.info(f"Uploading '{local_file_path}' to '{remote_path}'")
+                with open(local_file_path, 'rb') as local_file:
+                    self._put(sftp, local_file, remote_path)
+                uploaded += 1
 
+            for filename, content in payloads.items():
                 remote_path = self._rjoin(current_remote_dir, filename)
-                logger.info(f"Uploading '{filename}' to '{remote_path}'")
-                sftp.put(local_file_path, remote_path)
+                logger.info(f"Uploading '{filename}' ({len(content)} bytes from memory) to '{remote_path}'")
+                self._put(sftp, io.BytesIO(content), remote_path)
                 uploaded += 1
 
-            logger.success(f"Uploaded {uploaded} JSON file(s)")
+            logger.success(f"Uploaded {uploaded} file(s)")
             return uploaded
 
         except Exception as e:
@@ -115,9 +131,28 @@ class FTPDataPoster:
         finally:
             self.close()
 
-    def move_to_done(self, files: list[str]) -> None:
+    def post_json_to_ftp(self) -> int:
+        """
+        Upload all JSON files from local data_path_in to remote in/ directory.
+        Returns the number of files uploaded.
+
+        Note: this uploads everything in data_path_in again, use upload_files for single articles.
+        """
+        if not data_path_in or not os.path.isdir(data_path_in):
+            raise ValueError(f"'{data_path_in}' is not a valid local directory")
+
+        local_file_paths = [
+            os.path.join(data_path_in, filename)
+            for filename in os.listdir(data_path_in)
+            if filename.endswith('.json') and os.path.isfile(os.path.join(data_path_in, filename))
+        ]
+        return self.upload_files(paths=local_file_paths)
+
+    def move_to_done(self, files: list[str], source_dir: str = '.') -> list[str]:
         """
-        Move all regular files from out/ to out/done/ via server-side rename.
+        Move all regular files from out/ (or from source_dir below out/, e.g. the processing directory of this replica)
+        to out/done/ via server-side rename.
+        Returns the names of the moved files.
         """
         try:
             self.connect()
@@ -134,17 +169,17 @@ class FTPDataPoster:
                 sftp.mkdir('done')
 
             # find all regular files (ignore subdirectories)
-            entries = sftp.listdir_attr('.')
+            entries = sftp.listdir_attr(source_dir)
             files = [e.filename for e in entries if stat.S_ISREG(e.st_mode) and e.filename in files]
 
-            moved = 0
+            moved = []
             for fname in files:
-                src = fname
+                src = posixpath.join(source_dir, fname) if source_dir != '.' else fname
                 dst = f"done/{fname}"
                 try:
                     sftp.rename(src, dst)
                     logger.info(f"Moved: {src} -> {dst}")
-                    moved += 1
+                    moved.append(fname)
                 except IOError as e:
                     logger.warning(f"File '{fname}' could not be moved: {e}. Probably it already exists in 'done/'.")
                     # Delete file in done and retry
@@ -153,11 +188,12 @@ class FTPDataPoster:
                         logger.warning(f"Deleted existing file in 'done/': {dst}. Retrying move.")
                         sftp.rename(src, dst)
                         logger.success(f"Moved: {src} -> {dst}")
-                        moved += 1
+                        moved.append(fname)
                     except IOError as e2:
                         logger.error(f"Retry failed for moving '{fname}': {e2}")
 
-            logger.info(f"Moved {moved}/{len(files)} file(s) to out/done/")
+            logger.info(f"Moved {len(moved)}/{len(files)} file(s) to out/done/")
+            return moved
 
         except Exception as e:
             logger.error(f"Error during move: {e}")
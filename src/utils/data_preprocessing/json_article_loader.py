@@ -57,9 +57,11 @@ class ArticleLoaderFromJson:
             logger.info(f'Directory {file_path} does not exist, creating it...')
             os.makedirs(file_path, exist_ok=True)
 
-        # Step 2: Save article at teh given file_path
-        with open(file_path / article_file_name, 'w', encoding='utf-8') as f:
+        # Step 2: Save article at teh given file_path (via a temporary file, so a concurrent upload never sees a partial file)
+        temp_file_path = file_path / f'{article_file_name}.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
             json.dump(processed_article, f, indent=2, ensure_ascii=False)
+        os.replace(temp_file_path, file_path / article_file_name)
 
         logger.info(f'Successfully saved article at: "{file_path / article_file_name}"')
 
@@ -0,0 +1,187 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+import paramiko
+from loguru import logger
+
+from config.config import ftp_config, sftp_pool_config
+from utils.helper import metrics
+
+SFTPConnection = tuple[paramiko.SSHClient, paramiko.SFTPClient]
+
+
+def _get_host_and_password() -> tuple[str, str]:
+    host_address = (
+        ftp_config.host_address_integ
+        if ftp_config.integ_or_prod == 'integ'
+        else ftp_config.host_address_prod
+    )
+    password = (
+        ftp_config.integ_password
+        if ftp_config.integ_or_prod == 'integ'
+        else ftp_config.prod_password
+    )
+    return host_address, password
+
+
+def connect_sftp() -> tuple[paramiko.SSHClient, paramiko.SFTPClient]:
+    """
+    Open a new SSH connection and SFTP session to the configured server.
+
+    Returns:
+        tuple[paramiko.SSHClient, paramiko.SFTPClient]: The SSH client and the SFTP session (both have to be closed by the caller).
+    """
+    host_address, password = _get_host_and_password()
+
+    logger.info(
+        f'Connecting to SFTP with host_address: {host_address} and user: {ftp_config.username}'
+    )
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(
+            hostname=host_address,
+            port=ftp_config.port,
+            username=ftp_config.username,
+            password=password,
+        )
+        sftp = client.open_sftp()
+    except Exception:
+        client.close()
+        raise
+
+    return client, sftp
+
+
+def close_sftp(client: paramiko.SSHClient, sftp: paramiko.SFTPClient) -> None:
+    try:
+        if sftp:
+            sftp.close()
+    finally:
+        if client:
+            client.close()
+
+
+class SFTPConnectionPool:
+    """
+    Thread-safe pool of SSH/SFTP sessions, shared by the loader and the poster, so a batch needs a few handshakes instead of one
+    per upload/move. Idle sessions are checked before they are handed out (transport alive, and a cheap `stat('.')` if they have
+    been idle for longer than health_check_interval); broken sessions are closed and replaced by a new connection.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 4,
+        health_check_interval: float = 30.0,
+        max_idle_time: float = 300.0,
+        connect: Callable[[], SFTPConnection] = connect_sftp,
+    ):
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.max_idle_time = max_idle_time
+        self._connect = connect
+        self._idle: list[tuple[SFTPConnection, float]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    @staticmethod
+    def _is_alive(connection: SFTPConnection) -> bool:
+        transport = connection[0].get_transport()
+        return transport is not None and transport.is_active()
+
+    def _is_healthy(self, connection: SFTPConnection, idle_since: float) -> bool:
+        if not self._is_alive(connection):
+            return False
+
+        idle_time = time.monotonic() - idle_since
+        if idle_time > self.max_idle_time:
+            return False
+        if idle_time > self.health_check_interval:
+            try:
+                connection[1].stat('.')
+            except Exception as e:
+                logger.warning(f'SFTP session failed the health check: {e}')
+                return False
+
+        return True
+
+    def acquire(self, timeout: Optional[float] = None) -> SFTPConnection:
+        """
+        Take an idle healthy session or open a new one (at most max_size sessions are handed out at the same time).
+
+        Raises:
+            TimeoutError: If no session became free within the timeout.
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f'No SFTP session became free within {timeout}s')
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, idle_since = self._idle.pop()
+
+                if self._is_healthy(connection, idle_since):
+                    metrics.increment('sftp_sessions_reused')
+                    return connection
+
+                logger.info('Dropping broken or expired SFTP session from the pool')
+                close_sftp(*connection)
+
+            connection = self._connect()
+            metrics.increment('sftp_sessions_opened')
+            return connection
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection: SFTPConnection, discard: bool = False) -> None:
+        """
+        Give a session back to the pool. Broken sessions (or discard=True) are closed instead.
+        """
+        try:
+            if not discard and self._is_alive(connection):
+                try:
+                    # The next user starts in the login directory again (relative paths like 'out/' depend on it)
+                    connection[1].chdir(None)
+                    with self._lock:
+                        self._idle.append((connection, time.monotonic()))
+                    return
+                except Exception as e:
+                    logger.warning(f'SFTP session could not be reset and is closed: {e}')
+
+            close_sftp(*connection)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def session(self) -> Iterator[paramiko.SFTPClient]:
+        """
+        Borrow a session for the duration of the with block. If the connection broke during the block, it is not reused.
+        """
+        connection = self.acquire()
+        try:
+            yield connection[1]
+        finally:
+            self.release(connection)
+
+    def close_all(self) -> None:
+        """
+        Close the idle sessions (sessions in use are closed when they are released).
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            close_sftp(*connection)
+        if idle:
+            logger.info(f'Closed {len(idle)} pooled SFTP session(s)')
+
+
+sftp_pool = SFTPConnectionPool(
+    max_size=sftp_pool_config.max_size,
+    health_check_interval=sftp_pool_config.health_check_interval,
+    max_idle_time=sftp_pool_config.max_idle_time,
+)
@@ -0,0 +1,182 @@
+import json
+import posixpath
+import socket
+import stat
+from typing import Optional
+
+import paramiko
+from loguru import logger
+
+from config.config import sharding_config
+from utils.helper import metrics
+
+LEASE_FILE_NAME = '.lease'
+
+
+class WorkClaimer:
+    """
+    Shards the article files in '/out' between several replicas. A replica claims a file by renaming it into its own
+    '/out/processing/<worker-id>/' directory; the rename is atomic on the server, so each file is claimed by exactly one replica.
+
+    Every replica keeps a lease file in its directory and renews it regularly. Files of replicas whose lease is older than
+    lease_timeout (crashed or removed replicas) are reclaimed by the others. The age of a lease is measured with the modification
+    times of the SFTP server (compared to the own, just renewed lease), so the clocks of the replicas do not matter.
+    """
+
+    def __init__(self, worker_id: str, lease_timeout: float = 600.0, base_dir: str = '/out'):
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self.base_dir = base_dir
+        self.processing_root = posixpath.join(base_dir, 'processing')
+
+    @property
+    def processing_dir(self) -> str:
+        return posixpath.join(self.processing_root, self.worker_id)
+
+    @staticmethod
+    def _mkdir(sftp: paramiko.SFTPClient, path: str) -> None:
+        try:
+            sftp.mkdir(path)
+        except IOError:
+            # Exists already (or has been created by another replica in the meantime)
+            sftp.stat(path)
+
+    @staticmethod
+    def _json_files(sftp: paramiko.SFTPClient, path: str) -> list[str]:
+        return sorted(
+            entry.filename
+            for entry in sftp.listdir_attr(path)
+            if stat.S_ISREG(entry.st_mode) and entry.filename.endswith('.json')
+        )
+
+    def renew_lease(self, sftp: paramiko.SFTPClient) -> float:
+        """
+        Create the processing directory of this replica if needed and renew its lease.
+
+        Returns:
+            float: The modification time of the renewed lease, i.e. the current time of the SFTP server.
+        """
+        self._mkdir(sftp, self.processing_root)
+        self._mkdir(sftp, self.processing_dir)
+
+        lease_path = posixpath.join(self.processing_dir, LEASE_FILE_NAME)
+        with sftp.open(lease_path, 'w') as lease_file:
+            lease_file.write(json.dumps({'worker_id': self.worker_id}))
+
+        return sftp.stat(lease_path).st_mtime
+
+    @staticmethod
+    def _lease_renewed_at(sftp: paramiko.SFTPClient, worker_dir: str) -> Optional[float]:
+        """
+        The modification time of the lease of a replica directory on the SFTP server (None if there is no lease).
+        """
+        try:
+            return sftp.stat(posixpath.join(worker_dir, LEASE_FILE_NAME)).st_mtime
+        except IOError:
+            return None
+
+    def reclaim_stale(self, sftp: paramiko.SFTPClient, server_time: Optional[float] = None) -> list[str]:
+        """
+        Move the files of replicas with an expired lease into the own processing directory. A directory without a lease is only
+        stale if the directory itself is older than lease_timeout (a replica creates its directory before it writes the lease).
+
+        Args:
+            sftp (paramiko.SFTPClient): The SFTP session.
+            server_time (float, optional): The current time of the SFTP server (see renew_lease). Defaults to renewing the
+                own lease.
+
+        Returns:
+            list[str]: The names of the reclaimed files.
+        """
+        if server_time is None:
+            server_time = self.renew_lease(sftp)
+
+        reclaimed = []
+        for entry in sftp.listdir_attr(self.processing_root):
+            if not stat.S_ISDIR(entry.st_mode) or entry.filename == self.worker_id:
+                continue
+
+            worker_dir = posixpath.join(self.processing_root, entry.filename)
+            renewed_at = self._lease_renewed_at(sftp, worker_dir)
+            lease_age = server_time - renewed_at if renewed_at is not None else None
+            if lease_age is not None and lease_age < self.lease_timeout:
+                continue
+            if lease_age is None and entry.st_mtime is not None and server_time - entry.st_mtime < self.lease_timeout:
+                continue
+
+            reclaimed_from_worker = []
+            for filename in self._json_files(sftp, worker_dir):
+                try:
+                    sftp.rename(posixpath.join(worker_dir, filename), posixpath.join(self.processing_dir, filename))
+                    reclaimed_from_worker.append(filename)
+                except IOError:
+                    # Reclaimed by another replica first
+                    continue
+
+            if reclaimed_from_worker:
+                logger.warning(
+                    f"Reclaimed {len(reclaimed_from_worker)} file(s) from replica '{entry.filename}' "
+                    f"(lease {'missing' if lease_age is None else f'expired {lease_age:.0f}s ago'})"
+                )
+            reclaimed.extend(reclaimed_from_worker)
+
+            # Remove the abandoned directory (a returning replica creates it again with a fresh lease)
+            try:
+                sftp.remove(posixpath.join(worker_dir, LEASE_FILE_NAME))
+            except IOError:
+                pass
+            try:
+                sftp.rmdir(worker_dir)
+            except IOError:
+                pass
+
+        metrics.increment('sftp_files_reclaimed', len(reclaimed))
+        return reclaimed
+
+    def claim(self, sftp: paramiko.SFTPClient, batch_size: Optional[int] = None) -> list[str]:
+        """
+        Claim up to batch_size files for this replica: files left in the own directory (failed or interrupted before) come first,
+        then files of stale replicas, then new files from '/out'.
+
+        Returns:
+            list[str]: The absolute remote paths of the claimed files (in the own processing directory).
+        """
+        server_time = self.renew_lease(sftp)
+        self.reclaim_stale(sftp, server_time=server_time)
+
+        claimed = self._json_files(sftp, self.processing_dir)
+        conflicts = 0
+
+        for filename in self._json_files(sftp, self.base_dir):
+            if batch_size is not None and len(claimed) >= batch_size:
+                break
+            try:
+                sftp.rename(posixpath.join(self.base_dir, filename), posixpath.join(self.processing_dir, filename))
+                claimed.append(filename)
+            except IOError:
+                # Claimed by another replica in the meantime
+                conflicts += 1
+
+        if batch_size is not None:
+            claimed = claimed[:batch_size]
+
+        metrics.increment('sftp_claim_conflicts', conflicts)
+        logger.info(f"Replica '{self.worker_id}' holds {len(claimed)} file(s) ({conflicts} claimed by other replicas first)")
+
+        return [posixpath.join(self.processing_dir, filename) for filename in claimed]
+
+    def release(self, sftp: paramiko.SFTPClient, file_names: list[str]) -> None:
+        """
+        Give unfinished files back to '/out' (e.g. on shutdown), so other replicas do not have to wait for the lease to expire.
+        """
+        for filename in file_names:
+            try:
+                sftp.rename(posixpath.join(self.processing_dir, filename), posixpath.join(self.base_dir, filename))
+            except IOError as e:
+                logger.warning(f"Could not release '{filename}' back to {self.base_dir}: {e}")
+
+
+work_claimer = WorkClaimer(
+    worker_id=sharding_config.worker_id or socket.gethostname(),
+    lease_timeout=sharding_config.lease_timeout,
+)
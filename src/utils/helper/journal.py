@@ -0,0 +1,230 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterable, Literal, Optional
+
+from loguru import logger
+
+from config.config import journal_config
+from config.paths import data_path_state
+
+ArticleState = Literal['downloaded', 'extracted', 'uploaded', 'moved']
+
+# Order of the article states, a later state implies the earlier ones
+ARTICLE_STATES = ('downloaded', 'extracted', 'uploaded', 'moved')
+
+
+class ProcessingJournal:
+    """
+    Crash-safe, append-only journal (SQLite in WAL mode) of the processing state per article file and of the answered attributes,
+    so a restarted container resumes a batch instead of downloading and extracting everything again.
+
+    Article states: downloaded -> extracted (result saved to data/in) -> uploaded (posted to in/) -> moved (out/ -> out/done/).
+    Submitted Batch API jobs (bulk mode) are recorded as well, so a restart polls them again instead of submitting them anew.
+    """
+
+    def __init__(self, db_path: Path, enabled: bool = True):
+        self.db_path = Path(db_path)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            # Every commit is on disk before the next step starts
+            self._connection.execute('PRAGMA synchronous=FULL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS article_events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, file_name TEXT NOT NULL, state TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS attribute_events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, file_name TEXT NOT NULL, attribute_index INTEGER NOT NULL, '
+                'attribute_id TEXT, value TEXT NOT NULL, created_at REAL NOT NULL, article_hash TEXT)'
+            )
+            # Journals written before the article hash was recorded
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(attribute_events)')]
+            if 'article_hash' not in columns:
+                self._connection.execute('ALTER TABLE attribute_events ADD COLUMN article_hash TEXT')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS batch_jobs ('
+                'batch_id TEXT PRIMARY KEY, custom_ids TEXT NOT NULL, created_at REAL NOT NULL, finished_at REAL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS idx_article_events_file ON article_events (file_name)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS idx_attribute_events_file ON attribute_events (file_name)')
+            self._connection.commit()
+        return self._connection
+
+    def record_article(self, file_name: str, state: ArticleState) -> None:
+        if not self.enabled:
+            return
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'INSERT INTO article_events (file_name, state, created_at) VALUES (?, ?, ?)', (file_name, state, time.time())
+            )
+            connection.commit()
+
+    def record_articles(self, file_names: Iterable[str], state: ArticleState) -> None:
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.executemany(
+                'INSERT INTO article_events (file_name, state, created_at) VALUES (?, ?, ?)',
+                [(file_name, state, now) for file_name in file_names],
+            )
+            connection.commit()
+
+    def record_attributes(self, file_name: str, entries: Iterable[tuple[int, str, Any]], article_hash: Optional[str] = None) -> None:
+        """
+        Record the answers of several attributes (attribute index, attribute id, value) of an article file in one transaction.
+        The article_hash identifies the content of the file the answers belong to.
+        """
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.executemany(
+                'INSERT INTO attribute_events (file_name, attribute_index, attribute_id, value, created_at, article_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (file_name, attribute_index, attribute_id, json.dumps(value, ensure_ascii=False), now, article_hash)
+                    for attribute_index, attribute_id, value in entries
+                ],
+            )
+            connection.commit()
+
+    def article_states(self, file_names: Iterable[str]) -> dict[str, ArticleState]:
+        """
+        Returns the most advanced state of each given file (files without an entry are left out).
+        """
+        file_names = list(file_names)
+        if not self.enabled or not file_names:
+            return {}
+
+        with self._lock:
+            rows = self._get_connection().execute(
+                f'SELECT file_name, state FROM article_events WHERE file_name IN ({",".join("?" * len(file_names))})',
+                file_names,
+            ).fetchall()
+
+        states = {}
+        for file_name, state in rows:
+            if file_name not in states or ARTICLE_STATES.index(state) > ARTICLE_STATES.index(states[file_name]):
+                states[file_name] = state
+        return states
+
+    def attribute_results(self, file_name: str, article_hash: Optional[str] = None) -> dict[int, tuple[Optional[str], Any]]:
+        """
+        Returns attribute index -> (attribute id, latest recorded answer) of the file. Answers recorded for a different content of
+        the file (another article_hash, e.g. a file delivered again under the same name) are left out.
+        """
+        if not self.enabled:
+            return {}
+
+        with self._lock:
+            rows = self._get_connection().execute(
+                'SELECT attribute_index, attribute_id, value FROM attribute_events '
+                'WHERE file_name = ? AND article_hash IS ? ORDER BY id',
+                (file_name, article_hash),
+            ).fetchall()
+
+        return {attribute_index: (attribute_id, json.loads(value)) for attribute_index, attribute_id, value in rows}
+
+    def record_batch(self, batch_id: str, custom_ids: Iterable[str]) -> None:
+        """
+        Record a submitted Batch API job and the custom_ids of its requests.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'INSERT OR REPLACE INTO batch_jobs (batch_id, custom_ids, created_at, finished_at) VALUES (?, ?, ?, NULL)',
+                (batch_id, json.dumps(sorted(custom_ids)), time.time()),
+            )
+            connection.commit()
+
+    def finish_batch(self, batch_id: str) -> None:
+        """
+        Mark a Batch API job as finished (completed, failed, expired or cancelled), it is not polled again.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('UPDATE batch_jobs SET finished_at = ? WHERE batch_id = ?', (time.time(), batch_id))
+            connection.commit()
+
+    def pending_batches(self) -> list[tuple[str, set[str]]]:
+        """
+        Returns the Batch API jobs which have been submitted but not finished yet (batch id, custom_ids), newest first.
+        """
+        if not self.enabled:
+            return []
+
+        with self._lock:
+            rows = self._get_connection().execute(
+                'SELECT batch_id, custom_ids FROM batch_jobs WHERE finished_at IS NULL ORDER BY created_at DESC'
+            ).fetchall()
+
+        return [(batch_id, set(json.loads(custom_ids))) for batch_id, custom_ids in rows]
+
+    def forget(self, file_names: Iterable[str]) -> None:
+        """
+        Drop all entries of the files (e.g. a file which has been moved before is delivered again and has to be processed anew).
+        """
+        file_names = list(file_names)
+        if not self.enabled or not file_names:
+            return
+
+        with self._lock:
+            connection = self._get_connection()
+            placeholders = ','.join('?' * len(file_names))
+            connection.execute(f'DELETE FROM article_events WHERE file_name IN ({placeholders})', file_names)
+            connection.execute(f'DELETE FROM attribute_events WHERE file_name IN ({placeholders})', file_names)
+            connection.commit()
+
+    def prune(self, retention_seconds: float) -> None:
+        """
+        Drop the entries of files which have been moved to done/ longer than retention_seconds ago.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'DELETE FROM batch_jobs WHERE finished_at IS NOT NULL AND finished_at < ?', (time.time() - retention_seconds,)
+            )
+            connection.commit()
+            file_names = [
+                row[0]
+                for row in connection.execute(
+                    "SELECT DISTINCT file_name FROM article_events WHERE state = 'moved' AND created_at < ?",
+                    (time.time() - retention_seconds,),
+                ).fetchall()
+            ]
+
+        if file_names:
+            self.forget(file_names)
+            logger.info(f'Processing journal: pruned {len(file_names)} finished article file(s)')
+
+
+journal = ProcessingJournal(
+    db_path=data_path_state / 'processing_journal.sqlite',
+    enabled=journal_config.enabled,
+)
@@ -0,0 +1,50 @@
+import threading
+from collections import defaultdict
+
+# Process wide counters and gauges (e.g. fetches saved, cache hits), exposed via the API
+_lock = threading.Lock()
+_counters: dict[str, float] = defaultdict(float)
+_gauges: dict[str, float] = {}
+
+
+def increment(name: str, value: float = 1) -> None:
+    """
+    Increase a counter by the given value.
+
+    Args:
+        name (str): Name of the counter.
+        value (float, optional): Value to add. Defaults to 1.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """
+    Set a gauge to the given value (overwrites the previous value).
+
+    Args:
+        name (str): Name of the gauge.
+        value (float): Current value.
+    """
+    with _lock:
+        _gauges[name] = value
+
+
+def get_counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    """
+    Returns a copy of all counters and gauges.
+    """
+    with _lock:
+        return {'counters': dict(_counters), 'gauges': dict(_gauges)}
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
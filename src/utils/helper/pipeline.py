@@ -0,0 +1,98 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from loguru import logger
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """
+    A single stage of the pipeline. Each worker takes an item from the stage's input queue, hands it to the handler and passes the
+    returned item on to the next stage (items for which the handler returns None are dropped).
+    """
+
+    name: str
+    handler: Callable[[Any], Awaitable[Any]]
+    workers: int = 1
+
+
+@dataclass
+class PipelineResult:
+    completed: list = field(default_factory=list)
+    failed: list = field(default_factory=list)  # (item, stage name, exception)
+
+
+async def run_pipeline(
+    items: Iterable,
+    stages: list[Stage],
+    queue_size: int = 10,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> PipelineResult:
+    """
+    Streams the items through the stages. The stages are connected by bounded queues, so a slow stage applies back-pressure to
+    the stages before it instead of piling up items in memory. A failing item is logged and recorded, the other items continue.
+
+    Args:
+        items (Iterable): The items to feed into the first stage.
+        stages (list[Stage]): The stages in order.
+        queue_size (int, optional): The maximum number of items waiting in front of each stage. Defaults to 10.
+        should_stop (Callable[[], bool], optional): If it returns True, no new items are fed into the pipeline. Items which are
+            already in the pipeline are finished.
+
+    Returns:
+        PipelineResult: The items which passed all stages and the failed items.
+    """
+    result = PipelineResult()
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages] + [asyncio.Queue()]
+
+    async def feed() -> None:
+        for item in items:
+            if should_stop is not None and should_stop():
+                logger.info("Shutdown requested, no new items are fed into the pipeline")
+                break
+            await queues[0].put(item)
+        for _ in range(stages[0].workers):
+            await queues[0].put(_DONE)
+
+    async def work(stage: Stage, in_queue: asyncio.Queue, out_queue: asyncio.Queue) -> None:
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                break
+
+            try:
+                start_time = time.perf_counter()
+                item_out = await stage.handler(item)
+                logger.debug(f"Stage '{stage.name}' took {time.perf_counter() - start_time:.2f}s")
+            except Exception as e:
+                logger.error(f"Stage '{stage.name}' failed for {item}: {e}")
+                result.failed.append((item, stage.name, e))
+                continue
+
+            if item_out is not None:
+                await out_queue.put(item_out)
+
+    async def run_stage(index: int, stage: Stage) -> None:
+        in_queue, out_queue = queues[index], queues[index + 1]
+        await asyncio.gather(*[work(stage, in_queue, out_queue) for _ in range(stage.workers)])
+
+        # All workers of this stage are done -> signal the end to every worker of the next stage
+        next_workers = stages[index + 1].workers if index + 1 < len(stages) else 1
+        for _ in range(next_workers):
+            await out_queue.put(_DONE)
+
+    async def collect() -> None:
+        while True:
+            item = await queues[-1].get()
+            if item is _DONE:
+                break
+            result.completed.append(item)
+
+    await asyncio.gather(feed(), collect(), *[run_stage(i, stage) for i, stage in enumerate(stages)])
+
+    return result
@@ -0,0 +1,149 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Optional
+
+import openai
+from loguru import logger
+
+from config.config import concurrency_config
+from utils.helper import metrics
+
+# Errors which show that the provider is overloaded (the limit is cut back)
+CONGESTION_ERRORS = (openai.RateLimitError, openai.APITimeoutError)
+
+
+def _p95(latencies: list[float]) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+
+class AdaptiveConcurrencyController:
+    """
+    Limits the in-flight LLM calls and adapts the limit (AIMD): the limit is raised by one after a window of healthy calls and cut
+    by decrease_factor on 429s, timeouts or when the p95 latency of a window rises above latency_tolerance times its baseline.
+    Local providers (ollama) do not send 429s, there the p95 latency is the main signal.
+    With adaptive=False the limit stays at initial_limit.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: int = 50,
+        adaptive: bool = True,
+        latency_tolerance: float = 2.0,
+        decrease_factor: float = 0.5,
+        min_window_size: int = 10,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial_limit, max_limit))
+        self.adaptive = adaptive
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.min_window_size = min_window_size
+
+        self.in_flight = 0
+        self.baseline_p95: Optional[float] = None
+        self._window: list[float] = []
+        self._last_decrease_at = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+        self._condition_loop: Optional[asyncio.AbstractEventLoop] = None
+        metrics.set_gauge('llm_concurrency_limit', self.limit)
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._condition_loop is not loop:
+            self._condition = asyncio.Condition()
+            self._condition_loop = loop
+        return self._condition
+
+    @asynccontextmanager
+    async def slot(self, before_call: Optional[Callable[[], Awaitable[Any]]] = None):
+        """
+        Wait for a free slot below the current limit, and feed the latency or the congestion error of the call back into the limit.
+        before_call (e.g. waiting for the rate limiter) is awaited once the slot is taken, its duration is not counted as latency.
+        """
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        metrics.set_gauge('llm_in_flight', self.in_flight)
+
+        try:
+            if before_call is not None:
+                await before_call()
+
+            started_at = time.monotonic()
+            try:
+                yield
+            except CONGESTION_ERRORS as e:
+                self._on_congestion(started_at, reason=type(e).__name__)
+                raise
+            else:
+                self._on_success(time.monotonic() - started_at)
+        finally:
+            # Also wakes up the waiting calls after the limit has been raised
+            async with condition:
+                self.in_flight -= 1
+                condition.notify_all()
+            metrics.set_gauge('llm_in_flight', self.in_flight)
+
+    def _on_success(self, latency: float) -> None:
+        if not self.adaptive:
+            return
+
+        self._window.append(latency)
+        if len(self._window) < max(self.limit, self.min_window_size):
+            return
+
+        p95 = _p95(self._window)
+        metrics.set_gauge('llm_latency_p95', p95)
+
+        if self.baseline_p95 is None:
+            self.baseline_p95 = p95
+
+        if p95 > self.latency_tolerance * self.baseline_p95:
+            self._decrease(f'p95 latency {p95:.2f}s above {self.latency_tolerance} x baseline {self.baseline_p95:.2f}s')
+        else:
+            # The baseline follows slow changes (e.g. another model or time of day)
+            self.baseline_p95 = 0.8 * self.baseline_p95 + 0.2 * p95
+            self._increase(f'p95 latency {p95:.2f}s healthy')
+
+    def _on_congestion(self, started_at: float, reason: str) -> None:
+        # Calls which were already in flight at the last cut answer for the old limit, so one burst of 429s cuts the limit once
+        if not self.adaptive or started_at < self._last_decrease_at:
+            return
+        self._decrease(reason)
+
+    def _increase(self, reason: str) -> None:
+        self._window = []
+        if self.limit >= self.max_limit:
+            return
+
+        self.limit += 1
+        logger.info(f'LLM concurrency limit raised to {self.limit} ({reason})')
+        metrics.increment('llm_concurrency_increases')
+        metrics.set_gauge('llm_concurrency_limit', self.limit)
+
+    def _decrease(self, reason: str) -> None:
+        self._window = []
+        self._last_decrease_at = time.monotonic()
+        if self.limit <= self.min_limit:
+            return
+
+        self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+        logger.warning(f'LLM concurrency limit cut to {self.limit} ({reason})')
+        metrics.increment('llm_concurrency_decreases')
+        metrics.set_gauge('llm_concurrency_limit', self.limit)
+
+
+llm_concurrency = AdaptiveConcurrencyController(
+    initial_limit=concurrency_config.initial_concurrent_llm_calls,
+    min_limit=concurrency_config.min_concurrent_llm_calls,
+    max_limit=concurrency_config.max_concurrent_llm_calls,
+    adaptive=concurrency_config.adaptive_concurrency,
+    latency_tolerance=concurrency_config.llm_latency_tolerance,
+)
@@ -0,0 +1,136 @@
+import asyncio
+from typing import List, Optional
+
+from loguru import logger
+
+from utils.helper import metrics
+from utils.response.colour_engine import ColourAnalysis, colour_engine
+from utils.response.image_policy import ImagePolicy, image_variant
+from utils.response.preprocess_images import (
+    ProcessedImage,
+    deduplicate_images,
+    download_and_process_image,
+    write_failed_image,
+)
+
+
+class ArticleImages:
+    """
+    The images of a single article. They are downloaded and preprocessed once and then shared by all attribute calls of the article.
+    """
+
+    def __init__(
+        self,
+        product_id: int,
+        image_urls: List[str],
+        supplier_colour: Optional[str] = None,
+        image_roles: Optional[dict[str, str]] = None,
+    ):
+        """
+        Args:
+            product_id (int): The product ID the images belong to.
+            image_urls (List[str]): The URL(s) of the article's image(s) (Hauptbild, Freisteller Back, Modellbild).
+            supplier_colour (str, optional): The colour of the product as provided by the supplier (only used for logging failed images).
+            image_roles (dict[str, str], optional): URL -> role of the image (e.g. "Modellbild"), used by the image policies.
+        """
+        self.product_id = product_id
+        self.image_urls = image_urls
+        self.supplier_colour = supplier_colour
+        self.image_roles = image_roles or {}
+        self._processed_images: List[ProcessedImage] = []
+        self._variants: dict[tuple, ProcessedImage] = {}
+        self._is_prepared = False
+        self._colour_analysis: Optional[asyncio.Future] = None
+
+    async def prepare(self) -> List[ProcessedImage]:
+        """
+        Download and preprocess every image of the article exactly once (the images are downloaded concurrently).
+
+        Returns:
+            List[ProcessedImage]: The processed images, ready to be sent to the LLM.
+        """
+        if self._is_prepared:
+            return self._processed_images
+
+        processed_images = await asyncio.gather(
+            *[download_and_process_image(url=img) for img in self.image_urls]
+        )
+
+        for img, processed_image in zip(self.image_urls, processed_images, strict=True):
+            if not processed_image:
+                logger.error(f'Failed to process image from URL: {img}')
+                write_failed_image(self.product_id, self.supplier_colour, img)
+            else:
+                self._processed_images.append(processed_image)
+
+        # Near-identical pictures under different URLs are only sent once
+        self._processed_images = deduplicate_images(self._processed_images)
+
+        metrics.increment('image_fetches', len(self.image_urls))
+        self._is_prepared = True
+
+        return self._processed_images
+
+    def report_fetches_saved(self, number_of_calls: int) -> int:
+        """
+        Log and count the image fetches that were saved, compared to downloading all images for every attribute call.
+
+        Args:
+            number_of_calls (int): The number of attribute calls that used the shared images.
+
+        Returns:
+            int: The number of saved image fetches.
+        """
+        fetches_saved = len(self.image_urls) * max(number_of_calls - 1, 0)
+        metrics.increment('image_fetches_saved', fetches_saved)
+        logger.info(
+            f'Article {self.product_id}: fetched {len(self.image_urls)} image(s) once for {number_of_calls} attribute call(s), saved {fetches_saved} fetch(es)'
+        )
+
+        return fetches_saved
+
+    def select_images(self, policy: ImagePolicy) -> List[ProcessedImage]:
+        """
+        The images to send according to an image policy (selected roles, cropped/downscaled variants are created once per article).
+        If none of the selected images is available (missing, or dropped as duplicate), all processed images are used.
+        """
+        images = [img for img in self._processed_images if self.image_roles.get(img.url) in policy.images]
+        if not images:
+            images = list(self._processed_images)
+
+        if not policy.transforms_images:
+            return images
+
+        variants = []
+        for img in images:
+            key = (img.url, policy.max_size, policy.crop)
+            if key not in self._variants:
+                try:
+                    self._variants[key] = image_variant(img, max_size=policy.max_size, crop=policy.crop)
+                except Exception as e:
+                    logger.warning(f'Could not create the image variant of {img.url} ({e}), sending the processed image')
+                    self._variants[key] = img
+            variants.append(self._variants[key])
+
+        return variants
+
+    async def colour_analysis(self) -> ColourAnalysis:
+        """
+        The result of the local colour engine for the processed images (computed once per article, off the event loop).
+        """
+        if self._colour_analysis is None:
+            self._colour_analysis = asyncio.ensure_future(asyncio.to_thread(colour_engine.analyse, list(self._processed_images)))
+        return await self._colour_analysis
+
+    def cleanup(self) -> None:
+        """
+        Release the processed images of the article (they are only kept in memory).
+        """
+        self._processed_images = []
+        self._variants = {}
+        self._is_prepared = False
+        self._colour_analysis = None
+
+    @property
+    def processed_images(self) -> List[ProcessedImage]:
+        return self._processed_images
@@ -0,0 +1,119 @@
+import json
+from dataclasses import dataclass
+from typing import Any, Literal, Optional
+
+from loguru import logger
+
+from config.config import attribute_rules_config
+from utils.helper import metrics
+
+RuleName = Literal['supplier_field', 'category_implied']
+
+
+@dataclass(frozen=True)
+class RuleDecision:
+    """
+    The answer of an attribute decided by a deterministic rule, and why.
+    """
+
+    answer: Any
+    rule: RuleName
+    reason: str
+
+
+class AttributeRules:
+    """
+    Deterministic rules which answer trivially decidable attributes without an LLM call (checked in this order):
+
+    * 'supplier_field': the answer is mapped from a field of the supplier data, e.g. {"farbe": {"field": "FarbID",
+      "values": {"100": ["#FFFFFF"]}}}
+    * 'category_implied': the product category implies the answer, keyed by the Klassifikation Identifier or a prefix of its
+      Bezeichnung (path), e.g. {"D-Hosen / D-Jeans": {"material": "denim"}}
+
+    Mapped answers of attributes with Attributwerte have to be one of their Identifiers (colour attributes: hex codes), otherwise
+    the rule is ignored. An attribute with a single Attributwert is still asked, "None" is always a valid answer.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        category_rules: Optional[dict[str, dict[str, Any]]] = None,
+        supplier_field_rules: Optional[dict[str, dict]] = None,
+    ):
+        self.enabled = enabled
+        self.category_rules = category_rules or {}
+        self.supplier_field_rules = supplier_field_rules or {}
+
+    @staticmethod
+    def _is_allowed(attribut: dict, answer: Any) -> bool:
+        # Colour attributes are answered with hex codes, not with their Attributwerte
+        if attribut.get('Identifier') in ('farbe', 'farbHex'):
+            return True
+        options = [item.get('Identifier') for item in attribut.get('Attributwerte') or []]
+        return not options or answer in options
+
+    def _supplier_field(self, article: dict, attribut: dict) -> Optional[RuleDecision]:
+        rule = self.supplier_field_rules.get(attribut.get('Identifier'))
+        if not rule:
+            return None
+
+        value = article.get(rule.get('field'))
+        if value is None or str(value) not in rule.get('values', {}):
+            return None
+
+        answer = rule['values'][str(value)]
+        if not self._is_allowed(attribut, answer):
+            logger.warning(f"Supplier field rule of {attribut.get('Identifier')} maps {value} to {answer}, which is not an allowed option")
+            return None
+
+        return RuleDecision(answer, 'supplier_field', f"{rule.get('field')}={value} is mapped to {answer}")
+
+    def _category_implied(self, article: dict, attribut: dict) -> Optional[RuleDecision]:
+        for category in article.get('Klassifikation') or []:
+            for key, answers in self.category_rules.items():
+                if attribut.get('Identifier') not in answers:
+                    continue
+                if key != category.get('Identifier') and not (category.get('Bezeichnung') or '').startswith(key):
+                    continue
+
+                answer = answers[attribut.get('Identifier')]
+                if not self._is_allowed(attribut, answer):
+                    logger.warning(f"Category rule '{key}' implies {answer} for {attribut.get('Identifier')}, which is not an allowed option")
+                    continue
+
+                return RuleDecision(
+                    answer, 'category_implied', f"category {category.get('Identifier')} ({category.get('Bezeichnung')}) matches '{key}'"
+                )
+
+        return None
+
+    def resolve(self, article: dict, attribut: dict) -> Optional[RuleDecision]:
+        """
+        Decide the attribute with the first matching rule (None if no rule applies and the LLM has to be asked).
+        Every decision is logged with its reason and counted (attribute_rules_resolved, attribute_rules_resolved.<rule>).
+        """
+        if not self.enabled:
+            return None
+
+        decision = self._supplier_field(article, attribut) or self._category_implied(article, attribut)
+
+        metrics.increment('attribute_rules_checked')
+        if decision is not None:
+            logger.info(
+                f"Rule '{decision.rule}' answered attribute {attribut.get('Identifier')} of article {article.get('ProduktID')} "
+                f"with {decision.answer}: {decision.reason}"
+            )
+            metrics.increment('attribute_rules_resolved')
+            metrics.increment(f'attribute_rules_resolved.{decision.rule}')
+        metrics.set_gauge(
+            'attribute_rules_share', metrics.get_counter('attribute_rules_resolved') / metrics.get_counter('attribute_rules_checked')
+        )
+
+        return decision
+
+
+attribute_rules = AttributeRules(
+    enabled=attribute_rules_config.enabled,
+    category_rules=json.loads(attribute_rules_config.category_rules or '{}'),
+    supplier_field_rules=json.loads(attribute_rules_config.supplier_field_rules or '{}'),
+)
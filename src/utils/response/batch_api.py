@@ -0,0 +1,332 @@
+import asyncio
+import json
+import time
+from typing import Callable, List, Optional
+
+import openai
+from loguru import logger
+
+from config.config import batch_api_config, openai_config, response_config
+from utils.helper.journal import journal
+from utils.response.article_images import ArticleImages
+from utils.response.attribute_rules import attribute_rules
+from utils.response.colour_engine import colour_engine
+from utils.response.get_attribute import (
+    build_attribute_content,
+    get_max_completion_tokens,
+    get_response_option_ids,
+)
+from utils.response.image_policy import image_policies
+from utils.response.llm import llm_client
+from utils.response.process_article import get_possible_options
+from utils.response.prompt_builder import record_usage
+
+# Batch states after which polling stops
+_TERMINAL_STATES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchInterrupted(Exception):
+    """
+    Raised if a shutdown was requested (or the max. wait time passed) before the batch finished. The batch keeps running at
+    OpenAI and is polled again after a restart (see the processing journal).
+    """
+
+
+def _response_format(is_color: bool, possible_options: Optional[dict] = None) -> dict:
+    """
+    The structured output format of a single attribute request (same as the models of get_attribute.get_response_model).
+    """
+    option_ids = None if is_color else get_response_option_ids(possible_options)
+    if is_color:
+        response_schema = {'type': 'array', 'items': {'type': 'string'}}
+    elif option_ids is not None:
+        response_schema = {'type': 'string', 'enum': option_ids}
+    else:
+        response_schema = {'type': 'string'}
+    return {
+        'type': 'json_schema',
+        'json_schema': {
+            'name': 'ResponseColor' if is_color else 'Response',
+            'strict': True,
+            'schema': {
+                'type': 'object',
+                'properties': {'response': response_schema},
+                'required': ['response'],
+                'additionalProperties': False,
+            },
+        },
+    }
+
+
+def make_custom_id(file_name: str, attribute_index: int) -> str:
+    return f'{file_name}::{attribute_index}'
+
+
+def build_batch_requests(articles: List[tuple[str, dict, ArticleImages]]) -> List[dict]:
+    """
+    Turn the attribute requests of several articles into Batch API request lines (one chat completion per attribute).
+
+    Args:
+        articles (List[tuple[str, dict, ArticleImages]]): The file name, the article dict and the prepared images of each article.
+
+    Returns:
+        List[dict]: The request lines, the custom_id identifies the article file and the attribute index.
+    """
+    requests = []
+    for file_name, article, article_images in articles:
+        if not article_images.processed_images:
+            logger.error(f"No images for article {article.get('ProduktID')} ({file_name}), its attributes are not requested")
+            continue
+
+        product_category = article.get('Klassifikation', [{}])[0]['Bezeichnung']
+        target_group = article.get('Geschlecht')
+        colour_analysis = None
+
+        for attribute_index, attribut in enumerate(article.get('Klassifikations-Attribute', [])):
+            attribute_id = attribut.get('Identifier')
+            is_color = attribute_id == 'farbe'
+
+            # Attributes decided by the deterministic rules are not sent to the Batch API
+            decision = attribute_rules.resolve(article, attribut)
+            if decision is not None:
+                attribut['Ausgewaehlter Attributwert (Result)'] = decision.answer
+                continue
+
+            # Colour attributes answered by the local colour engine are not sent to the Batch API
+            if colour_engine.mode_for(attribute_id) != 'llm':
+                colour_analysis = colour_analysis or colour_engine.analyse(article_images.processed_images)
+                answered_locally, answer = colour_engine.resolve(attribute_id, colour_analysis, get_possible_options(attribut))
+                if answered_locally:
+                    attribut['Ausgewaehlter Attributwert (Result)'] = answer
+                    continue
+
+            possible_options = get_possible_options(attribut)
+            image_policy = image_policies.for_attribute(attribut)
+            images = article_images.select_images(image_policy)
+            image_policies.report_savings(attribute_id, article_images.processed_images, images, image_policy.detail)
+            content = build_attribute_content(
+                attribute_id=attribute_id,
+                attribute_description=attribut.get('Bezeichner'),
+                attribute_orientation=attribut.get('Orientierung'),
+                possible_options=possible_options,
+                product_category=product_category,
+                target_group=target_group,
+                images=images,
+                image_detail=image_policy.detail,
+            )
+
+            requests.append(
+                {
+                    'custom_id': make_custom_id(file_name, attribute_index),
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': {
+                        'model': llm_client.model_name,
+                        'temperature': openai_config.temperature,
+                        'max_completion_tokens': get_max_completion_tokens(attribute_id, possible_options),
+                        'messages': [
+                            {'role': 'system', 'content': response_config.system_prompt_attribute if not is_color else response_config.system_prompt_color},
+                            {'role': 'user', 'content': content},
+                        ],
+                        'response_format': _response_format(is_color, possible_options),
+                    },
+                }
+            )
+
+    return requests
+
+
+def _parse_output_lines(output_text: str) -> dict:
+    results = {}
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+
+        output = json.loads(line)
+        response = output.get('response') or {}
+        if output.get('error') or response.get('status_code') != 200:
+            logger.error(f"Batch request {output.get('custom_id')} failed: {output.get('error') or response.get('body')}")
+            continue
+
+        results[output['custom_id']] = response['body']['choices'][0]['message']['content']
+        record_usage(response['body'].get('usage'))
+
+    return results
+
+
+def chunk_requests(requests: List[dict], max_requests: int, max_bytes: int) -> List[List[dict]]:
+    """
+    Split the request lines into chunks which fit into one Batch API input file (max. number of requests and max. file size).
+    """
+    chunks, chunk, chunk_bytes = [], [], 0
+    for request in requests:
+        request_bytes = len(json.dumps(request, ensure_ascii=False).encode('utf-8')) + 1
+        if chunk and (len(chunk) >= max_requests or chunk_bytes + request_bytes > max_bytes):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        if request_bytes > max_bytes:
+            logger.warning(f"Batch request {request['custom_id']} alone exceeds the max. input file size ({request_bytes} bytes)")
+        chunk.append(request)
+        chunk_bytes += request_bytes
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def _resume_pending_batches(client, custom_ids: set[str]) -> List[tuple]:
+    """
+    Returns the unfinished batches of the processing journal (e.g. submitted before a restart) which contain any of the requests,
+    each with the custom_ids taken from it. A request contained in several batches is taken from the newest one.
+    """
+    resumed = []
+    remaining = set(custom_ids)
+    for batch_id, batch_custom_ids in await asyncio.to_thread(journal.pending_batches):
+        taken = remaining & batch_custom_ids
+        if not taken:
+            continue
+
+        try:
+            batch = await client.batches.retrieve(batch_id)
+        except openai.NotFoundError:
+            logger.warning(f'Batch {batch_id} of the processing journal does not exist anymore')
+            await asyncio.to_thread(journal.finish_batch, batch_id)
+            continue
+
+        logger.info(f'Resuming batch {batch.id} (status: {batch.status}) for {len(taken)} of its {len(batch_custom_ids)} requests')
+        resumed.append((batch, taken))
+        remaining -= taken
+
+    return resumed
+
+
+async def _submit(client, requests: List[dict]):
+    jsonl = '\n'.join(json.dumps(request, ensure_ascii=False) for request in requests).encode('utf-8')
+    input_file = await client.files.create(file=('batch_requests.jsonl', jsonl), purpose='batch')
+
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window=batch_api_config.completion_window,
+    )
+    await asyncio.to_thread(journal.record_batch, batch.id, [request['custom_id'] for request in requests])
+    logger.info(f'Submitted batch {batch.id} with {len(requests)} requests (input file: {input_file.id}, {len(jsonl)} bytes)')
+    return batch
+
+
+async def _sleep(seconds: float, should_stop: Optional[Callable[[], bool]] = None) -> None:
+    # Sleeps in short steps, so a shutdown does not wait for the whole poll interval
+    end = time.monotonic() + seconds
+    while time.monotonic() < end and not (should_stop is not None and should_stop()):
+        await asyncio.sleep(min(1.0, end - time.monotonic()))
+
+
+async def run_batch(
+    requests: List[dict],
+    client=None,
+    poll_interval: Optional[float] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    max_wait: Optional[float] = None,
+) -> dict:
+    """
+    Upload the requests as JSONL files, submit them as Batch API jobs and wait until the jobs are finished. The requests are split
+    into several jobs if they exceed the max. number of requests or the max. size of an input file.
+    Every batch id is recorded in the processing journal: requests which have been submitted before (e.g. before a restart) are
+    taken from the recorded batch instead of submitting (and paying for) them again, only the missing requests are submitted.
+
+    Args:
+        requests (List[dict]): The request lines (see build_batch_requests).
+        client (openai.AsyncOpenAI, optional): The client to use. Defaults to the shared LLM client.
+        poll_interval (float, optional): Seconds between two status checks. Defaults to the configured interval.
+        should_stop (Callable[[], bool], optional): Returns True once a shutdown was requested, polling stops then.
+        max_wait (float, optional): Max. seconds to wait for the batches. Defaults to BATCH_API_MAX_WAIT_HOURS.
+
+    Returns:
+        dict: custom_id -> message content (JSON string) of every successful request.
+
+    Raises:
+        BatchInterrupted: If a shutdown was requested or max_wait passed before the batches finished.
+        RuntimeError: If a batch did not complete (the completed ones are kept in the journal and resumed).
+    """
+    if not requests:
+        return {}
+
+    client = client or llm_client.get_client()
+    poll_interval = poll_interval if poll_interval is not None else batch_api_config.poll_interval
+    max_wait = max_wait if max_wait is not None else batch_api_config.max_wait_hours * 3600
+
+    jobs = await _resume_pending_batches(client, {request['custom_id'] for request in requests})
+    resumed_ids = set().union(*(taken for _, taken in jobs))
+    missing = [request for request in requests if request['custom_id'] not in resumed_ids]
+    chunks = chunk_requests(missing, batch_api_config.max_requests_per_file, int(batch_api_config.max_file_mb * 1024 * 1024))
+    for chunk in chunks:
+        batch = await _submit(client, chunk)
+        jobs.append((batch, {request['custom_id'] for request in chunk}))
+
+    deadline = time.monotonic() + max_wait
+    while any(batch.status not in _TERMINAL_STATES for batch, _ in jobs):
+        await _sleep(min(poll_interval, max(deadline - time.monotonic(), 0)), should_stop)
+        if should_stop is not None and should_stop():
+            raise BatchInterrupted(f'Shutdown requested, stopped polling {len(jobs)} batch(es) (they are resumed after a restart)')
+        if time.monotonic() >= deadline:
+            raise BatchInterrupted(f'Batches did not finish within {max_wait / 3600:.1f} h (they are resumed after a restart)')
+
+        for i, (batch, taken) in enumerate(jobs):
+            if batch.status not in _TERMINAL_STATES:
+                batch = await client.batches.retrieve(batch.id)
+                logger.info(f'Batch {batch.id} status: {batch.status} ({batch.request_counts})')
+                jobs[i] = (batch, taken)
+
+    failed = [batch for batch, _ in jobs if batch.status != 'completed']
+    if failed:
+        for batch in failed:
+            await asyncio.to_thread(journal.finish_batch, batch.id)
+        raise RuntimeError(
+            'Batches did not complete: ' + ', '.join(f'{batch.id} (status: {batch.status}, errors: {batch.errors})' for batch in failed)
+        )
+
+    results = {}
+    for batch, taken in jobs:
+        if batch.error_file_id:
+            error_content = await client.files.content(batch.error_file_id)
+            _parse_output_lines(error_content.text)
+
+        if batch.output_file_id:
+            output_content = await client.files.content(batch.output_file_id)
+            results.update(
+                (custom_id, content) for custom_id, content in _parse_output_lines(output_content.text).items() if custom_id in taken
+            )
+
+        # Only finished once the results are downloaded, a crash before is resumed from the same batch
+        await asyncio.to_thread(journal.finish_batch, batch.id)
+
+    return results
+
+
+def merge_batch_results(articles: List[tuple[str, dict, ArticleImages]], results: dict, requests: Optional[List[dict]] = None) -> None:
+    """
+    Write the batch results into the attribute dicts of the articles (inplace). Attributes without a result are set to None.
+    If the requests are given, only the requested attributes are written (the others have been answered locally).
+    """
+    requested_ids = {request['custom_id'] for request in requests} if requests is not None else None
+
+    for file_name, article, _ in articles:
+        for attribute_index, attribut in enumerate(article.get('Klassifikations-Attribute', [])):
+            custom_id = make_custom_id(file_name, attribute_index)
+            if requested_ids is not None and custom_id not in requested_ids:
+                continue
+
+            message_content = results.get(custom_id)
+
+            value = None
+            if message_content is not None:
+                try:
+                    value = json.loads(message_content)['response']
+                except (json.JSONDecodeError, KeyError) as e:
+                    logger.error(f'Failed to parse batch response for {file_name} / {attribut.get("Identifier")}: {e}')
+                    value = message_content
+
+            attribut['Ausgewaehlter Attributwert (Result)'] = value
+
+            if value is None or value == 'None':
+                logger.warning(f"Failed to process article: {article.get('ProduktID')} and the corresponding attribute: {attribut.get('Identifier')}")
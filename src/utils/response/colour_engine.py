@@ -0,0 +1,307 @@
+import io
+import json
+from dataclasses import dataclass, field
+from typing import List, Literal, Optional
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from config.config import colour_engine_config
+from utils.helper import metrics
+from utils.response.preprocess_images import ProcessedImage
+
+ColourMode = Literal['llm', 'local', 'local_verify']
+
+# Reference colours for mapping a hex code to the nearest allowed option (matched against the option's Identifier/Bezeichner)
+COLOUR_NAMES = {
+    'schwarz': (20, 20, 20),
+    'weiss': (245, 245, 245),
+    'weiß': (245, 245, 245),
+    'grau': (128, 128, 128),
+    'silber': (192, 192, 192),
+    'beige': (220, 200, 160),
+    'braun': (110, 70, 40),
+    'rot': (200, 30, 30),
+    'bordeaux': (110, 20, 40),
+    'rosa': (240, 160, 180),
+    'pink': (230, 60, 150),
+    'lila': (130, 60, 160),
+    'violett': (130, 60, 160),
+    'blau': (30, 60, 170),
+    'marine': (20, 30, 70),
+    'navy': (20, 30, 70),
+    'türkis': (50, 190, 190),
+    'tuerkis': (50, 190, 190),
+    'grün': (40, 140, 60),
+    'gruen': (40, 140, 60),
+    'oliv': (110, 110, 50),
+    'khaki': (160, 150, 100),
+    'gelb': (240, 210, 40),
+    'orange': (240, 130, 30),
+    'gold': (200, 160, 50),
+}
+
+
+@dataclass
+class ColourAnalysis:
+    """
+    The result of the local colour engine for the images of an article.
+    """
+
+    hex_codes: List[str] = field(default_factory=list)  # Dominant colours of the product, sorted by share (descending)
+    shares: List[float] = field(default_factory=list)
+    confidence: float = 0.0
+
+    @property
+    def dominant_hex(self) -> Optional[str]:
+        return self.hex_codes[0] if self.hex_codes else None
+
+
+def _to_hex(rgb: np.ndarray) -> str:
+    return '#{:02X}{:02X}{:02X}'.format(*np.clip(np.rint(rgb), 0, 255).astype(int))
+
+
+def _hex_to_rgb(hex_code: str) -> np.ndarray:
+    hex_code = hex_code.lstrip('#')
+    return np.array([int(hex_code[i:i + 2], 16) for i in (0, 2, 4)], dtype=np.float32)
+
+
+def _foreground_pixels(image: ProcessedImage, background_tolerance: float, max_pixels: int) -> tuple[np.ndarray, float, bool]:
+    """
+    Returns the (subsampled) RGB pixels of the product, the share of the image they cover and whether the background was masked.
+
+    Freisteller (cut-out shots) have a uniform background: its colour is estimated from the image border and every pixel
+    close to it is masked. On photos with a non-uniform border (e.g. Modellbild) the central part of the image is used instead,
+    which also contains skin and background.
+    """
+    with Image.open(io.BytesIO(image.jpeg_bytes)) as pil_image:
+        pixels = np.asarray(pil_image.convert('RGB'), dtype=np.float32)
+
+    height, width, _ = pixels.shape
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    background = np.median(border, axis=0)
+
+    masked = bool(np.linalg.norm(border - background, axis=1).mean() < background_tolerance)
+    if masked:
+        mask = np.linalg.norm(pixels - background, axis=2) > background_tolerance
+    else:
+        mask = np.zeros((height, width), dtype=bool)
+        mask[height // 6: height - height // 6, width // 4: width - width // 4] = True
+
+    foreground = pixels[mask]
+    coverage = float(mask.mean())
+
+    # Keep the work per image bounded (evenly spaced subsample, deterministic)
+    if len(foreground) > max_pixels:
+        foreground = foreground[np.linspace(0, len(foreground) - 1, max_pixels).astype(int)]
+
+    return foreground, coverage, masked
+
+
+def kmeans(pixels: np.ndarray, k: int, iterations: int = 15) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorised k-means (k-means++ initialisation with a fixed seed, so results are reproducible).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The cluster centres (k x 3) and the label of each pixel.
+    """
+    rng = np.random.default_rng(0)
+    k = min(k, len(pixels))
+
+    centres = [pixels[rng.integers(len(pixels))]]
+    for _ in range(1, k):
+        distances = np.min(((pixels[:, None, :] - np.array(centres)[None]) ** 2).sum(axis=2), axis=1)
+        if distances.sum() == 0:
+            break
+        centres.append(pixels[rng.choice(len(pixels), p=distances / distances.sum())])
+    centres = np.array(centres)
+
+    for _ in range(iterations):
+        labels = ((pixels[:, None, :] - centres[None]) ** 2).sum(axis=2).argmin(axis=1)
+        new_centres = np.array([
+            pixels[labels == i].mean(axis=0) if np.any(labels == i) else centres[i] for i in range(len(centres))
+        ])
+        if np.allclose(new_centres, centres, atol=0.5):
+            break
+        centres = new_centres
+
+    labels = ((pixels[:, None, :] - centres[None]) ** 2).sum(axis=2).argmin(axis=1)
+    return centres, labels
+
+
+class ColourEngine:
+    """
+    Determines the colours of a product locally from its processed images (no LLM call): the background of Freisteller is
+    masked, the remaining pixels are quantised with k-means and the clusters are returned as hex codes sorted by share.
+
+    The mode is selected per attribute:
+        * 'llm': the colour is determined by the LLM (as before)
+        * 'local': the local result is used
+        * 'local_verify': the local result is used, the LLM is only asked if the confidence is below min_confidence
+    """
+
+    def __init__(
+        self,
+        modes: dict[str, ColourMode],
+        min_confidence: float = 0.6,
+        max_colours: int = 5,
+        min_share: float = 0.08,
+        background_tolerance: float = 30.0,
+        merge_distance: float = 40.0,
+        max_pixels_per_image: int = 4000,
+    ):
+        self.modes = modes
+        self.min_confidence = min_confidence
+        self.max_colours = max_colours
+        self.min_share = min_share
+        self.background_tolerance = background_tolerance
+        self.merge_distance = merge_distance
+        self.max_pixels_per_image = max_pixels_per_image
+
+    def mode_for(self, attribute_id: str) -> ColourMode:
+        return self.modes.get(attribute_id, 'llm')
+
+    def analyse(self, images: List[ProcessedImage]) -> ColourAnalysis:
+        """
+        Determine the dominant colours of the product on the images.
+
+        Only Freisteller (masked background) are analysed if there are any, the centre crop of other photos contains skin and
+        background. The confidence is the share of the dominant colour among the product pixels, times the share of images whose
+        own dominant colour agrees with it, reduced if only little of the images is covered by the product (failed background
+        masking). It is 0 if no image could be masked, so such articles are always verified by the LLM.
+        """
+        per_image = []
+        for image in images:
+            try:
+                pixels, coverage, masked = _foreground_pixels(image, self.background_tolerance, self.max_pixels_per_image)
+            except Exception as e:
+                logger.warning(f'Colour engine could not read image {image.url}: {e}')
+                continue
+            if len(pixels) > 0:
+                per_image.append((pixels, coverage, masked))
+
+        if not per_image:
+            return ColourAnalysis()
+
+        masked_images = any(masked for _, _, masked in per_image)
+        if masked_images:
+            per_image = [(pixels, coverage, masked) for pixels, coverage, masked in per_image if masked]
+
+        pixels = np.concatenate([pixels for pixels, _, _ in per_image])
+        centres, labels = kmeans(pixels, k=self.max_colours + 2)
+        shares = np.bincount(labels, minlength=len(centres)) / len(labels)
+
+        # Merge clusters of (almost) the same colour, then drop small clusters (seams, shadows, labels)
+        order = np.argsort(-shares)
+        merged_centres, merged_shares = [], []
+        for i in order:
+            for j, centre in enumerate(merged_centres):
+                if np.linalg.norm(centres[i] - centre) < self.merge_distance:
+                    merged_shares[j] += shares[i]
+                    break
+            else:
+                merged_centres.append(centres[i])
+                merged_shares.append(shares[i])
+
+        colours = [
+            (share, centre) for share, centre in zip(merged_shares, merged_centres, strict=True) if share >= self.min_share
+        ][: self.max_colours]
+        colours.sort(key=lambda colour: -colour[0])
+        if not colours:
+            return ColourAnalysis()
+
+        dominant = colours[0][1]
+        agreeing_images = 0
+        for image_pixels, _, _ in per_image:
+            image_centres, image_labels = kmeans(image_pixels, k=3)
+            image_dominant = image_centres[np.bincount(image_labels, minlength=len(image_centres)).argmax()]
+            agreeing_images += np.linalg.norm(image_dominant - dominant) < 2 * self.merge_distance
+
+        coverage = np.mean([coverage for _, coverage, _ in per_image])
+        confidence = colours[0][0] * (agreeing_images / len(per_image)) * min(1.0, coverage / 0.05)
+        if not masked_images:
+            confidence = 0.0
+
+        return ColourAnalysis(
+            hex_codes=[_to_hex(centre) for _, centre in colours],
+            shares=[round(float(share), 3) for share, _ in colours],
+            confidence=round(float(confidence), 3),
+        )
+
+    @staticmethod
+    def nearest_option(hex_code: str, possible_options: Optional[dict]) -> Optional[str]:
+        """
+        Map a hex code to the nearest allowed option (Identifier: Bezeichner) whose name or identifier contains a known colour name.
+
+        Returns:
+            Optional[str]: The Identifier of the nearest option, or None if no option could be mapped to a colour.
+        """
+        if not hex_code or not possible_options:
+            return None
+
+        rgb = _hex_to_rgb(hex_code)
+        best_option, best_distance = None, None
+        for identifier, description in possible_options.items():
+            text = f'{identifier} {description}'.lower()
+            for name, reference in COLOUR_NAMES.items():
+                if name in text:
+                    distance = float(np.linalg.norm(rgb - np.array(reference, dtype=np.float32)))
+                    if best_distance is None or distance < best_distance:
+                        best_option, best_distance = identifier, distance
+
+        return best_option
+
+    def answer(self, attribute_id: str, analysis: ColourAnalysis, possible_options: Optional[dict] = None):
+        """
+        The answer for an attribute in the format the LLM would give: a list of hex codes for "farbe", the nearest allowed option
+        for attributes with colour options, else the dominant hex code.
+        """
+        if not analysis.hex_codes:
+            return None
+        if attribute_id == 'farbe':
+            return analysis.hex_codes
+        return self.nearest_option(analysis.dominant_hex, possible_options) or analysis.dominant_hex
+
+
+    def resolve(self, attribute_id: str, analysis: ColourAnalysis, possible_options: Optional[dict] = None) -> tuple[bool, object]:
+        """
+        Decide whether the local result answers the attribute.
+
+        Returns:
+            tuple[bool, object]: (True, answer) if the local answer is used, (False, None) if the LLM has to be asked.
+        """
+        mode = self.mode_for(attribute_id)
+        if mode == 'llm':
+            return False, None
+
+        answer = self.answer(attribute_id, analysis, possible_options)
+        if mode == 'local':
+            metrics.increment('colour_engine_local_answers')
+            return True, answer
+
+        if answer is not None and analysis.confidence >= self.min_confidence:
+            metrics.increment('colour_engine_local_answers')
+            return True, answer
+
+        logger.info(
+            f'Colour engine confidence {analysis.confidence} below {self.min_confidence} for {attribute_id} '
+            f'(local result: {answer}), verifying with the LLM'
+        )
+        metrics.increment('colour_engine_llm_verifications')
+        return False, None
+
+
+def _parse_modes(modes: str) -> dict[str, ColourMode]:
+    parsed = json.loads(modes) if modes else {}
+    invalid = {attribute_id: mode for attribute_id, mode in parsed.items() if mode not in ('llm', 'local', 'local_verify')}
+    if invalid:
+        logger.error(f'Invalid colour engine modes (falling back to "llm"): {invalid}')
+    return {attribute_id: mode for attribute_id, mode in parsed.items() if attribute_id not in invalid}
+
+
+colour_engine = ColourEngine(
+    modes=_parse_modes(colour_engine_config.modes),
+    min_confidence=colour_engine_config.min_confidence,
+    max_colours=colour_engine_config.max_colours,
+)
@@ -1,47 +1,292 @@
-import base64
+import asyncio
+import hashlib
 import json
-import os
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 import backoff
 import openai
 from loguru import logger
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, create_model
 
 from config.config import openai_config, response_config
+from utils.response.adaptive_concurrency import llm_concurrency
 from utils.response.llm import llm_client
 from utils.response.preprocess_images import (
+    ProcessedImage,
+    deduplicate_images,
     download_and_process_image,
     write_failed_image,
 )
+from utils.response.prompt_builder import (
+    build_product_context,
+    build_prompt_content,
+    content_text,
+    record_usage,
+)
+from utils.response.rate_limiter import rate_limiter
+from utils.response.response_cache import response_cache
+from utils.response.token_estimation import (
+    estimate_request_tokens,
+    estimate_text_tokens,
+)
+
+# Tokens of the JSON around an enum answer ('{"response":"..."}'), added to the tokens of the longest option
+ENUM_RESPONSE_OVERHEAD_TOKENS = 10
+
+
+# Defining a class which allows for the response of the LLM to be of JSON format
+class Response(BaseModel):
+    response: str
+
+
+# Defining a class which allows for the response of the LLM to be of JSON format
+class ResponseColor(BaseModel):
+    response: List[str]
+
+
+# Option-set hash -> response model restricted to these options (built once, reused by every article with the same options)
+_enum_response_models: dict[str, type[BaseModel]] = {}
+
+
+def get_response_option_ids(possible_options: Optional[dict]) -> Optional[List[str]]:
+    """
+    The answers allowed for an attribute: the Identifiers of its Attributwerte plus "None" (None if the answer is free, e.g. farbHex).
+    """
+    if not possible_options:
+        return None
+    return [str(option_id) for option_id in possible_options] + ['None']
+
+
+def _option_set_hash(option_ids: List[str]) -> str:
+    return hashlib.sha256(json.dumps(sorted(option_ids)).encode('utf-8')).hexdigest()
+
+
+def get_response_model(attribute_id: str, possible_options: Optional[dict] = None) -> type[BaseModel]:
+    """
+    The structured output model of a single attribute request. For attributes with Attributwerte the response is an enum of their
+    Identifiers (and "None"), so the model cannot answer with an invalid option. The models are cached by option-set hash.
+    """
+    if attribute_id == 'farbe':
+        return ResponseColor
+
+    option_ids = get_response_option_ids(possible_options)
+    if option_ids is None:
+        return Response
+
+    option_set_hash = _option_set_hash(option_ids)
+    response_model = _enum_response_models.get(option_set_hash)
+    if response_model is None:
+        response_model = create_model('Response', response=(Literal[tuple(option_ids)], ...))
+        _enum_response_models[option_set_hash] = response_model
+
+    return response_model
+
+
+def get_max_completion_tokens(attribute_id: str, possible_options: Optional[dict] = None) -> int:
+    """
+    The completion budget of a single attribute request. Enum answers are short, so their budget is the longest option plus the
+    JSON overhead (at most the configured MAX_COMPLETION_TOKENS).
+    """
+    option_ids = get_response_option_ids(possible_options) if attribute_id != 'farbe' else None
+    if option_ids is None:
+        return openai_config.max_completion_tokens
+
+    longest_option_tokens = max(estimate_text_tokens(option_id) for option_id in option_ids)
+    # Identifiers tokenize worse than prose, hence twice the estimate
+    return min(openai_config.max_completion_tokens, ENUM_RESPONSE_OVERHEAD_TOKENS + 2 * longest_option_tokens)
 
 
 @backoff.on_exception(backoff.expo, openai.RateLimitError)
-async def _call_llm(client, content: List, is_color: bool, temperature: float = 0.0, max_completion_tokens: int = 50,):
-    # Defining a class which allows for the response of the LLM to be of JSON format
-    class Response(BaseModel):
-        response: str
-
-    # Defining a class which allows for the response of the LLM to be of JSON format
-    class ResponseColor(BaseModel):
-        response: List[str]
-
-    response = await client.beta.chat.completions.parse(
-                temperature=temperature,
-                model=llm_client.model_name,
-                max_completion_tokens=max_completion_tokens,
-                messages=[
-                    {'role': 'system', 'content': response_config.system_prompt_attribute if not is_color else response_config.system_prompt_color},
-                    {
-                        'role': 'user',
-                        'content': content
-                    },
-                ],
-                response_format=Response if not is_color else ResponseColor,
-            )
+async def _call_llm(
+    client,
+    content: List,
+    is_color: bool,
+    temperature: float = 0.0,
+    max_completion_tokens: int = 50,
+    response_format: Optional[type[BaseModel]] = None,
+    system_prompt: Optional[str] = None,
+    estimated_tokens: int = 0,
+):
+    if response_format is None:
+        response_format = Response if not is_color else ResponseColor
+    if system_prompt is None:
+        system_prompt = response_config.system_prompt_attribute if not is_color else response_config.system_prompt_color
+
+    try:
+        # Every attempt (also the retries) takes a slot of the adaptive in-flight limit first, then waits until the request fits
+        # into the requests/tokens per minute budget (tokens are not reserved while the call still waits for a slot)
+        async with llm_concurrency.slot(before_call=lambda: rate_limiter.acquire(estimated_tokens)):
+            raw_response = await client.beta.chat.completions.with_raw_response.parse(
+                        temperature=temperature,
+                        model=llm_client.model_name,
+                        max_completion_tokens=max_completion_tokens,
+                        messages=[
+                            {'role': 'system', 'content': system_prompt},
+                            {
+                                'role': 'user',
+                                'content': content
+                            },
+                        ],
+                        response_format=response_format,
+                    )
+    except openai.RateLimitError as e:
+        rate_limiter.update_from_headers(e.response.headers)
+        raise
+
+    rate_limiter.update_from_headers(raw_response.headers)
+
+    response = raw_response.parse()
+    record_usage(response.usage)
 
     return response
 
+
+def _get_option_ids(attribut: dict) -> List[str]:
+    return [item.get('Identifier') for item in attribut.get('Attributwerte') or []]
+
+
+def _describe_attribute(attribut: dict) -> str:
+    possible_options = {item.get('Identifier'): item.get('Bezeichner') for item in attribut.get('Attributwerte')}
+    return (
+        f"- **{attribut.get('Identifier')}**: {attribut.get('Bezeichner')} | "
+        f"Orientierung: {attribut.get('Orientierung')} | Mögliche Optionen: {possible_options}"
+    )
+
+
+def _build_multi_attribute_model(attributes: List[dict]) -> type[BaseModel]:
+    """
+    Build the structured output schema for several attributes: one field per attribute Identifier, restricted to its allowed
+    Attributwerte (or "None"). The values are checked per attribute afterwards, so one invalid answer does not discard the others.
+    """
+    fields = {}
+    for i, attribut in enumerate(attributes):
+        fields[f'attribute_{i}'] = (
+            str,
+            Field(..., alias=attribut.get('Identifier'), json_schema_extra={'enum': _get_option_ids(attribut) + ['None']}),
+        )
+
+    return create_model('MultiAttributeResponse', **fields)
+
+
+async def get_multi_attribute_response(
+    attributes: List[dict],
+    product_id: int,
+    images: List[ProcessedImage],
+    product_category: str = '',
+    target_group: str = '',
+) -> dict:
+    """
+    Get the values of several (non-colour) attributes of a product with a single LLM call, so the images are only sent once.
+    The response schema is built from each attribute's Identifier and allowed Attributwerte.
+
+    Args:
+        attributes (List[dict]): The attributes ("Klassifikations-Attribute" entries) to determine.
+        product_id (int): The product ID.
+        images (List[ProcessedImage]): The processed images of the article.
+        product_category (str, optional): The product category to use for the response. Defaults to "".
+        target_group (str, optional): The target group to use for the response. Defaults to "".
+
+    Returns:
+        dict: Attribute Identifier -> value, only for the attributes whose answer passed the validation (an allowed Identifier or "None").
+    """
+    if not images or not attributes:
+        return {}
+
+    # Attribute identifiers have to be unique within one schema
+    identifiers = [attribut.get('Identifier') for attribut in attributes]
+    attributes = [attribut for attribut in attributes if identifiers.count(attribut.get('Identifier')) == 1]
+
+    attribute_descriptions = '\n'.join(_describe_attribute(attribut) for attribut in attributes)
+    question = response_config.prompt_template_multi_attribute.format(
+        attributes=attribute_descriptions,
+        product_category=product_category,
+        target_group=target_group,
+    )
+    content = build_prompt_content(build_product_context(product_category, target_group), images, question)
+    prompt = content_text(content)
+
+    cache_key = response_cache.make_key(
+        model_name=llm_client.model_name,
+        attribute_id=','.join(attribut.get('Identifier') for attribut in attributes),
+        image_hashes=[img.sha256 for img in images],
+        possible_options={attribut.get('Identifier'): _get_option_ids(attribut) for attribut in attributes},
+        prompt_template=response_config.prompt_template_multi_attribute,
+        system_prompt=response_config.system_prompt_attribute,
+        prompt=prompt,
+    )
+    message_content = await asyncio.to_thread(response_cache.get, cache_key)
+    from_cache = message_content is not None
+
+    if not from_cache:
+        logger.info(f'Getting LLM Resposne from product {product_id} for {len(attributes)} attributes with a single call')
+
+        response = await _call_llm(
+            client=llm_client.get_client(),
+            content=content,
+            is_color=False,
+            temperature=openai_config.temperature,
+            max_completion_tokens=response_config.multi_attribute_tokens_per_attribute * len(attributes),
+            response_format=_build_multi_attribute_model(attributes),
+            estimated_tokens=estimate_request_tokens(
+                texts=[response_config.system_prompt_attribute, prompt],
+                images=images,
+                max_completion_tokens=response_config.multi_attribute_tokens_per_attribute * len(attributes),
+            ),
+        )
+        message_content = response.choices[0].message.content
+
+    try:
+        json_response = json.loads(message_content)
+    except (json.JSONDecodeError, TypeError) as e:
+        logger.error(f'Failed to parse JSON response of the multi attribute call: {e}')
+        return {}
+
+    results = {}
+    for attribut in attributes:
+        identifier = attribut.get('Identifier')
+        value = json_response.get(identifier)
+        if value in _get_option_ids(attribut) or value == 'None':
+            results[identifier] = value
+        else:
+            logger.warning(f'Invalid answer for attribute {identifier} of product {product_id} in the multi attribute call: {value}')
+
+    logger.info(f'LLM Response (multi attribute): {results}')
+
+    # Only fresh, complete and valid answers are cached (a hit must not reset the age of the entry)
+    if not from_cache and len(results) == len(attributes):
+        await asyncio.to_thread(response_cache.set, cache_key, message_content, attribute_id='multi_attribute')
+
+    return results
+
+
+def build_attribute_content(
+    attribute_id: str,
+    images: List[ProcessedImage],
+    attribute_description: str = None,
+    attribute_orientation: str = None,
+    possible_options: Optional[dict] = None,
+    product_category: str = '',
+    target_group: str = '',
+    image_detail: str = 'auto',
+) -> List:
+    """
+    Build the user content (product context, images and the attribute question) of the LLM request for a single attribute.
+    The product context and the images come first, so all requests of an article share the same (cacheable) prefix.
+    """
+    question = response_config.prompt_template_attribute.format(
+                    attribute_id=attribute_id,
+                    attribute_description=attribute_description,
+                    attribute_orientation=attribute_orientation,
+                    possible_options=possible_options,
+                    product_category=product_category,
+                    target_group=target_group,
+    ) if attribute_id != 'farbe' else response_config.prompt_template_color.format(
+                    target_group=target_group,
+    )
+
+    return build_prompt_content(build_product_context(product_category, target_group), images, question, image_detail=image_detail)
+
+
 async def get_response(
     attribute_id: str,
     product_id: int,
@@ -51,7 +296,9 @@ async def get_response(
     product_category: str = '',
     target_group: str = '',
     supplier_colour: Optional[str] = None,
-    possible_options: Optional[dict] = None
+    possible_options: Optional[dict] = None,
+    images: Optional[List[ProcessedImage]] = None,
+    image_detail: str = 'auto',
 ) -> json:
     """
     Get response from the LLM API. It should pick the correct attribute of the given product.
@@ -70,6 +317,9 @@ async def get_response(
         attribute_orientation (str, optional): Where the model should look in order to identify the attribute.
         target_group (str, optional): The target group to use for the response. Defaults to "".
         image_url (List[str]): The URL(s) of the image(s) to use for the response. Defaults to "".
+        images (List[ProcessedImage], optional): Already processed images of the article (see ArticleImages). If supplied, the
+            images are not downloaded again.
+        image_detail (str, optional): The 'detail' hint of the images (see ImagePolicy). Defaults to 'auto'.
 
     Returns:
         Optional[str]: The response from the LLM API.
@@ -77,85 +327,95 @@ async def get_response(
 
     client = llm_client.get_client()
 
-    final_images = []
-    for i, img in enumerate(image_urls):
+    # Images prepared once per article are shared between the attribute calls
+    final_images = [] if images is None else list(images)
+    for img in image_urls if images is None else []:
         # Process image first
-        processed_image_path = download_and_process_image(
-            url=img, suffix=i, verify_certificate=response_config.verify_certificate
-        )
+        processed_image = await download_and_process_image(url=img)
 
-        if not processed_image_path:
+        if not processed_image:
             logger.error(f'Failed to process image from URL: {img}')
             write_failed_image(product_id, supplier_colour, img)
         else:
-            final_images.append(processed_image_path)
+            final_images.append(processed_image)
+
+    if images is None:
+        final_images = deduplicate_images(final_images)
 
     if len(final_images) > 0:
-        content = [{'type': 'text',
-                    'text': response_config.prompt_template_attribute.format(
-                                    attribute_id=attribute_id,
-                                    attribute_description=attribute_description,
-                                    attribute_orientation=attribute_orientation,
-                                    possible_options=possible_options,
-                                    product_category=product_category,
-                                    target_group=target_group,
-                    ) if attribute_id != 'farbe'
-                    else response_config.prompt_template_color.format(
-                        target_group=target_group,
-                    ),
-                    },]
+        content = build_attribute_content(
+            attribute_id=attribute_id,
+            attribute_description=attribute_description,
+            attribute_orientation=attribute_orientation,
+            possible_options=possible_options,
+            product_category=product_category,
+            target_group=target_group,
+            images=final_images,
+            image_detail=image_detail,
+        )
 
-        for img in final_images:
-            try:
-                # Read the processed image
-                with open(img, 'rb') as image_file:
-                    base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-                # Append each image to the contents
-                content.append(
-                    {
-                        'type': 'image_url',
-                        'image_url': {
-                            'url': f'data:image/jpeg;base64,{base64_image}'
-                        },
-                    },
-                )
-            except Exception as e:
-                logger.warning(f'Image could not be retireved (URL: {img}). Error: {e}')
+        is_color = attribute_id == 'farbe'
+
+        # Identical requests (same images, attribute, options, prompts and model) are answered from the cache
+        cache_key = response_cache.make_key(
+            model_name=llm_client.model_name,
+            attribute_id=attribute_id,
+            image_hashes=[img.sha256 for img in final_images],
+            possible_options=possible_options,
+            prompt_template=response_config.prompt_template_attribute if not is_color else response_config.prompt_template_color,
+            system_prompt=response_config.system_prompt_attribute if not is_color else response_config.system_prompt_color,
+            prompt=content_text(content),
+            image_detail=image_detail,
+        )
+        message_content = await asyncio.to_thread(response_cache.get, cache_key)
+        from_cache = message_content is not None
 
         try:
-            logger.info(
-                    f'Getting LLM Resposne from product {product_id} and attribute {attribute_id} with image {image_urls}'
+            if from_cache:
+                logger.info(f'Cached LLM Response for product {product_id} and attribute {attribute_id}')
+            else:
+                logger.info(
+                        f'Getting LLM Resposne from product {product_id} and attribute {attribute_id} with image {image_urls}'
+                    )
+
+                max_completion_tokens = get_max_completion_tokens(attribute_id, possible_options)
+                response = await _call_llm(
+                    client=client,
+                    content=content,
+                    is_color=is_color,
+                    temperature=openai_config.temperature,
+                    max_completion_tokens=max_completion_tokens,
+                    response_format=get_response_model(attribute_id, possible_options),
+                    estimated_tokens=estimate_request_tokens(
+                        texts=[response_config.system_prompt_attribute if not is_color else response_config.system_prompt_color, content_text(content)],
+                        images=final_images,
+                        max_completion_tokens=max_completion_tokens,
+                        image_detail=image_detail,
+                    ),
                 )
 
-            response = await _call_llm(client=client, content=content, is_color=attribute_id == 'farbe', temperature=openai_config.temperature, max_completion_tokens=openai_config.max_completion_tokens)
+                message_content = response.choices[0].message.content
 
             try:
-                json_response = json.loads(response.choices[0].message.content)
+                json_response = json.loads(message_content)
 
                 logger.info(f'LLM Response: {json_response["response"]}')
 
+                # Only fresh and valid answers are cached (a hit must not reset the age of the entry)
+                if not from_cache:
+                    await asyncio.to_thread(response_cache.set, cache_key, message_content, attribute_id=attribute_id)
+
                 return json_response['response']
             except json.JSONDecodeError as e:
                 logger.error(f'Failed to parse JSON response: {e}')
-                return response.choices[0].message.content
+                return message_content
             except KeyError as e:
                 logger.error(f'Response key not found in JSON: {e}')
-                return response.choices[0].message.content
+                return message_content
 
         except Exception as e:
             logger.error(f'API call failed: {str(e)}')
             raise Exception(f'API call failed: {str(e)}')
-
-        finally:
-            # Clean up all saved image files
-            for img_path in final_images:
-                try:
-                    if os.path.exists(img_path):
-                        os.remove(img_path)
-                        logger.info(f'Removed temporary image file: {img_path}')
-                except Exception as e:
-                    logger.warning(f'Failed to delete temporary image file {img_path}: {e}')
     else:
         logger.error('None of the image paths worked!')
         return None
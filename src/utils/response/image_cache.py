@@ -0,0 +1,226 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal, Optional
+
+from loguru import logger
+
+from config.config import image_cache_config
+from config.paths import data_path_cache
+from utils.helper import metrics
+
+
+@dataclass(frozen=True)
+class CachedImage:
+    """
+    The index entry of a cached image (the bytes are stored in files next to the index).
+    """
+
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+    processing_key: Optional[str]
+    width: Optional[int]
+    height: Optional[int]
+
+
+class ImageCache:
+    """
+    Size bounded on-disk cache of the downloaded images, keyed by URL. For every URL the raw bytes (with ETag/Last-Modified of the
+    response, for conditional revalidation) and the processed JPEG are kept. The processed JPEG is only valid for the preprocessing
+    settings it has been created with (processing_key); otherwise it is created again from the raw bytes.
+
+    Entries older than revalidate_after are revalidated with a conditional request before they are used. The least recently used
+    entries are evicted once the files take more than max_bytes.
+
+    Modes:
+        * 'on': read and write the cache
+        * 'off': bypass the cache completely
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_bytes: int = 1024 * 1024 * 1024,
+        revalidate_after: float = 24 * 3600,
+        mode: Literal['on', 'off'] = 'on',
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode == 'on'
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.cache_dir / 'index.sqlite', check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL, processing_key TEXT, '
+                'width INTEGER, height INTEGER, size_bytes INTEGER NOT NULL, last_access REAL NOT NULL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS idx_images_last_access ON images (last_access)')
+            self._connection.commit()
+        return self._connection
+
+    def _paths(self, url: str) -> tuple[Path, Path]:
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return self.cache_dir / f'{name}.raw', self.cache_dir / f'{name}.jpg'
+
+    def _record_lookup(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.increment('image_cache_hits' if hit else 'image_cache_misses')
+        metrics.set_gauge('image_cache_hit_rate', self.hit_rate)
+
+    def record_hit(self) -> None:
+        self._record_lookup(hit=True)
+
+    def record_miss(self) -> None:
+        self._record_lookup(hit=False)
+
+    def lookup(self, url: str) -> Optional[CachedImage]:
+        """
+        Returns the index entry of the URL (and marks it as recently used) or None.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute(
+                'SELECT etag, last_modified, fetched_at, processing_key, width, height FROM images WHERE url = ?', (url,)
+            ).fetchone()
+            if row is not None:
+                connection.execute('UPDATE images SET last_access = ? WHERE url = ?', (time.time(), url))
+                connection.commit()
+
+        return CachedImage(url, *row) if row is not None else None
+
+    def is_fresh(self, entry: CachedImage) -> bool:
+        """
+        Whether the entry can be used without revalidation.
+        """
+        return time.time() - entry.fetched_at < self.revalidate_after
+
+    def read_raw(self, url: str) -> Optional[bytes]:
+        try:
+            return self._paths(url)[0].read_bytes()
+        except OSError:
+            return None
+
+    def read_processed(self, entry: CachedImage, processing_key: str) -> Optional[bytes]:
+        """
+        Returns the processed JPEG, if it has been created with the given preprocessing settings.
+        """
+        if entry.processing_key != processing_key:
+            return None
+        try:
+            return self._paths(entry.url)[1].read_bytes()
+        except OSError:
+            return None
+
+    def store(
+        self,
+        url: str,
+        raw: Optional[bytes],
+        etag: Optional[str],
+        last_modified: Optional[str],
+        processing_key: str,
+        processed: bytes,
+        width: int,
+        height: int,
+    ) -> None:
+        """
+        Store (or replace) the entry of the URL. With raw=None (e.g. after a 304) the raw bytes are kept.
+        """
+        if not self.enabled:
+            return
+
+        raw_path, processed_path = self._paths(url)
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            if raw is not None:
+                self._write_file(raw_path, raw)
+            self._write_file(processed_path, processed)
+            size_bytes = (raw_path.stat().st_size if raw_path.exists() else 0) + len(processed)
+
+            connection.execute(
+                'INSERT OR REPLACE INTO images (url, etag, last_modified, fetched_at, processing_key, width, height, size_bytes, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, now, processing_key, width, height, size_bytes, now),
+            )
+            connection.commit()
+            self._evict(connection)
+
+    def mark_revalidated(self, url: str) -> None:
+        """
+        The server confirmed the cached image (304 Not Modified), it is fresh again.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('UPDATE images SET fetched_at = ? WHERE url = ?', (time.time(), url))
+            connection.commit()
+        metrics.increment('image_cache_revalidations')
+
+    @staticmethod
+    def _write_file(path: Path, content: bytes) -> None:
+        # Written next to the target and renamed, so a crash never leaves a truncated image behind
+        temp_path = path.with_suffix(path.suffix + '.part')
+        temp_path.write_bytes(content)
+        temp_path.replace(path)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        total_bytes = connection.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM images').fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        evicted = 0
+        for url, size_bytes in connection.execute('SELECT url, size_bytes FROM images ORDER BY last_access ASC').fetchall():
+            if total_bytes <= self.max_bytes:
+                break
+            for path in self._paths(url):
+                path.unlink(missing_ok=True)
+            connection.execute('DELETE FROM images WHERE url = ?', (url,))
+            total_bytes -= size_bytes
+            evicted += 1
+        connection.commit()
+
+        metrics.increment('image_cache_evictions', evicted)
+        logger.info(f'Image cache: evicted {evicted} least recently used image(s)')
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {'mode': self.mode, 'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hit_rate, 3)}
+
+
+image_cache = ImageCache(
+    cache_dir=data_path_cache / 'images',
+    max_bytes=int(image_cache_config.max_mb * 1024 * 1024),
+    revalidate_after=image_cache_config.revalidate_after_hours * 3600,
+    mode=image_cache_config.mode,
+)
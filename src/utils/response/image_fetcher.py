@@ -0,0 +1,181 @@
+import asyncio
+import importlib.util
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlsplit
+
+import backoff
+import httpx
+from loguru import logger
+
+from config.config import image_fetch_config, response_config
+
+
+def _is_permanent_error(e: Exception) -> bool:
+    """
+    Client errors (e.g. 404) are not retried, except for 408 and 429.
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        status_code = e.response.status_code
+        return 400 <= status_code < 500 and status_code not in (408, 429)
+    return False
+
+
+@dataclass(frozen=True)
+class FetchedImage:
+    """
+    The result of a (conditional) download. content is None if the server answered 304 Not Modified.
+    """
+
+    content: Optional[bytes]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.content is None
+
+
+class AsyncImageFetcher:
+    """
+    Downloads images with a shared (keep-alive) connection pool. Connections per host are limited, failed downloads are retried
+    with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_connections_per_host: int = 6,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 5.0,
+        max_retries: int = 3,
+        http2: bool = False,
+        verify_certificate: bool = True,
+    ):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.verify_certificate = verify_certificate
+
+        # HTTP/2 needs the optional 'h2' package
+        self.http2 = http2 and importlib.util.find_spec('h2') is not None
+        if http2 and not self.http2:
+            logger.warning("HTTP/2 requested for the image fetcher, but the 'h2' package is not installed. Using HTTP/1.1.")
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # The pool is bound to the event loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                verify=self.verify_certificate,
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+            )
+            self._client_loop = loop
+            self._host_semaphores = {}
+
+        return self._client
+
+    def _get_host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.max_connections_per_host)
+
+        return self._host_semaphores[host]
+
+    async def fetch(self, url: str) -> bytes:
+        """
+        Download the content of the given URL.
+
+        Args:
+            url (str): The URL to download.
+
+        Returns:
+            bytes: The content of the response.
+
+        Raises:
+            httpx.HTTPError: If the download failed after all retries.
+        """
+        return (await self.fetch_conditional(url)).content
+
+    async def fetch_conditional(self, url: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> FetchedImage:
+        """
+        Download the content of the given URL, unless it has not changed since the given ETag/Last-Modified.
+
+        Args:
+            url (str): The URL to download.
+            etag (str, optional): The ETag of the cached copy (sent as If-None-Match).
+            last_modified (str, optional): The Last-Modified of the cached copy (sent as If-Modified-Since).
+
+        Returns:
+            FetchedImage: The content and validators of the response (content None on 304 Not Modified).
+
+        Raises:
+            httpx.HTTPError: If the download failed after all retries.
+            httpx.InvalidURL, ValueError: If the URL is malformed.
+        """
+        client = self._get_client()
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        @backoff.on_exception(
+            backoff.expo,
+            httpx.HTTPError,
+            max_tries=self.max_retries,
+            jitter=backoff.full_jitter,
+            giveup=_is_permanent_error,
+            on_backoff=lambda details: logger.warning(
+                f"Attempt {details['tries']}/{self.max_retries} failed for {url}: {details['exception']}"
+            ),
+        )
+        async def _fetch() -> FetchedImage:
+            async with self._get_host_semaphore(url):
+                response = await client.get(url, headers=headers)
+                if response.status_code == 304 and headers:
+                    return FetchedImage(content=None, etag=etag, last_modified=last_modified)
+                response.raise_for_status()
+                return FetchedImage(
+                    content=response.content,
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'),
+                )
+
+        return await _fetch()
+
+    async def aclose(self) -> None:
+        """
+        Close the connection pool (a new one is created on the next fetch).
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            logger.info("Image fetcher connection pool closed.")
+        self._client = None
+        self._client_loop = None
+        self._host_semaphores = {}
+
+
+image_fetcher = AsyncImageFetcher(
+    max_connections=image_fetch_config.max_connections,
+    max_connections_per_host=image_fetch_config.max_connections_per_host,
+    keepalive_expiry=image_fetch_config.keepalive_expiry,
+    timeout=image_fetch_config.timeout,
+    max_retries=image_fetch_config.max_retries,
+    http2=image_fetch_config.http2,
+    verify_certificate=response_config.verify_certificate,
+)
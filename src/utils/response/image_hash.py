@@ -0,0 +1,60 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> int:
+    """
+    Difference hash of an image: the image is reduced to (hash_size + 1) x hash_size grey values and every bit tells whether a
+    pixel is brighter than its left neighbour. Re-encoded, slightly rescaled or recompressed copies of a picture get the same or a
+    very close hash.
+
+    Args:
+        image_bytes (bytes): The encoded image (e.g. the processed JPEG).
+        hash_size (int, optional): Bits per row and number of rows. Defaults to 8 (64 bit hash).
+
+    Returns:
+        int: The hash.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEGs are decoded at a fraction of their size, only a few pixels are needed
+    image.draft('L', ((hash_size + 1) * 4, hash_size * 4))
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX), dtype=np.int16)
+
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return (first ^ second).bit_count()
+
+
+def pixel_difference(first: bytes, second: bytes, size: int = 64, block_size: int = 8) -> float:
+    """
+    How much two images differ pixel by pixel: both are reduced to size x size RGB pixels and the mean absolute difference (0-255)
+    is computed per block of block_size x block_size pixels; the largest block difference is returned. Recompression noise averages
+    out within the blocks, while a local change (e.g. another neckline) or another colour gives a large difference.
+    Images with a different aspect ratio are not compared (infinite difference).
+
+    Args:
+        first (bytes): The first encoded image.
+        second (bytes): The second encoded image.
+        size (int, optional): Width and height the images are compared at. Defaults to 64.
+        block_size (int, optional): Width and height of the blocks. Defaults to 8.
+
+    Returns:
+        float: The largest mean absolute difference of a block.
+    """
+    images = [Image.open(io.BytesIO(image_bytes)) for image_bytes in (first, second)]
+    if abs(images[0].width / images[0].height - images[1].width / images[1].height) > 0.02:
+        return float('inf')
+
+    pixels = []
+    for image in images:
+        image.draft('RGB', (size * 2, size * 2))
+        pixels.append(np.asarray(image.convert('RGB').resize((size, size), Image.Resampling.BOX), dtype=np.float32))
+
+    difference = np.abs(pixels[0] - pixels[1]).mean(axis=2)
+    blocks = difference.reshape(size // block_size, block_size, size // block_size, block_size).mean(axis=(1, 3))
+    return float(blocks.max())
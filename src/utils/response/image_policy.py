@@ -0,0 +1,129 @@
+import io
+import json
+from dataclasses import dataclass
+from typing import List, Literal, Optional
+
+from loguru import logger
+from PIL import Image
+
+from config.config import image_policy_config, image_preprocess_config
+from utils.helper import metrics
+from utils.response.preprocess_images import RESAMPLING_FILTERS, ProcessedImage
+from utils.response.token_estimation import estimate_image_tokens
+
+# The images of an article (keys of the article dict)
+IMAGE_ROLES = ('Hauptbild', 'Freisteller Back', 'Modellbild')
+
+ImageDetail = Literal['low', 'high', 'auto']
+
+
+@dataclass(frozen=True)
+class ImagePolicy:
+    """
+    Which images of an article are sent for an attribute, and how.
+
+    Attributes:
+        images (tuple[str, ...]): The image roles to send (Hauptbild, Freisteller Back, Modellbild), in this order.
+        max_size (int, optional): Max. width/height of the sent images (None = as processed).
+        detail (str): The 'detail' hint of the image_url parts ('low', 'high' or 'auto'). 'low' only lowers the cost on tile based
+            models (base tokens only, e.g. 85 for gpt-4o/gpt-4.1); patch based models like gpt-4.1-mini ignore it, there only
+            max_size and crop reduce the image tokens.
+        crop (tuple[float, float, float, float], optional): Region of the image to send (left, top, right, bottom as fractions).
+    """
+
+    images: tuple[str, ...] = IMAGE_ROLES
+    max_size: Optional[int] = None
+    detail: ImageDetail = 'auto'
+    crop: Optional[tuple[float, float, float, float]] = None
+
+    @property
+    def transforms_images(self) -> bool:
+        return self.max_size is not None or self.crop is not None
+
+
+def image_variant(image: ProcessedImage, max_size: Optional[int] = None, crop: Optional[tuple] = None) -> ProcessedImage:
+    """
+    Crop and/or downscale a processed image (the result is JPEG encoded again).
+    """
+    variant = Image.open(io.BytesIO(image.jpeg_bytes))
+
+    if crop is not None:
+        left, top, right, bottom = crop
+        variant = variant.crop(
+            (round(left * variant.width), round(top * variant.height), round(right * variant.width), round(bottom * variant.height))
+        )
+    if max_size is not None and (variant.width > max_size or variant.height > max_size):
+        variant.thumbnail((max_size, max_size), resample=RESAMPLING_FILTERS[image_preprocess_config.resampling])
+
+    buffer = io.BytesIO()
+    variant.convert('RGB').save(buffer, 'JPEG', quality=image_preprocess_config.jpeg_quality)
+
+    return ProcessedImage(url=image.url, jpeg_bytes=buffer.getvalue(), width=variant.width, height=variant.height)
+
+
+class ImagePolicies:
+    """
+    Looks up the image policy of an attribute: by its Identifier, then by a keyword of its "Orientierung" (keys of the form
+    'orientierung:<keyword>', case-insensitive), then the 'default' policy. Counts the image tokens saved per attribute, compared
+    to sending all processed images with detail 'auto', with the image token formula of the model (see estimate_image_tokens).
+    """
+
+    def __init__(self, policies: dict[str, ImagePolicy], model_name: Optional[str] = None):
+        self.policies = policies
+        self.model_name = model_name
+        self.default = policies.get('default', ImagePolicy())
+        self.tokens_saved: dict[str, int] = {}
+
+    def for_attribute(self, attribut: dict) -> ImagePolicy:
+        identifier = attribut.get('Identifier')
+        if identifier in self.policies:
+            return self.policies[identifier]
+
+        orientation = (attribut.get('Orientierung') or '').lower()
+        for key, policy in self.policies.items():
+            if key.startswith('orientierung:') and key.split(':', 1)[1].strip().lower() in orientation:
+                return policy
+
+        return self.default
+
+    def report_savings(self, attribute_id: str, all_images: List[ProcessedImage], sent_images: List[ProcessedImage], detail: ImageDetail) -> int:
+        """
+        Count the estimated image tokens saved by the policy of an attribute.
+
+        Returns:
+            int: The saved tokens (negative if the policy sends more, e.g. a high detail crop).
+        """
+        baseline = sum(estimate_image_tokens(img.width, img.height, model_name=self.model_name) for img in all_images)
+        sent = sum(estimate_image_tokens(img.width, img.height, detail=detail, model_name=self.model_name) for img in sent_images)
+        saved = baseline - sent
+
+        self.tokens_saved[attribute_id] = self.tokens_saved.get(attribute_id, 0) + saved
+        metrics.increment('image_tokens_saved', saved)
+        metrics.increment(f'image_tokens_saved.{attribute_id}', saved)
+
+        return saved
+
+
+def _parse_policies(policies: str) -> dict[str, ImagePolicy]:
+    parsed = {}
+    for key, policy in (json.loads(policies) if policies else {}).items():
+        try:
+            images = tuple(policy.get('images', IMAGE_ROLES))
+            crop = tuple(float(value) for value in policy['crop']) if policy.get('crop') is not None else None
+            if not set(images) <= set(IMAGE_ROLES) or policy.get('detail', 'auto') not in ('low', 'high', 'auto'):
+                raise ValueError(f'unknown image role or detail in {policy}')
+            if crop is not None and not (len(crop) == 4 and 0 <= crop[0] < crop[2] <= 1 and 0 <= crop[1] < crop[3] <= 1):
+                raise ValueError(f'crop has to be (left, top, right, bottom) fractions, got {crop}')
+            parsed[key] = ImagePolicy(
+                images=images,
+                max_size=policy.get('max_size'),
+                detail=policy.get('detail', 'auto'),
+                crop=crop,
+            )
+        except (AttributeError, TypeError, ValueError, KeyError) as e:
+            logger.error(f'Invalid image policy for "{key}" (ignored): {e}')
+
+    return parsed
+
+
+image_policies = ImagePolicies(_parse_policies(image_policy_config.policies))
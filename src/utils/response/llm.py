@@ -1,9 +1,12 @@
+import asyncio
 from typing import Literal, Optional
 
+import httpx
 import openai
-from pydantic import BaseModel, Field
+from loguru import logger
+from pydantic import BaseModel, Field, PrivateAttr
 
-from config.config import openai_config
+from config.config import llm_client_config, openai_config
 
 
 class LLM(BaseModel):
@@ -15,18 +18,88 @@ class LLM(BaseModel):
     api_key: str = Field(..., description='API key for OpenAI')
     api_base: str | None = Field(default=None, description='Überschreibt die Basis-URL (z.B. http://localhost:11434/v1)')
     provider: Literal['openai', 'ollama'] = Field(default='openai', description='Welcher Backend-Provider genutzt wird')
+    max_connections: int = Field(default=20, description='Maximale Anzahl an Verbindungen im HTTP-Pool')
+    max_keepalive_connections: int = Field(default=20, description='Maximale Anzahl an offen gehaltenen (keep-alive) Verbindungen')
+    keepalive_expiry: float = Field(default=30.0, description='Sekunden, die eine ungenutzte Verbindung offen gehalten wird')
+    timeout: float = Field(default=60.0, description='Timeout pro Request in Sekunden')
+    connect_timeout: float = Field(default=10.0, description='Timeout für den Verbindungsaufbau in Sekunden')
+
+    # Long-lived client (and its connection pool), created lazily for the running event loop
+    _client: Optional[openai.AsyncOpenAI] = PrivateAttr(default=None)
+    _client_loop: Optional[asyncio.AbstractEventLoop] = PrivateAttr(default=None)
+
+    def _base_url(self) -> str | None:
+        base = self.api_base or None
+        if self.provider == 'ollama' and base is None:
+            base = 'http://localhost:11434/v1'
+        return base
 
     def get_client(self):
         """
-        Liefert einen OpenAI-kompatiblen Asnyc-Client
+        Liefert einen OpenAI-kompatiblen Asnyc-Client (wird einmal erstellt und für alle Requests wiederverwendet)
         * Für OpenAI -> api_base = None (SDK setzt https://api.openai.com/v1)
         * Für Ollama -> api_base = http://localhost:11434/v1
         """
-        base = self.api_base
-        if self.provider == 'ollama' and base is None:
-            base = 'http://localhost:11434/v1'
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        # The connection pool is bound to the event loop it was created in
+        if self._client is None or (loop is not None and self._client_loop is not loop):
+            self._close_previous_client()
+
+            base = self._base_url()
+            logger.info(f'Creating LLM client (provider: {self.provider}, base url: {base or "default"})')
 
-        return openai.AsyncOpenAI(api_key=self.api_key)
+            self._client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=base,
+                http_client=httpx.AsyncClient(
+                    timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_keepalive_connections,
+                        keepalive_expiry=self.keepalive_expiry,
+                    ),
+                ),
+            )
+            self._client_loop = loop
+
+            if loop is not None:
+                loop.create_task(anext(self._close_with_loop(self._client)))
+
+        return self._client
+
+    def _close_previous_client(self) -> None:
+        # A client of an event loop which still runs (e.g. in another thread) is closed on its own loop. Clients of finished
+        # loops are closed by _close_with_loop
+        client, client_loop = self._client, self._client_loop
+        if client is not None and client_loop is not None and client_loop.is_running() and not client.is_closed():
+            asyncio.run_coroutine_threadsafe(client.close(), client_loop)
+
+    async def _close_with_loop(self, client: openai.AsyncOpenAI):
+        # Stays suspended until the event loop shuts down: asyncio.run finalizes the open async generators (shutdown_asyncgens)
+        # before it closes the loop, so the connection pool is closed on the loop it belongs to
+        try:
+            yield
+        finally:
+            if self._client is client:
+                self._client = None
+                self._client_loop = None
+            if not client.is_closed():
+                await client.close()
+                logger.info('LLM client of a finished event loop closed.')
+
+    async def aclose(self) -> None:
+        """
+        Schließt den Client und seinen Connection-Pool (beim nächsten Aufruf von get_client wird ein neuer erstellt).
+        """
+        if self._client is not None:
+            await self._client.close()
+            logger.info('LLM client closed.')
+        self._client = None
+        self._client_loop = None
 
     # Backwards-Kompatibilität
     @property
@@ -34,4 +107,14 @@ class LLM(BaseModel):
         return self.get_client()
 
 
-llm_client = LLM(api_key=openai_config.api_key, model_name=openai_config.model_name, api_base=openai_config.api_base, provider=openai_config.provider)
+llm_client = LLM(
+    api_key=openai_config.api_key,
+    model_name=openai_config.model_name,
+    api_base=openai_config.api_base,
+    provider=openai_config.provider,
+    max_connections=llm_client_config.max_connections,
+    max_keepalive_connections=llm_client_config.max_keepalive_connections,
+    keepalive_expiry=llm_client_config.keepalive_expiry,
+    timeout=llm_client_config.timeout,
+    connect_timeout=llm_client_config.connect_timeout,
+)
@@ -1,12 +1,37 @@
+import asyncio
+import base64
+import hashlib
 import io
-import time
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
-from typing import Optional
+from typing import List, Literal, Optional
 
-import requests
+import httpx
 from loguru import logger
 from PIL import Image
 
+from config.config import image_dedup_config, image_preprocess_config
+from utils.helper import metrics
+from utils.response.image_cache import CachedImage, image_cache
+from utils.response.image_fetcher import image_fetcher
+from utils.response.image_hash import dhash, hamming_distance, pixel_difference
+
+RESAMPLING_FILTERS = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'hamming': Image.Resampling.HAMMING,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+
 
 def write_failed_image(product_id: int, supplier_colour: str, url: str) -> None:
     """
@@ -39,60 +64,331 @@ def write_failed_image(product_id: int, supplier_colour: str, url: str) -> None:
         f.write(entry)
 
 
-def download_and_process_image(
-    url: str, suffix: int, max_retries: int = 1, verify_certificate: bool = True
-) -> Optional[str]:
+@dataclass(frozen=True)
+class ProcessedImage:
+    """
+    A downloaded and processed (RGB, max. IMAGE_MAX_SIZE x IMAGE_MAX_SIZE) image, JPEG encoded and kept in memory.
     """
-    Download and process an image from a URL, with retry logic and validation.
-    Returns the processed image URL or None if failed.
 
-    Args:
-        url (str): The URL of the image to download and process.
-        suffix (int): The suffix of the image URL.
-        max_retries (int, optional): The maximum number of retries. Defaults to 1.
-        verify_certificate (bool, optional): Whether to verify SSL certificates. Defaults to True.
+    url: str
+    jpeg_bytes: bytes
+    width: int
+    height: int
+
+    @cached_property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.jpeg_bytes).hexdigest()
+
+    @cached_property
+    def data_url(self) -> str:
+        """
+        The image as base64 data URL, as expected in the 'image_url' content of the LLM request.
+        """
+        return f'data:image/jpeg;base64,{base64.b64encode(self.jpeg_bytes).decode("utf-8")}'
+
+    @cached_property
+    def perceptual_hash(self) -> Optional[int]:
+        """
+        The dHash of the image (None if it cannot be decoded).
+        """
+        try:
+            return dhash(self.jpeg_bytes)
+        except Exception as e:
+            logger.warning(f'Could not compute the perceptual hash of {self.url}: {e}')
+            return None
+
+
+def deduplicate_images(images: List[ProcessedImage]) -> List[ProcessedImage]:
+    """
+    Drop duplicate images (e.g. Hauptbild and Freisteller Back being the same picture under different URLs), so every picture is
+    sent (and paid for) only once per request. The first image of each group is kept.
+
+    The dHash (at most IMAGE_DEDUP_MAX_DISTANCE bits apart) only preselects the candidates, as it is too coarse on its own: other
+    necklines, sleeves or colours of the same cut get the same or a very close hash. A candidate is only dropped if it also matches
+    pixel by pixel (see pixel_difference, at most IMAGE_DEDUP_MAX_PIXEL_DIFFERENCE).
+    """
+    if not image_dedup_config.enabled:
+        return list(images)
+
+    kept = []
+    for image in images:
+        duplicate_of = next((kept_image for kept_image in kept if _is_duplicate(image, kept_image)), None)
+        if duplicate_of is not None:
+            logger.info(f'Image {image.url} is a duplicate of {duplicate_of.url} and is not sent')
+            metrics.increment('image_duplicates_dropped')
+            continue
+        kept.append(image)
+
+    return kept
+
+
+def _is_duplicate(image: ProcessedImage, kept_image: ProcessedImage) -> bool:
+    if image.sha256 == kept_image.sha256:
+        return True
+    if image.perceptual_hash is None or kept_image.perceptual_hash is None:
+        return False
+    if hamming_distance(image.perceptual_hash, kept_image.perceptual_hash) > image_dedup_config.max_distance:
+        return False
+
+    try:
+        return pixel_difference(image.jpeg_bytes, kept_image.jpeg_bytes) <= image_dedup_config.max_pixel_difference
+    except Exception as e:
+        logger.warning(f'Could not compare {image.url} with {kept_image.url}: {e}')
+        return False
+
+
+# One reusable encode buffer per thread
+_encode_buffers = threading.local()
+
+
+def _encode_jpeg(image: Image.Image, quality: int = 85) -> bytes:
+    buffer = getattr(_encode_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _encode_buffers.buffer = io.BytesIO()
+
+    buffer.seek(0)
+    buffer.truncate()
+    image.save(buffer, 'JPEG', quality=quality)
+
+    return buffer.getvalue()
+
+
+def _target_size(size: tuple[int, int], max_size: tuple[int, int]) -> tuple[int, int]:
+    """
+    The size of the image after the resize (aspect ratio preserved, at most max_size).
+    """
+    scale = min(max_size[0] / size[0], max_size[1] / size[1], 1.0)
+    return max(round(size[0] * scale), 1), max(round(size[1] * scale), 1)
+
+
+def _process_image_bytes(content: bytes) -> tuple[bytes, int, int]:
+    """
+    Convert, resize and JPEG encode the downloaded image (in memory).
+
+    With IMAGE_FAST_DECODE, JPEGs are decoded at a reduced size (DCT scaling by 1/2, 1/4 or 1/8, see Image.draft) instead of
+    decoding all pixels of the (often multi-megapixel) original, and are only converted after the resize.
 
     Returns:
-        Optional[str]: The URL of the processed image or None if failed.
+        tuple[bytes, int, int]: The JPEG bytes, width and height of the processed image (plain values, cheap to send between processes).
     """
+    # Load image and validate (the pixels are only decoded on the first access)
+    image = Image.open(io.BytesIO(content))
 
-    logger.info(f'Downloading and processing image from URL: {url}')
+    max_size = (image_preprocess_config.max_size, image_preprocess_config.max_size)
+    resample = RESAMPLING_FILTERS[image_preprocess_config.resampling]
 
-    for attempt in range(max_retries):
-        try:
-            # Download image with timeout
-            response = requests.get(url, timeout=5, verify=verify_certificate)
-            response.raise_for_status()
+    if image_preprocess_config.fast_decode and image.format == 'JPEG':
+        # Decode at (at least IMAGE_DRAFT_REDUCING_GAP times) the target size, the decoder converts YCbCr to RGB on the way
+        target_width, target_height = _target_size(image.size, max_size)
+        gap = image_preprocess_config.draft_reducing_gap
+        image.draft('RGB', (int(target_width * gap), int(target_height * gap)))
 
-            # Load image and validate
-            image = Image.open(io.BytesIO(response.content))
+        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
+            image.thumbnail(max_size, resample=resample, reducing_gap=None)
 
-            # Convert to RGB if necessary (handles RGBA/other formats)
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+        # Only other modes (e.g. CMYK, grayscale) still need a conversion, at the reduced size
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+    else:
+        # Convert to RGB if necessary (handles RGBA/other formats)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
 
-            # Resize if too large (adjust size as needed)
-            max_size = (500, 500)
-            if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-                image.thumbnail(max_size)
+        # Resize if too large
+        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
+            image.thumbnail(max_size, resample=resample)
 
-            # Save to temp file
-            temp_path = f'processed_{int(time.time())}_{attempt}_{suffix}.jpg'
+    return _encode_jpeg(image, quality=image_preprocess_config.jpeg_quality), image.size[0], image.size[1]
 
-            temp_images_dir = Path('data/temp_images')
-            temp_images_dir.mkdir(parents=True, exist_ok=True)
 
-            temp_path = temp_images_dir / temp_path
+def _process_image(content: bytes, url: str) -> ProcessedImage:
+    jpeg_bytes, width, height = _process_image_bytes(content)
+    return ProcessedImage(url=url, jpeg_bytes=jpeg_bytes, width=width, height=height)
 
-            image.save(temp_path, 'JPEG', quality=85)
 
-            return str(temp_path)
+class ImageProcessor:
+    """
+    Runs the CPU bound preprocessing (decode -> RGB -> thumbnail -> encode) off the event loop, so the images of several articles
+    are processed on all cores while the loop keeps serving downloads and LLM calls.
 
-        except requests.RequestException as e:
-            logger.warning(f'Attempt {attempt + 1}/{max_retries} failed: {str(e)}')
-            time.sleep(1)  # Wait before retry
-        except Exception as e:
-            logger.error(f'Image processing error: {str(e)}')
+    - 'thread': thread pool, Pillow releases the GIL while decoding, resizing and encoding (no copies of the image bytes).
+    - 'process': process pool, for the parts which hold the GIL (the bytes are sent to the worker and the JPEG is sent back).
+    - 'inline': on the event loop (previous behaviour).
+    """
+
+    def __init__(self, executor: Literal['inline', 'thread', 'process'] = 'thread', workers: int = 0):
+        """
+        Args:
+            executor (str, optional): Where the images are processed. Defaults to 'thread'.
+            workers (int, optional): Number of workers, 0 = one per CPU core. Defaults to 0.
+        """
+        self.executor = executor
+        self.workers = workers or os.cpu_count() or 1
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.executor == 'process':
+                    # 'spawn' instead of fork: the parent runs threads (connection pools, logging)
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-processor')
+                logger.info(f'Processing images with {self.workers} {self.executor} worker(s)')
+            return self._executor
+
+    async def process(self, content: bytes, url: str) -> ProcessedImage:
+        """
+        Process a downloaded image (see _process_image_bytes) with the configured executor.
+        """
+        if self.executor == 'inline':
+            return _process_image(content, url=url)
+
+        jpeg_bytes, width, height = await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), _process_image_bytes, content
+        )
+        return ProcessedImage(url=url, jpeg_bytes=jpeg_bytes, width=width, height=height)
+
+    def shutdown(self) -> None:
+        """
+        Stop the workers (a new pool is started on the next use).
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+image_processor = ImageProcessor(
+    executor=image_preprocess_config.executor,
+    workers=image_preprocess_config.workers,
+)
+
+
+def _processing_key() -> str:
+    """
+    Identifies the preprocessing settings (a cached processed image is only reused if they did not change).
+    """
+    settings = image_preprocess_config.model_dump(include={'max_size', 'jpeg_quality', 'fast_decode', 'draft_reducing_gap', 'resampling'})
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _read_cached_image(url: str, processing_key: str) -> tuple[Optional[CachedImage], Optional[bytes], Optional[bytes]]:
+    """
+    The cached copy of an image: the processed JPEG (if created with the current settings) or else the raw bytes.
+
+    Returns:
+        tuple: The index entry, the processed JPEG and the raw bytes (all None if the image is not cached).
+    """
+    entry = image_cache.lookup(url)
+    if entry is None:
+        return None, None, None
+
+    processed = image_cache.read_processed(entry, processing_key)
+    raw = image_cache.read_raw(url) if processed is None else None
+    if processed is None and raw is None:
+        return None, None, None
+
+    return entry, processed, raw
+
+
+async def _use_image_cache(url: str, func, *args, **kwargs):
+    """
+    Run an image cache operation off the event loop. Failures of the cache (e.g. a locked or corrupt index, a full disk) are logged
+    and None is returned, the image is then downloaded and processed without the cache.
+    """
+    try:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f'Image cache error for {url} ({func.__name__}), continuing without the cache: {e}')
+        metrics.increment('image_cache_errors')
+        return None
+
+
+# (event loop, URL) -> running download, concurrent requests of the same image (e.g. colour variants in one batch) share it
+_in_flight: dict[tuple[int, str], asyncio.Future] = {}
+
+
+async def download_and_process_image(url: str) -> Optional[ProcessedImage]:
+    """
+    Download (with the pooled async image fetcher, incl. retries) and process an image from a URL.
+    Images in the local image cache are not downloaded again (only revalidated once they are older than
+    IMAGE_CACHE_REVALIDATE_AFTER_HOURS) and not processed again.
+    Returns the processed image or None if failed.
+
+    Args:
+        url (str): The URL of the image to download and process.
+
+    Returns:
+        Optional[ProcessedImage]: The processed image (in memory) or None if failed.
+    """
+    key = (id(asyncio.get_running_loop()), url)
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_download_and_process_image(url))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    else:
+        metrics.increment('image_downloads_coalesced')
+
+    # A cancelled caller must not cancel the download for the others
+    return await asyncio.shield(task)
+
+
+async def _download_and_process_image(url: str) -> Optional[ProcessedImage]:
+    processing_key = _processing_key()
+
+    entry, processed, raw = await _use_image_cache(url, _read_cached_image, url, processing_key) or (None, None, None)
+
+    if entry is not None and image_cache.is_fresh(entry):
+        image_cache.record_hit()
+    else:
+        logger.info(f'Downloading and processing image from URL: {url}')
+
+        try:
+            fetched = await image_fetcher.fetch_conditional(
+                url,
+                etag=entry.etag if entry is not None else None,
+                last_modified=entry.last_modified if entry is not None else None,
+            )
+        except httpx.HTTPError as e:
+            logger.warning(f'Download failed for {url}: {str(e)}')
             return None
+        except (httpx.InvalidURL, ValueError) as e:
+            # Malformed URLs in the supplier data (e.g. 'http://[::1') are skipped like failed downloads
+            logger.warning(f'Invalid image URL {url}: {str(e)}')
+            return None
+
+        if fetched.not_modified:
+            await _use_image_cache(url, image_cache.mark_revalidated, url)
+            image_cache.record_hit()
+        else:
+            if image_cache.enabled:
+                image_cache.record_miss()
+            entry, processed, raw = None, None, fetched.content
+
+    if processed is not None:
+        return ProcessedImage(url=url, jpeg_bytes=processed, width=entry.width, height=entry.height)
+
+    try:
+        processed_image = await image_processor.process(raw, url=url)
+    except Exception as e:
+        logger.error(f'Image processing error: {str(e)}')
+        return None
+
+    await _use_image_cache(
+        url,
+        image_cache.store,
+        url,
+        # Raw bytes already in the cache are kept
+        raw=raw if entry is None else None,
+        etag=fetched.etag if entry is None else entry.etag,
+        last_modified=fetched.last_modified if entry is None else entry.last_modified,
+        processing_key=processing_key,
+        processed=processed_image.jpeg_bytes,
+        width=processed_image.width,
+        height=processed_image.height,
+    )
 
-    return None
+    return processed_image
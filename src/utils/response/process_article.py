@@ -1,83 +1,443 @@
+import asyncio
+import hashlib
+import json
+from typing import Any, Callable, Optional
+
 from loguru import logger
 
+from config.config import concurrency_config, response_config
+from utils.helper.journal import journal
 from utils.response import get_attribute, preprocess_images
+from utils.response.article_images import ArticleImages
+from utils.response.attribute_rules import attribute_rules
+from utils.response.colour_engine import colour_engine
+from utils.response.image_policy import IMAGE_ROLES, image_policies
+
+RESULT_KEY = "Ausgewaehlter Attributwert (Result)"
+
+
+class ArticleProcessingInterrupted(Exception):
+    """
+    Raised if a shutdown was requested while the attributes of an article were still being processed.
+    The article is incomplete and should not be saved or posted.
+    """
+
+
+def get_image_urls(article: dict) -> list:
+    """
+    Returns the image urls of an article (Hauptbild, Freisteller Back, Modellbild), if supplied.
+    """
+    return [article.get(role) for role in IMAGE_ROLES if article.get(role)]
+
+
+def get_image_roles(article: dict) -> dict:
+    """
+    Returns image url -> role (Hauptbild, Freisteller Back, Modellbild) of an article, used by the image policies.
+    """
+    roles = {}
+    for role in IMAGE_ROLES:
+        if article.get(role):
+            roles.setdefault(article.get(role), role)
+    return roles
 
 
-async def process_article(article: dict) -> dict:
+def get_possible_options(attribut: dict) -> Optional[dict]:
+    """
+    Returns the possible values of an attribute and the corresponding descriptions (Identifier: Bezeichner).
+    """
+    # TODO: Think of better logic here - currently only color attribute does not have possible outcomes when Hexcode is requested
+    if attribut.get("Identifier", None) == "farbHex":
+        return None
+
+    # Get possible values and the corrsponding descriptions to these values
+    return {
+        item.get("Identifier"): item.get("Bezeichner")
+        for item in attribut.get("Attributwerte")
+    }
+
+
+async def process_article(
+    article: dict,
+    article_images: ArticleImages = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    journal_key: Optional[str] = None,
+) -> dict:
     """
     Returns the LLMs response for each attribute for a given article (helper function).
+    The article's images are downloaded and preprocessed once and shared by all attribute calls.
+    With a journal_key (the article file name), every answer is recorded in the processing journal, and attributes answered
+    before an interruption are restored from it instead of being sent again.
 
     Args:
         article (dict): the dictionary conatianing all the article's information.
+        article_images (ArticleImages, optional): the already prepared images of the article. If not supplied, they are prepared
+            (and cleaned up) here.
+        should_stop (Callable[[], bool], optional): returns True once a shutdown was requested. Attributes which have not been sent
+            yet are skipped and ArticleProcessingInterrupted is raised.
+        journal_key (str, optional): the key of the article in the processing journal. Defaults to None (no journal).
 
     Returns:
         article (dict): the dictionary conatianing all the article's information, plus the LLMs' responses.
     """
     product_id = article.get("ProduktID")
-    farb_id = article.get("FarbID")
-    image_urls = [
-        url
-        for url in [
-            article.get("Hauptbild"),
-            article.get("Freisteller Back"),
-            article.get("Modellbild"),
-        ]
-        if url
-    ]
+    image_urls = get_image_urls(article)
+    on_result = None
     product_category = article.get("Klassifikation", [{}])[0]["Bezeichnung"]
     target_group = article.get("Geschlecht")
     supplier_color_id = article.get("FarbID", None)
 
-    for attribut in article.get("Klassifikations-Attribute", []):
-        logger.info(f"Analysing article: {product_id} and the corresponding attribute is: {attribut.get('Bezeichner')}")
-        
-        # TODO: Think of better logic here - currently only color attribute does not have possible outcomes when Hexcode is requested
-        if attribut.get("Identifier", None) == "farbHex":
-            possible_outcomes_description = None
-        else:
-            # Get possible values and the corrsponding descriptions to these values
-            possible_outcomes_description = {
-                item.get("Identifier"): item.get("Bezeichner")
-                for item in attribut.get("Attributwerte")
-            }
-
-        # Check if at least one image url has been supplied
+    # Image stage: fetch and prepare the images once per article
+    owns_images = article_images is None
+    if owns_images:
+        article_images = ArticleImages(
+            product_id=product_id,
+            image_urls=image_urls,
+            supplier_colour=supplier_color_id,
+            image_roles=get_image_roles(article),
+        )
+
+    try:
         if len(image_urls) != 0:
-            # Replace the key for this specific attribute inplace
-            attribut[
-                "Ausgewaehlter Attributwert (Result)"
-            ] = await get_attribute.get_response(
-                attribute_id=attribut.get(
-                    "Identifier"
-                ),  # The specific attribute identifier (e.g. "kragenform")
-                attribute_description=attribut.get(
-                    "Bezeichner"
-                ),  # The attribute's description - how is "kragenform" defined, in terms of fashion?
-                attribute_orientation=attribut.get(
-                    "Orientierung"
-                ),  # The orientation - where should the AI look to find correct attibute?
-                product_id=product_id,  # The proeduct id
-                # The image urls - there can be 1-3 images being supplied to us by Novomind
-                image_urls=image_urls,
-                target_group=target_group,  # The target group - men, women, children
-                # The short description of the product category (e.g. "D-Hosen / D-Freizeithosen")
+            await article_images.prepare()
+
+        attributes = article.get("Klassifikations-Attribute", [])
+        number_of_calls = 0
+
+        if journal_key is not None:
+            attributes, on_result = await _restore_from_journal(journal_key, attributes, article_hash(article))
+
+        # Attributes decided by the deterministic rules are not sent to the LLM
+        attributes = _apply_rules(article, attributes, on_result)
+
+        # Multi attribute mode: all non-colour attributes in one call, the remaining ones (and invalid answers) one by one
+        if response_config.extraction_mode == "multi_attribute" and article_images.processed_images:
+            attributes, number_of_calls = await _process_multi_attribute(
+                article=article,
+                attributes=attributes,
+                article_images=article_images,
                 product_category=product_category,
-                supplier_colour=farb_id
-                if attribut.get("Identifier") == "farbe"
-                else None,  # The supplier's color id - Is only supplid if we want to analyze the color
-                possible_options=possible_outcomes_description,  # Dictioanry of attribute:description
-            )
-        else:
-            preprocess_images.write_failed_image(
-                product_id=product_id, supplier_colour=supplier_color_id, url=image_urls
+                target_group=target_group,
+                on_result=on_result,
             )
-            logger.error(f"No image urls where supplied for the following product id: {product_id}")
 
-        # Log any failed responses here if needed
-        if (
-            attribut["Ausgewaehlter Attributwert (Result)"] is None
-            or attribut["Ausgewaehlter Attributwert (Result)"] == "None"
-        ):
-            logger.warning(f"Failed to process article: {product_id} and the corresponding attribute: {attribut.get('Identifier')}")
+        number_of_calls += await _process_attributes(
+            article=article,
+            attributes=attributes,
+            article_images=article_images,
+            product_category=product_category,
+            target_group=target_group,
+            should_stop=should_stop,
+            on_result=on_result,
+        )
+
+        article_images.report_fetches_saved(number_of_calls=number_of_calls)
+    finally:
+        # Answers given before an interruption are recorded as well, they are restored after the restart
+        if on_result is not None:
+            await on_result.wait()
+        if owns_images:
+            article_images.cleanup()
 
     return article
+
+
+class _AttributeRecorder:
+    """
+    Records the answers of an article's attributes in the processing journal, off the event loop (every commit is synced to disk).
+    Answers given while a write is running are written together with the next one, in one transaction.
+    """
+
+    def __init__(self, journal_key: str, attributes: list, article_hash: Optional[str] = None):
+        self.journal_key = journal_key
+        self.article_hash = article_hash
+        self._attribute_indices = {id(attribut): index for index, attribut in enumerate(attributes)}
+        self._pending: list[tuple[int, str, Any]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def __call__(self, attribut: dict) -> None:
+        # Failed calls (None) are not recorded, they are sent again after a restart
+        if attribut.get(RESULT_KEY) is None:
+            return
+
+        self._pending.append((self._attribute_indices[id(attribut)], attribut.get("Identifier"), attribut[RESULT_KEY]))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self) -> None:
+        while self._pending:
+            entries, self._pending = self._pending, []
+            await asyncio.to_thread(journal.record_attributes, self.journal_key, entries, self.article_hash)
+
+    async def wait(self) -> None:
+        """
+        Wait until all answers are written.
+        """
+        if self._task is not None:
+            await self._task
+
+
+def article_hash(article: dict) -> str:
+    """
+    Returns a hash of the article's content (identifies the delivered file, independent of its name).
+    """
+    return hashlib.sha256(json.dumps(article, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+async def _restore_from_journal(journal_key: str, attributes: list, content_hash: Optional[str] = None) -> tuple[list, _AttributeRecorder]:
+    """
+    Writes the answers recorded for the article into the attribute dicts (inplace). Only answers recorded for the same content
+    (content_hash) and the same attribute Identifier at the same position are restored.
+
+    Returns:
+        tuple[list, _AttributeRecorder]: The attributes which still have to be processed, and the callback which records an answer.
+    """
+    recorded = await asyncio.to_thread(journal.attribute_results, journal_key, content_hash)
+
+    restored = set()
+    for index, (attribute_id, value) in recorded.items():
+        if index < len(attributes) and attributes[index].get("Identifier") == attribute_id:
+            attributes[index][RESULT_KEY] = value
+            restored.add(index)
+
+    if restored:
+        logger.info(f"Restored {len(restored)} attribute answer(s) of {journal_key} from the processing journal")
+    if len(restored) < len(recorded):
+        logger.warning(f"Ignored {len(recorded) - len(restored)} recorded answer(s) of {journal_key}, the attributes have changed")
+
+    remaining_attributes = [attribut for index, attribut in enumerate(attributes) if index not in restored]
+    return remaining_attributes, _AttributeRecorder(journal_key, attributes, content_hash)
+
+
+def _apply_rules(article: dict, attributes: list, on_result: Optional[Callable[[dict], None]] = None) -> list:
+    """
+    Writes the answers of the attributes decided by the deterministic rules into the attribute dicts (inplace).
+
+    Returns:
+        list: The attributes which still have to be sent to the LLM.
+    """
+    remaining_attributes = []
+    for attribut in attributes:
+        decision = attribute_rules.resolve(article, attribut)
+        if decision is None:
+            remaining_attributes.append(attribut)
+            continue
+
+        attribut[RESULT_KEY] = decision.answer
+        if on_result is not None:
+            on_result(attribut)
+
+    return remaining_attributes
+
+
+async def _process_multi_attribute(
+    article: dict,
+    attributes: list,
+    article_images: ArticleImages,
+    product_category: str,
+    target_group: str,
+    on_result: Optional[Callable[[dict], None]] = None,
+) -> tuple[list, int]:
+    """
+    Determines all non-colour attributes with a single LLM call and writes the valid results into the attribute dicts (inplace).
+
+    Returns:
+        tuple[list, int]: The attributes which still have to be processed one by one, and the number of calls made (0 or 1).
+    """
+    product_id = article.get("ProduktID")
+    multi_attributes = [
+        attribut
+        for attribut in attributes
+        if attribut.get("Identifier") not in ("farbe", "farbHex") and attribut.get("Attributwerte")
+    ]
+
+    if not multi_attributes:
+        return attributes, 0
+
+    try:
+        results = await get_attribute.get_multi_attribute_response(
+            attributes=multi_attributes,
+            product_id=product_id,
+            images=article_images.processed_images,
+            product_category=product_category,
+            target_group=target_group,
+        )
+    except Exception as e:
+        logger.error(f"Multi attribute call failed for article {product_id}, falling back to one call per attribute: {e}")
+        return attributes, 1
+
+    for attribut in multi_attributes:
+        if attribut.get("Identifier") in results:
+            attribut[RESULT_KEY] = results[attribut.get("Identifier")]
+            if on_result is not None:
+                on_result(attribut)
+
+    answered = {id(attribut) for attribut in multi_attributes if attribut.get("Identifier") in results}
+    remaining_attributes = [attribut for attribut in attributes if id(attribut) not in answered]
+    logger.info(
+        f"Article {product_id}: {len(results)}/{len(multi_attributes)} attributes answered by the multi attribute call, "
+        f"{len(remaining_attributes)} attribute(s) left for single calls"
+    )
+
+    return remaining_attributes, 1
+
+
+async def _process_attributes(
+    article: dict,
+    attributes: list,
+    article_images: ArticleImages,
+    product_category: str,
+    target_group: str,
+    should_stop: Optional[Callable[[], bool]] = None,
+    on_result: Optional[Callable[[dict], None]] = None,
+) -> int:
+    """
+    Sends each attribute of the article to the LLM and writes the result into the attribute dict (inplace).
+    Depending on the config, the attributes are sent one after another or concurrently.
+
+    Returns:
+        int: The number of attribute calls that were made.
+    """
+    if not concurrency_config.concurrent_attributes:
+        number_of_calls = 0
+        for index, attribut in enumerate(attributes):
+            # Do not start the next request once a shutdown has been requested
+            if should_stop is not None and should_stop():
+                skipped_attributes = [remaining.get("Identifier") for remaining in attributes[index:]]
+                raise ArticleProcessingInterrupted(
+                    f"Shutdown requested, skipped {len(skipped_attributes)} attribute(s) of article {article.get('ProduktID')}: {skipped_attributes}"
+                )
+
+            number_of_calls += await _process_attribute(
+                article=article,
+                attribut=attribut,
+                article_images=article_images,
+                product_category=product_category,
+                target_group=target_group,
+                on_result=on_result,
+            )
+        return number_of_calls
+
+    # Concurrent mode: all attribute requests of the article are sent together (bounded per article, and globally in get_attribute)
+    article_semaphore = asyncio.Semaphore(concurrency_config.max_concurrent_attributes_per_article)
+    skipped_attributes = []
+
+    async def _bounded(attribut: dict) -> int:
+        async with article_semaphore:
+            # Do not start new requests once a shutdown has been requested (in-flight requests are finished)
+            if should_stop is not None and should_stop():
+                skipped_attributes.append(attribut.get("Identifier"))
+                return 0
+
+            return await _process_attribute(
+                article=article,
+                attribut=attribut,
+                article_images=article_images,
+                product_category=product_category,
+                target_group=target_group,
+                on_result=on_result,
+            )
+
+    results = await asyncio.gather(*[_bounded(attribut) for attribut in attributes], return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    if skipped_attributes:
+        raise ArticleProcessingInterrupted(
+            f"Shutdown requested, skipped {len(skipped_attributes)} attribute(s) of article {article.get('ProduktID')}: {skipped_attributes}"
+        )
+
+    return sum(results)
+
+
+async def _process_attribute(
+    article: dict,
+    attribut: dict,
+    article_images: ArticleImages,
+    product_category: str,
+    target_group: str,
+    on_result: Optional[Callable[[dict], None]] = None,
+) -> int:
+    """
+    Sends a single attribute to the LLM and writes the result into the attribute dict (inplace).
+
+    Returns:
+        int: 1 if an attribute call was made, else 0.
+    """
+    product_id = article.get("ProduktID")
+    farb_id = article.get("FarbID")
+    image_urls = article_images.image_urls
+    supplier_color_id = article.get("FarbID", None)
+    number_of_calls = 0
+
+    logger.info(f"Analysing article: {product_id} and the corresponding attribute is: {attribut.get('Bezeichner')}")
+
+    possible_outcomes_description = get_possible_options(attribut)
+
+    # Colour attributes can be answered by the local colour engine (the LLM is only asked if it is selected or not confident)
+    if colour_engine.mode_for(attribut.get("Identifier")) != "llm" and article_images.processed_images:
+        analysis = await article_images.colour_analysis()
+        answered_locally, answer = colour_engine.resolve(attribut.get("Identifier"), analysis, possible_outcomes_description)
+        if answered_locally:
+            logger.info(
+                f"Colour engine answer for article {product_id} and attribute {attribut.get('Identifier')}: {answer} "
+                f"(confidence: {analysis.confidence})"
+            )
+            attribut[RESULT_KEY] = answer
+            if on_result is not None:
+                on_result(attribut)
+            return 0
+
+    # Only the images (roles, resolution, crop, detail) of the attribute's image policy are sent
+    image_policy = image_policies.for_attribute(attribut)
+    images = await asyncio.to_thread(article_images.select_images, image_policy)
+    if images:
+        image_policies.report_savings(attribut.get("Identifier"), article_images.processed_images, images, image_policy.detail)
+
+    # Check if at least one image url has been supplied
+    if len(image_urls) != 0:
+        # Replace the key for this specific attribute inplace
+        attribut[
+            "Ausgewaehlter Attributwert (Result)"
+        ] = await get_attribute.get_response(
+            attribute_id=attribut.get(
+                "Identifier"
+            ),  # The specific attribute identifier (e.g. "kragenform")
+            attribute_description=attribut.get(
+                "Bezeichner"
+            ),  # The attribute's description - how is "kragenform" defined, in terms of fashion?
+            attribute_orientation=attribut.get(
+                "Orientierung"
+            ),  # The orientation - where should the AI look to find correct attibute?
+            product_id=product_id,  # The proeduct id
+            # The image urls - there can be 1-3 images being supplied to us by Novomind
+            image_urls=image_urls,
+            target_group=target_group,  # The target group - men, women, children
+            # The short description of the product category (e.g. "D-Hosen / D-Freizeithosen")
+            product_category=product_category,
+            supplier_colour=farb_id
+            if attribut.get("Identifier") == "farbe"
+            else None,  # The supplier's color id - Is only supplid if we want to analyze the color
+            possible_options=possible_outcomes_description,  # Dictioanry of attribute:description
+            images=images,  # The images prepared once for this article, selected by the image policy
+            image_detail=image_policy.detail,
+        )
+        number_of_calls += 1
+
+        if on_result is not None:
+            on_result(attribut)
+    else:
+        preprocess_images.write_failed_image(
+            product_id=product_id, supplier_colour=supplier_color_id, url=image_urls
+        )
+        logger.error(f"No image urls where supplied for the following product id: {product_id}")
+
+    # Log any failed responses here if needed
+    if (
+        attribut["Ausgewaehlter Attributwert (Result)"] is None
+        or attribut["Ausgewaehlter Attributwert (Result)"] == "None"
+    ):
+        logger.warning(f"Failed to process article: {product_id} and the corresponding attribute: {attribut.get('Identifier')}")
+
+    return number_of_calls
@@ -0,0 +1,74 @@
+from typing import List
+
+from config.config import response_config
+from utils.helper import metrics
+from utils.response.preprocess_images import ProcessedImage
+
+
+def build_product_context(product_category: str = '', target_group: str = '') -> str:
+    """
+    The product context shared by all requests of an article (product category and target group).
+    """
+    return response_config.prompt_template_product_context.format(
+        product_category=product_category,
+        target_group=target_group,
+    )
+
+
+def build_prompt_content(product_context: str, images: List[ProcessedImage], question: str, image_detail: str = 'auto') -> List:
+    """
+    Build the user content of a request with the stable parts first: the product context and the images, then the question
+    (attribute, description and options). All requests of an article thereby start with the same prefix (system prompt,
+    product context, images), which the provider can serve from its prompt cache.
+
+    Args:
+        product_context (str): The product context of the article (see build_product_context).
+        images (List[ProcessedImage]): The processed images of the article.
+        question (str): The attribute specific part of the prompt.
+        image_detail (str, optional): The 'detail' hint of the images ('low', 'high' or 'auto'). Defaults to 'auto' (not sent).
+
+    Returns:
+        List: The user content (text and image parts).
+    """
+    content = [{'type': 'text', 'text': product_context}]
+    for img in images:
+        # Append each image (encoded in memory) to the contents
+        image_url = {'url': img.data_url}
+        if image_detail != 'auto':
+            image_url['detail'] = image_detail
+        content.append({'type': 'image_url', 'image_url': image_url})
+    content.append({'type': 'text', 'text': question})
+
+    return content
+
+
+def content_text(content: List) -> str:
+    """
+    The text parts of a user content, joined (e.g. for cache keys and token estimates).
+    """
+    return '\n\n'.join(part['text'] for part in content if part.get('type') == 'text')
+
+
+def record_usage(usage) -> None:
+    """
+    Count the prompt tokens and the prompt tokens served from the provider's prompt cache (usage.prompt_tokens_details.cached_tokens).
+
+    Args:
+        usage: The usage of a chat completion (object or dict, as in the Batch API output), may be None.
+    """
+    if usage is None:
+        return
+
+    if isinstance(usage, dict):
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    else:
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+
+    metrics.increment('llm_prompt_tokens', prompt_tokens)
+    metrics.increment('llm_cached_prompt_tokens', cached_tokens)
+
+    total_prompt_tokens = metrics.get_counter('llm_prompt_tokens')
+    if total_prompt_tokens:
+        metrics.set_gauge('llm_cached_prompt_token_share', metrics.get_counter('llm_cached_prompt_tokens') / total_prompt_tokens)
@@ -0,0 +1,148 @@
+import asyncio
+import re
+import time
+from typing import Mapping, Optional
+
+from loguru import logger
+
+from config.config import rate_limit_config
+from utils.helper import metrics
+
+
+def _parse_reset(value: str) -> Optional[float]:
+    """
+    Parse the reset durations of the x-ratelimit-reset-* headers (e.g. "1s", "6m0s", "20ms") into seconds.
+    """
+    matches = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value or '')
+    if not matches:
+        return None
+
+    factors = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * factors[unit] for number, unit in matches)
+
+
+class TokenBucket:
+    """
+    A bucket which holds up to `capacity` units and is refilled continuously with `capacity` units per minute.
+    """
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.available = capacity
+        self._updated_at = time.monotonic()
+
+    @property
+    def refill_per_second(self) -> float:
+        return self.capacity / 60
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Seconds until `amount` units are available (0 if they are available now).
+        """
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        self.available -= min(amount, self.capacity)
+
+    def update(self, limit: Optional[float], remaining: Optional[float], reset_seconds: Optional[float]) -> None:
+        """
+        Align the bucket with the budget reported by the provider (the provider's view wins if it is stricter than ours).
+        """
+        self.refill()
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.available = min(self.available, remaining)
+            # Budget exhausted on the provider side: nothing is sent before the reported reset
+            if remaining <= 0 and reset_seconds:
+                self.available = min(self.available, -reset_seconds * self.refill_per_second)
+
+
+class RateLimiter:
+    """
+    Client-side limiter for requests per minute and (estimated) tokens per minute, shared by all LLM calls.
+    Calls are delayed before they are sent, instead of running into 429 errors.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, enabled: bool = True):
+        self.enabled = enabled
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        Wait until one request and the estimated tokens fit into the budget, then take them.
+
+        Args:
+            tokens (int): The estimated tokens of the request.
+        """
+        if not self.enabled:
+            return
+
+        # Callers are served one after another (FIFO), so a large request is not starved by small ones
+        async with self._get_lock():
+            waited = 0.0
+            while True:
+                wait_time = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+                waited += wait_time
+
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+
+        if waited > 0:
+            logger.debug(f'Rate limiter delayed LLM call by {waited:.2f}s ({tokens} estimated tokens)')
+            metrics.increment('rate_limiter_wait_seconds', waited)
+        metrics.set_gauge('rate_limiter_available_requests', self.requests.available)
+        metrics.set_gauge('rate_limiter_available_tokens', self.tokens.available)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """
+        Update the budgets from the x-ratelimit-* response headers of the provider (if present).
+        """
+        if not self.enabled or headers is None:
+            return
+
+        def _number(name: str) -> Optional[float]:
+            try:
+                return float(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        self.requests.update(
+            limit=_number('x-ratelimit-limit-requests'),
+            remaining=_number('x-ratelimit-remaining-requests'),
+            reset_seconds=_parse_reset(headers.get('x-ratelimit-reset-requests')),
+        )
+        self.tokens.update(
+            limit=_number('x-ratelimit-limit-tokens'),
+            remaining=_number('x-ratelimit-remaining-tokens'),
+            reset_seconds=_parse_reset(headers.get('x-ratelimit-reset-tokens')),
+        )
+
+
+rate_limiter = RateLimiter(
+    requests_per_minute=rate_limit_config.requests_per_minute,
+    tokens_per_minute=rate_limit_config.tokens_per_minute,
+    enabled=rate_limit_config.enabled,
+)
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Literal, Optional
+
+from loguru import logger
+
+from config.config import response_cache_config
+from config.paths import data_path_cache
+from utils.helper import metrics
+
+
+class ResponseCache:
+    """
+    Persistent (SQLite) cache of LLM answers. The key is derived from everything that determines the answer: the hashes of the
+    processed images, the attribute, its options, the prompts and the model. Entries expire after a TTL, and the least recently
+    used entries are evicted once the cache holds more than max_entries.
+
+    Modes:
+        * 'on': read and write the cache
+        * 'off': bypass the cache completely
+        * 'refresh': do not read, but overwrite the cached answers with fresh ones
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        max_entries: int = 100_000,
+        ttl_seconds: float = 30 * 24 * 3600,
+        mode: Literal['on', 'off', 'refresh'] = 'on',
+    ):
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, attribute_id TEXT, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)')
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def make_key(
+        model_name: str,
+        attribute_id: str,
+        image_hashes: List[str],
+        possible_options: Optional[dict],
+        prompt_template: str,
+        system_prompt: str,
+        prompt: str,
+        image_detail: str = 'auto',
+    ) -> str:
+        """
+        Build the cache key of an LLM request.
+
+        Args:
+            model_name (str): The model which answers the request.
+            attribute_id (str): The attribute identifier (e.g. "kragenform").
+            image_hashes (List[str]): The hashes of the processed images, in the order they are sent.
+            possible_options (dict, optional): The allowed options (Identifier: Bezeichner).
+            prompt_template (str): The (unformatted) prompt template.
+            system_prompt (str): The system prompt.
+            prompt (str): The formatted prompt (contains e.g. the product category and target group).
+            image_detail (str, optional): The 'detail' hint the images are sent with. Defaults to 'auto'.
+
+        Returns:
+            str: The hex digest of the key.
+        """
+        key_data = {
+            'model_name': model_name,
+            'attribute_id': attribute_id,
+            'image_hashes': list(image_hashes),
+            'possible_options': possible_options,
+            'prompt_template': prompt_template,
+            'system_prompt': system_prompt,
+            'prompt': prompt,
+        }
+        # Only part of the key if set, so the keys of the existing entries stay valid
+        if image_detail != 'auto':
+            key_data['image_detail'] = image_detail
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached answer or None (miss, expired entry, or cache not readable in the current mode).
+        """
+        if self.mode != 'on':
+            return None
+
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute('SELECT value, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+
+            if row is not None and now - row[1] > self.ttl_seconds:
+                connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                connection.commit()
+                row = None
+
+            if row is not None:
+                connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+                connection.commit()
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        metrics.increment('llm_cache_hits' if row is not None else 'llm_cache_misses')
+        metrics.set_gauge('llm_cache_hit_rate', self.hit_rate)
+
+        return row[0] if row is not None else None
+
+    def set(self, key: str, value: str, attribute_id: Optional[str] = None) -> None:
+        """
+        Store an answer (and evict the least recently used entries, if the cache is full).
+        """
+        if self.mode == 'off':
+            return
+
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'INSERT OR REPLACE INTO responses (key, attribute_id, value, created_at, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, attribute_id, value, now, now),
+            )
+
+            number_of_entries = connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            if number_of_entries > self.max_entries:
+                connection.execute(
+                    'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)',
+                    (number_of_entries - self.max_entries,),
+                )
+                logger.info(f'LLM response cache: evicted {number_of_entries - self.max_entries} least recently used entries')
+            connection.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {'mode': self.mode, 'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hit_rate, 3)}
+
+
+response_cache = ResponseCache(
+    db_path=data_path_cache / 'llm_responses.sqlite',
+    max_entries=response_cache_config.max_entries,
+    ttl_seconds=response_cache_config.ttl_days * 24 * 3600,
+    mode=response_cache_config.mode,
+)
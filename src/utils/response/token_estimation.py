@@ -0,0 +1,116 @@
+import math
+from typing import List, Literal, Optional
+
+from config.config import openai_config
+from utils.response.preprocess_images import ProcessedImage
+
+# Rough number of characters per text token
+_CHARS_PER_TOKEN = 4
+
+# Models which count images in 32px patches (at most 1536 per image), times a per-model multiplier (model name prefix -> multiplier)
+_PATCH_MODELS = {
+    'gpt-4.1-mini': 1.62,
+    'gpt-4.1-nano': 2.46,
+    'o4-mini': 1.72,
+}
+_MAX_PATCHES = 1536
+
+# All other models count 512px tiles (model name prefix -> base tokens, tokens per tile), gpt-4o/gpt-4.1 by default
+_TILE_MODELS = {
+    'gpt-4o-mini': (2833, 5667),
+    'o1': (75, 150),
+    'o3': (75, 150),
+}
+_DEFAULT_TILE_TOKENS = (85, 170)
+
+
+def _model_entry(model_name: str, models: dict):
+    # Longest matching prefix, so e.g. 'gpt-4o-mini-2024-07-18' is not matched by a shorter prefix
+    prefixes = [prefix for prefix in models if model_name.startswith(prefix)]
+    return models[max(prefixes, key=len)] if prefixes else None
+
+
+def _patch_tokens(width: float, height: float, multiplier: float) -> int:
+    patches = math.ceil(width / 32) * math.ceil(height / 32)
+    if patches > _MAX_PATCHES:
+        # Scaled down (aspect ratio preserved) until the image fits into 1536 whole patches
+        scale = math.sqrt(32 * 32 * _MAX_PATCHES / (width * height))
+        scale *= min(math.floor(width * scale / 32) / (width * scale / 32), math.floor(height * scale / 32) / (height * scale / 32))
+        patches = min(math.ceil(width * scale / 32) * math.ceil(height * scale / 32), _MAX_PATCHES)
+
+    return math.ceil(patches * multiplier)
+
+
+def _tile_tokens(width: float, height: float, detail: str, base_tokens: int, tile_tokens: int) -> int:
+    if detail == 'low':
+        return base_tokens
+
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+
+    return base_tokens + tile_tokens * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_image_tokens(
+    width: int,
+    height: int,
+    detail: Literal['low', 'high', 'auto'] = 'auto',
+    model_name: Optional[str] = None,
+) -> int:
+    """
+    Estimate the input tokens of an image (OpenAI vision pricing), depending on the model:
+
+    * gpt-4.1-mini, gpt-4.1-nano, o4-mini: 32px patches (at most 1536, larger images are scaled down) times a model multiplier
+      (e.g. 1.62 for gpt-4.1-mini). The detail hint does not change the count.
+    * other models: base tokens (85 for gpt-4o/gpt-4.1), plus tokens per 512px tile (170) for high detail, after fitting the image
+      into 2048x2048 and scaling its shortest side down to 768px. Low detail costs the base tokens only.
+
+    Args:
+        width (int): Width of the image in pixels.
+        height (int): Height of the image in pixels.
+        detail (str, optional): The requested detail ('auto' is treated as 'high'). Defaults to 'auto'.
+        model_name (str, optional): The model the image is sent to. Defaults to the configured model.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    model_name = model_name or openai_config.model_name
+
+    multiplier = _model_entry(model_name, _PATCH_MODELS)
+    if multiplier is not None:
+        return _patch_tokens(width, height, multiplier)
+
+    base_tokens, tile_tokens = _model_entry(model_name, _TILE_MODELS) or _DEFAULT_TILE_TOKENS
+    return _tile_tokens(width, height, detail, base_tokens, tile_tokens)
+
+
+def estimate_text_tokens(text: str) -> int:
+    return math.ceil(len(text or '') / _CHARS_PER_TOKEN)
+
+
+def estimate_request_tokens(
+    texts: List[str],
+    images: List[ProcessedImage],
+    max_completion_tokens: int = 0,
+    image_detail: Literal['low', 'high', 'auto'] = 'auto',
+) -> int:
+    """
+    Estimate the tokens an LLM request counts against the tokens-per-minute limit (input tokens plus the completion budget).
+
+    Args:
+        texts (List[str]): The text parts of the request (system prompt, prompt).
+        images (List[ProcessedImage]): The images sent with the request.
+        max_completion_tokens (int, optional): The completion token budget. Defaults to 0.
+        image_detail (str, optional): The 'detail' hint the images are sent with. Defaults to 'auto'.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return (
+        sum(estimate_text_tokens(text) for text in texts)
+        + sum(estimate_image_tokens(img.width, img.height, detail=image_detail) for img in images)
+        + max_completion_tokens
+    )
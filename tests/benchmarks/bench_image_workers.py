@@ -0,0 +1,62 @@
+"""
+Benchmark of the image preprocessing throughput (images per second) depending on the executor and the number of workers.
+The images are processed concurrently through ImageProcessor, as during the pipeline run.
+
+    PYTHONPATH=src python tests/benchmarks/bench_image_workers.py [--images 64] [--workers 1 2 4 8]
+"""
+import argparse
+import asyncio
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from utils.response.preprocess_images import ImageProcessor
+
+
+def _sample_image(width: int = 2000, height: int = 2600) -> bytes:
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    pixels = np.clip(pixels + rng.integers(-20, 20, pixels.shape), 0, 255).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+async def _throughput(processor: ImageProcessor, content: bytes, images: int) -> float:
+    # Warm up (starts the workers)
+    await asyncio.gather(*[processor.process(content, url='warmup') for _ in range(processor.workers)])
+
+    start = time.perf_counter()
+    await asyncio.gather(*[processor.process(content, url=f'image-{i}') for i in range(images)])
+    return images / (time.perf_counter() - start)
+
+
+def main(images: int, workers: list[int]) -> None:
+    content = _sample_image()
+    print(f'{os.cpu_count()} CPU core(s), {images} images of {len(content) // 1024} KiB')
+
+    baseline = asyncio.run(_throughput(ImageProcessor(executor='inline'), content, images))
+    print(f"{'executor':<10}{'workers':>8}{'images/s':>10}{'speedup':>9}")
+    print(f"{'inline':<10}{1:>8}{baseline:>10.1f}{1:>8.1f}x")
+
+    for executor in ('thread', 'process'):
+        for worker_count in workers:
+            processor = ImageProcessor(executor=executor, workers=worker_count)
+            try:
+                throughput = asyncio.run(_throughput(processor, content, images))
+            finally:
+                processor.shutdown()
+            print(f'{executor:<10}{worker_count:>8}{throughput:>10.1f}{throughput / baseline:>8.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=64, help='Images per run')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1], help='Worker counts to compare')
+    args = parser.parse_args()
+    main(args.images, sorted(set(args.workers)))
@@ -0,0 +1,60 @@
+"""
+Micro-benchmark of the image preprocessing (decode, resize, JPEG encode): CPU time per image with the legacy path (full decode)
+and with IMAGE_FAST_DECODE (reduced size JPEG decoding).
+
+    PYTHONPATH=src python tests/benchmarks/bench_preprocess_images.py [--repeat 10]
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from config.config import image_preprocess_config
+from utils.response.preprocess_images import _process_image
+
+
+def _sample_image(width: int, height: int, mode: str, image_format: str) -> bytes:
+    """
+    A photo-like test image (gradients plus noise, so the encoder cannot take shortcuts).
+    """
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    pixels = np.clip(pixels + rng.integers(-20, 20, pixels.shape), 0, 255).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).convert(mode).save(buffer, format=image_format, quality=90)
+    return buffer.getvalue()
+
+
+def _cpu_time_per_image(content: bytes, repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        _process_image(content, url='benchmark')
+    return (time.process_time() - start) / repeat
+
+
+def main(repeat: int) -> None:
+    samples = {
+        'JPEG RGB 3000x4000': _sample_image(3000, 4000, 'RGB', 'JPEG'),
+        'JPEG RGB 1200x1600': _sample_image(1200, 1600, 'RGB', 'JPEG'),
+        'JPEG CMYK 3000x4000': _sample_image(3000, 4000, 'CMYK', 'JPEG'),
+        'JPEG L 3000x4000': _sample_image(3000, 4000, 'L', 'JPEG'),
+        'PNG RGBA 1500x2000': _sample_image(1500, 2000, 'RGBA', 'PNG'),
+    }
+
+    print(f"{'image':<22}{'full decode':>14}{'fast decode':>14}{'speedup':>10}")
+    for name, content in samples.items():
+        image_preprocess_config.fast_decode = False
+        before = _cpu_time_per_image(content, repeat)
+        image_preprocess_config.fast_decode = True
+        after = _cpu_time_per_image(content, repeat)
+        print(f'{name:<22}{before * 1000:>11.1f} ms{after * 1000:>11.1f} ms{before / after:>9.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='Runs per image')
+    main(parser.parse_args().repeat)
@@ -0,0 +1,183 @@
+import os
+import socket
+import threading
+
+import paramiko
+import pytest
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+from paramiko.sftp import SFTP_FAILURE, SFTP_OK
+
+HOST_KEY = paramiko.RSAKey.generate(2048)
+
+
+class StubServer(paramiko.ServerInterface):
+    """
+    Accepts every password login and SFTP channel.
+    """
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+
+class StubSFTPHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+def make_sftp_interface(root):
+    class StubSFTPServer(SFTPServerInterface):
+        def _realpath(self, path):
+            return root + self.canonicalize(path)
+
+        def list_folder(self, path):
+            path = self._realpath(path)
+            try:
+                out = []
+                for fname in os.listdir(path):
+                    attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, fname)))
+                    attr.filename = fname
+                    out.append(attr)
+                return out
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+
+        def stat(self, path):
+            try:
+                return SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            path = self._realpath(path)
+            try:
+                fd = os.open(path, flags, 0o666)
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+            if (flags & os.O_CREAT) and (attr is not None):
+                attr._flags &= ~attr.FLAG_PERMISSIONS
+            if flags & os.O_WRONLY:
+                fstr = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                fstr = 'rb'
+            f = os.fdopen(fd, fstr)
+            handle = StubSFTPHandle(flags)
+            handle.filename = path
+            handle.readfile = f
+            handle.writefile = f
+            return handle
+
+        def remove(self, path):
+            try:
+                os.remove(self._realpath(path))
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+            return SFTP_OK
+
+        def rename(self, oldpath, newpath):
+            oldpath, newpath = self._realpath(oldpath), self._realpath(newpath)
+            # SFTP v3 semantics: renaming onto an existing path fails
+            if os.path.exists(newpath):
+                return SFTP_FAILURE
+            try:
+                os.rename(oldpath, newpath)
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+            return SFTP_OK
+
+        def mkdir(self, path, attr):
+            try:
+                os.mkdir(self._realpath(path))
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+            return SFTP_OK
+
+        def rmdir(self, path):
+            try:
+                os.rmdir(self._realpath(path))
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+            return SFTP_OK
+
+        def chattr(self, path, attr):
+            return SFTP_OK
+
+    return StubSFTPServer
+
+
+class LocalSFTPServer:
+    """
+    Local paramiko SFTP server which serves the directory `root` (counts the accepted connections).
+    """
+
+    def __init__(self, root):
+        self.root = str(root)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self.transports = []
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(HOST_KEY)
+            transport.set_subsystem_handler('sftp', SFTPServer, make_sftp_interface(self.root))
+            transport.start_server(server=StubServer())
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+
+@pytest.fixture
+def sftp_server(tmp_path):
+    root = tmp_path / 'sftp'
+    (root / 'out').mkdir(parents=True)
+    (root / 'in').mkdir()
+
+    server = LocalSFTPServer(root)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def connect_local_sftp(sftp_server):
+    """
+    Connection factory for the local SFTP server (same shape as sftp_pool.connect_sftp).
+    """
+
+    def _connect():
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname='127.0.0.1', port=sftp_server.port, username='user', password='pw',
+                       look_for_keys=False, allow_agent=False)
+        return client, client.open_sftp()
+
+    return _connect
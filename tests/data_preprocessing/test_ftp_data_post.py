@@ -0,0 +1,25 @@
+from utils.data_preprocessing import ftp_data_post
+from utils.data_preprocessing.sftp_pool import SFTPConnectionPool
+
+
+def test_upload_files_sends_only_the_given_files(sftp_server, connect_local_sftp, tmp_path, monkeypatch):
+    pool = SFTPConnectionPool(max_size=1, connect=connect_local_sftp)
+    monkeypatch.setattr(ftp_data_post, 'sftp_pool', pool)
+
+    local_dir = tmp_path / 'local'
+    local_dir.mkdir()
+    for name in ('a.json', 'b.json', 'c.json'):
+        (local_dir / name).write_text(f'{{"name": "{name}"}}')
+
+    try:
+        poster = ftp_data_post.FTPDataPoster()
+        uploaded = poster.upload_files(paths=[local_dir / 'a.json'])
+        uploaded += poster.upload_files(paths=[local_dir / 'b.json'], payloads={'d.json': b'{"name": "d.json"}'})
+    finally:
+        pool.close_all()
+
+    remote_in = tmp_path / 'sftp' / 'in'
+    assert uploaded == 3
+    assert sorted(p.name for p in remote_in.iterdir()) == ['a.json', 'b.json', 'd.json']
+    assert (remote_in / 'd.json').read_bytes() == b'{"name": "d.json"}'
+    assert sftp_server.connections == 1
@@ -0,0 +1,23 @@
+import pytest
+
+from utils.data_preprocessing import ftp_data_loader
+
+
+def test_download_json_file_streams_to_disk(sftp_server, connect_local_sftp, tmp_path):
+    content = ('{"ProduktID": 1, "data": "' + 'x' * 300_000 + '"}').encode()
+    (tmp_path / 'sftp' / 'out' / 'article_1.json').write_bytes(content)
+    local_dir = tmp_path / 'local'
+
+    client, sftp = connect_local_sftp()
+    try:
+        local_path = ftp_data_loader.download_json_file(sftp, '/out/article_1.json', local_dir=local_dir, read_size=8192)
+
+        # A failed download leaves no partial file behind
+        with pytest.raises(IOError):
+            ftp_data_loader.download_json_file(sftp, '/out/missing.json', local_dir=local_dir)
+    finally:
+        client.close()
+
+    assert local_path == str(local_dir / 'article_1.json')
+    assert [path.name for path in local_dir.iterdir()] == ['article_1.json']
+    assert (local_dir / 'article_1.json').read_bytes() == content
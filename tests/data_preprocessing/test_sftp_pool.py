@@ -0,0 +1,58 @@
+import threading
+
+from utils.data_preprocessing.sftp_pool import SFTPConnectionPool
+
+
+def test_sessions_are_reused_and_reset_to_the_login_directory(sftp_server, connect_local_sftp):
+    pool = SFTPConnectionPool(max_size=2, connect=connect_local_sftp)
+    try:
+        for _ in range(5):
+            with pool.session() as sftp:
+                sftp.chdir('out')
+                assert sftp.getcwd() == '/out'
+
+        with pool.session() as sftp:
+            assert sftp.getcwd() is None
+            assert sorted(sftp.listdir('.')) == ['in', 'out']
+    finally:
+        pool.close_all()
+
+    assert sftp_server.connections == 1
+
+
+def test_broken_session_is_replaced_by_a_new_connection(sftp_server, connect_local_sftp):
+    pool = SFTPConnectionPool(max_size=2, health_check_interval=0, connect=connect_local_sftp)
+    try:
+        with pool.session() as sftp:
+            sftp.listdir('out')
+
+        # The server drops the idle connection
+        for transport in sftp_server.transports:
+            transport.close()
+
+        with pool.session() as sftp:
+            assert sftp.listdir('out') == []
+    finally:
+        pool.close_all()
+
+    assert sftp_server.connections == 2
+
+
+def test_pool_limits_open_sessions(sftp_server, connect_local_sftp):
+    pool = SFTPConnectionPool(max_size=2, connect=connect_local_sftp)
+
+    def work():
+        for _ in range(5):
+            with pool.session() as sftp:
+                sftp.listdir('out')
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close_all()
+
+    assert sftp_server.connections <= 2
@@ -0,0 +1,93 @@
+import json
+import os
+
+from utils.data_preprocessing.work_claims import LEASE_FILE_NAME, WorkClaimer
+
+
+def test_replicas_claim_disjoint_files(sftp_server, connect_local_sftp, tmp_path):
+    remote_out = tmp_path / 'sftp' / 'out'
+    for i in range(10):
+        (remote_out / f'article_{i}.json').write_text('{}')
+
+    client_a, sftp_a = connect_local_sftp()
+    client_b, sftp_b = connect_local_sftp()
+    try:
+        claimed_a = WorkClaimer('replica-a').claim(sftp_a, batch_size=4)
+        claimed_b = WorkClaimer('replica-b').claim(sftp_b, batch_size=4)
+        # A second claim of the same replica returns its unfinished files first
+        claimed_a_again = WorkClaimer('replica-a').claim(sftp_a, batch_size=5)
+    finally:
+        client_a.close()
+        client_b.close()
+
+    names_a = {path.rsplit('/', 1)[-1] for path in claimed_a}
+    names_b = {path.rsplit('/', 1)[-1] for path in claimed_b}
+    assert len(names_a) == len(names_b) == 4
+    assert not names_a & names_b
+    assert all(path.startswith('/out/processing/replica-a/') for path in claimed_a)
+    assert names_a < {path.rsplit('/', 1)[-1] for path in claimed_a_again}
+    assert len(list(remote_out.glob('*.json'))) == 1
+
+
+def test_files_of_a_stale_replica_are_reclaimed(sftp_server, connect_local_sftp, tmp_path):
+    stale_dir = tmp_path / 'sftp' / 'out' / 'processing' / 'replica-dead'
+    stale_dir.mkdir(parents=True)
+    (stale_dir / LEASE_FILE_NAME).write_text(json.dumps({'worker_id': 'replica-dead'}))
+    os.utime(stale_dir / LEASE_FILE_NAME, (0, 0))
+    (stale_dir / 'article_1.json').write_text('{}')
+
+    alive_dir = tmp_path / 'sftp' / 'out' / 'processing' / 'replica-alive'
+    alive_dir.mkdir()
+    (alive_dir / 'article_2.json').write_text('{}')
+
+    client, sftp = connect_local_sftp()
+    try:
+        WorkClaimer('replica-alive').renew_lease(sftp)
+        claimed = WorkClaimer('replica-b', lease_timeout=60).claim(sftp)
+    finally:
+        client.close()
+
+    assert claimed == ['/out/processing/replica-b/article_1.json']
+    assert not stale_dir.exists()
+    assert (alive_dir / 'article_2.json').exists()
+
+
+def test_lease_age_uses_the_server_time(sftp_server, connect_local_sftp, tmp_path):
+    # Written just now by a replica whose clock is far behind (the old lease format with the writer's time)
+    skewed_dir = tmp_path / 'sftp' / 'out' / 'processing' / 'replica-skewed'
+    skewed_dir.mkdir(parents=True)
+    (skewed_dir / LEASE_FILE_NAME).write_text(json.dumps({'worker_id': 'replica-skewed', 'renewed_at': 0}))
+    (skewed_dir / 'article_1.json').write_text('{}')
+
+    client, sftp = connect_local_sftp()
+    try:
+        claimer = WorkClaimer('replica-b', lease_timeout=60)
+        server_time = claimer.renew_lease(sftp)
+        assert claimer.reclaim_stale(sftp, server_time=server_time) == []
+        # Measured against the server time, not the clock of the reclaiming replica
+        assert claimer.reclaim_stale(sftp, server_time=server_time + 3600) == ['article_1.json']
+    finally:
+        client.close()
+
+
+def test_new_directories_without_a_lease_are_not_reclaimed(sftp_server, connect_local_sftp, tmp_path):
+    processing = tmp_path / 'sftp' / 'out' / 'processing'
+    # Created just now, the replica has not written its lease yet
+    starting_dir = processing / 'replica-starting'
+    starting_dir.mkdir(parents=True)
+    (starting_dir / 'article_1.json').write_text('{}')
+    # Without a lease for longer than the lease timeout
+    abandoned_dir = processing / 'replica-abandoned'
+    abandoned_dir.mkdir()
+    (abandoned_dir / 'article_2.json').write_text('{}')
+    os.utime(abandoned_dir, (0, 0))
+
+    client, sftp = connect_local_sftp()
+    try:
+        claimed = WorkClaimer('replica-b', lease_timeout=60).claim(sftp)
+    finally:
+        client.close()
+
+    assert claimed == ['/out/processing/replica-b/article_2.json']
+    assert (starting_dir / 'article_1.json').exists()
+    assert not abandoned_dir.exists()
@@ -0,0 +1,83 @@
+import asyncio
+
+from utils.helper.journal import ProcessingJournal
+from utils.response import process_article
+
+
+def test_article_states_return_the_most_advanced_state(tmp_path):
+    journal = ProcessingJournal(tmp_path / 'journal.sqlite')
+
+    journal.record_article('a.json', 'downloaded')
+    journal.record_article('a.json', 'extracted')
+    journal.record_articles(['a.json', 'b.json'], 'uploaded')
+    journal.record_article('c.json', 'downloaded')
+
+    # A new instance sees the same state (e.g. after a restart)
+    reopened = ProcessingJournal(tmp_path / 'journal.sqlite')
+    assert reopened.article_states(['a.json', 'b.json', 'c.json', 'd.json']) == {
+        'a.json': 'uploaded',
+        'b.json': 'uploaded',
+        'c.json': 'downloaded',
+    }
+
+    reopened.forget(['a.json'])
+    assert reopened.article_states(['a.json']) == {}
+
+
+def test_attribute_answers_are_restored_after_an_interruption(tmp_path, monkeypatch):
+    journal = ProcessingJournal(tmp_path / 'journal.sqlite')
+    monkeypatch.setattr(process_article, 'journal', journal)
+
+    async def answer_and_restart():
+        attributes = [{'Identifier': 'kragenform'}, {'Identifier': 'armlaenge'}, {'Identifier': 'farbe'}]
+        remaining, on_result = await process_article._restore_from_journal('a.json', attributes)
+        assert remaining == attributes
+
+        attributes[0][process_article.RESULT_KEY] = 'rund'
+        on_result(attributes[0])
+        attributes[2][process_article.RESULT_KEY] = None  # failed calls are sent again
+        on_result(attributes[2])
+        attributes[1][process_article.RESULT_KEY] = 'lang'
+        on_result(attributes[1])
+        await on_result.wait()
+
+        restarted = [{'Identifier': 'kragenform'}, {'Identifier': 'armlaenge'}, {'Identifier': 'farbe'}]
+        remaining, _ = await process_article._restore_from_journal('a.json', restarted)
+        return restarted, remaining
+
+    restarted, remaining = asyncio.run(answer_and_restart())
+
+    assert [attribut.get(process_article.RESULT_KEY) for attribut in restarted] == ['rund', 'lang', None]
+    assert [attribut['Identifier'] for attribut in remaining] == ['farbe']
+
+
+def test_answers_of_a_changed_article_are_not_restored(tmp_path, monkeypatch):
+    journal = ProcessingJournal(tmp_path / 'journal.sqlite')
+    monkeypatch.setattr(process_article, 'journal', journal)
+
+    async def answer(content_hash):
+        attributes = [{'Identifier': 'kragenform'}, {'Identifier': 'armlaenge'}]
+        _, on_result = await process_article._restore_from_journal('a.json', attributes, content_hash)
+        for attribut, value in zip(attributes, ['rund', 'lang'], strict=True):
+            attribut[process_article.RESULT_KEY] = value
+            on_result(attribut)
+        await on_result.wait()
+
+    async def restart(attributes, content_hash):
+        remaining, _ = await process_article._restore_from_journal('a.json', attributes, content_hash)
+        return [attribut.get(process_article.RESULT_KEY) for attribut in attributes], remaining
+
+    original = {'ProduktID': 1, 'Klassifikations-Attribute': [{'Identifier': 'kragenform'}, {'Identifier': 'armlaenge'}]}
+    changed = {'ProduktID': 1, 'Klassifikations-Attribute': [{'Identifier': 'armlaenge'}, {'Identifier': 'kragenform'}]}
+    assert process_article.article_hash(original) != process_article.article_hash(changed)
+    asyncio.run(answer(process_article.article_hash(original)))
+
+    # The file is delivered again under the same name with different content: nothing is restored
+    results, remaining = asyncio.run(restart([{'Identifier': 'armlaenge'}, {'Identifier': 'kragenform'}], process_article.article_hash(changed)))
+    assert results == [None, None]
+    assert len(remaining) == 2
+
+    # Same content: restored, but only onto the attribute with the recorded Identifier
+    results, remaining = asyncio.run(restart([{'Identifier': 'kragenform'}, {'Identifier': 'passform'}], process_article.article_hash(original)))
+    assert results == ['rund', None]
+    assert [attribut['Identifier'] for attribut in remaining] == ['passform']
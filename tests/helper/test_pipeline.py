@@ -0,0 +1,81 @@
+import asyncio
+
+from utils.helper.pipeline import Stage, run_pipeline
+
+
+def test_items_pass_all_stages_in_order():
+    async def double(item):
+        return item * 2
+
+    async def increment(item):
+        return item + 1
+
+    result = asyncio.run(run_pipeline(range(20), [Stage('double', double), Stage('increment', increment)], queue_size=2))
+
+    assert result.completed == [item * 2 + 1 for item in range(20)]
+    assert result.failed == []
+
+
+def test_a_slow_stage_applies_back_pressure():
+    produced, consumed, in_flight = [], [], []
+
+    async def produce(item):
+        produced.append(item)
+        in_flight.append(len(produced) - len(consumed))
+        return item
+
+    async def consume(item):
+        await asyncio.sleep(0.001)
+        consumed.append(item)
+        return item
+
+    result = asyncio.run(
+        run_pipeline(range(50), [Stage('produce', produce), Stage('consume', consume)], queue_size=3)
+    )
+
+    assert len(result.completed) == 50
+    # Queue in front of 'consume' + the item put by 'produce' + the item 'consume' works on
+    assert max(in_flight) <= 3 + 2
+
+
+def test_a_failing_item_does_not_stop_the_others():
+    async def parse(item):
+        if item == 3:
+            raise ValueError('broken file')
+        return item
+
+    async def drop_odd(item):
+        return item if item % 2 == 0 else None
+
+    result = asyncio.run(
+        run_pipeline(range(8), [Stage('parse', parse, workers=3), Stage('filter', drop_odd, workers=2)], queue_size=2)
+    )
+
+    assert sorted(result.completed) == [0, 2, 4, 6]
+    assert [(item, stage, str(e)) for item, stage, e in result.failed] == [(3, 'parse', 'broken file')]
+
+
+def test_items_in_the_pipeline_are_finished_after_a_shutdown_request():
+    fed = []
+
+    async def download(item):
+        fed.append(item)
+        await asyncio.sleep(0.001)
+        return item
+
+    async def upload(item):
+        return item
+
+    result = asyncio.run(
+        run_pipeline(
+            range(100),
+            [Stage('download', download), Stage('upload', upload)],
+            queue_size=2,
+            should_stop=lambda: len(fed) >= 3,
+        )
+    )
+
+    # No new items are fed once the shutdown was requested, the ones already fed pass all stages
+    assert 3 <= len(result.completed) < 100
+    assert result.completed == list(range(len(result.completed)))
+    assert result.failed == []
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+import pytest
+
+from utils.response import get_attribute
+from utils.response.response_cache import ResponseCache
+
+
+class StubLLMClient:
+    """
+    Stands in for openai.AsyncOpenAI in the calls of get_attribute: every request is recorded and answered with the message
+    content returned by answer(request) (an exception raised by answer is raised by the call).
+    """
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+        self.beta = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(parse=self._parse)))
+        )
+
+    async def _parse(self, **request):
+        self.requests.append(request)
+        response = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.answer(request)))],
+            usage=None,
+        )
+        return SimpleNamespace(headers={}, parse=lambda: response)
+
+
+@pytest.fixture
+def stub_llm(tmp_path, monkeypatch):
+    """
+    Returns a function which installs a StubLLMClient with the given answer function (and an empty response cache).
+    """
+
+    def install(answer) -> StubLLMClient:
+        client = StubLLMClient(answer)
+        monkeypatch.setattr(get_attribute, 'llm_client', SimpleNamespace(model_name='gpt-4.1-mini', get_client=lambda: client))
+        monkeypatch.setattr(get_attribute, 'response_cache', ResponseCache(db_path=tmp_path / 'responses.sqlite'))
+        return client
+
+    return install
@@ -0,0 +1,83 @@
+import asyncio
+
+import httpx
+import openai
+
+from utils.response.adaptive_concurrency import AdaptiveConcurrencyController
+
+
+def _rate_limit_error() -> openai.RateLimitError:
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    return openai.RateLimitError('rate limited', response=httpx.Response(429, request=request), body=None)
+
+
+def test_limit_grows_while_healthy_and_bounds_in_flight_calls():
+    controller = AdaptiveConcurrencyController(initial_limit=2, max_limit=4, min_window_size=4)
+    max_in_flight = 0
+
+    async def call():
+        nonlocal max_in_flight
+        async with controller.slot():
+            max_in_flight = max(max_in_flight, controller.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(40)))
+
+    asyncio.run(run())
+
+    assert controller.limit == 4
+    assert max_in_flight <= 4
+    assert controller.in_flight == 0
+
+
+def test_burst_of_429s_cuts_the_limit_once():
+    controller = AdaptiveConcurrencyController(initial_limit=8)
+
+    async def call():
+        async with controller.slot():
+            await asyncio.sleep(0.01)
+            raise _rate_limit_error()
+
+    async def run():
+        return await asyncio.gather(*(call() for _ in range(8)), return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(result, openai.RateLimitError) for result in results)
+    assert controller.limit == 4
+
+
+def test_rising_p95_latency_cuts_the_limit():
+    controller = AdaptiveConcurrencyController(initial_limit=4, min_window_size=4, latency_tolerance=2.0)
+
+    for _ in range(4):
+        controller._on_success(0.1)
+    assert controller.limit == 5
+
+    for _ in range(5):
+        controller._on_success(1.0)
+    assert controller.limit == 2
+
+
+def test_before_call_waits_for_the_slot_and_is_not_counted_as_latency():
+    controller = AdaptiveConcurrencyController(initial_limit=1, min_window_size=2)
+    events = []
+
+    async def wait_for_budget(name):
+        events.append(f'{name} budget')
+        await asyncio.sleep(0.05)
+
+    async def call(name):
+        async with controller.slot(before_call=lambda: wait_for_budget(name)):
+            events.append(f'{name} call')
+
+    async def run():
+        await asyncio.gather(call('first'), call('second'))
+
+    asyncio.run(run())
+
+    assert events == ['first budget', 'first call', 'second budget', 'second call']
+    # Only the calls were timed (the window of two calls has been evaluated and reset)
+    assert controller.baseline_p95 is not None and controller.baseline_p95 < 0.05
+    assert controller.in_flight == 0
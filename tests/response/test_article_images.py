@@ -0,0 +1,98 @@
+import asyncio
+import io
+
+from PIL import Image
+
+from utils.helper import metrics
+from utils.response import article_images, get_attribute, process_article
+from utils.response.article_images import ArticleImages
+from utils.response.preprocess_images import ProcessedImage
+
+
+def _processed(url: str, colour) -> ProcessedImage:
+    buffer = io.BytesIO()
+    Image.new('RGB', (60, 80), colour).save(buffer, format='JPEG')
+    return ProcessedImage(url=url, jpeg_bytes=buffer.getvalue(), width=60, height=80)
+
+
+def _fake_downloads(monkeypatch, images: dict) -> list:
+    """
+    Replaces the download with the given url -> processed image (None: failed download), returns the downloaded urls.
+    """
+    downloaded = []
+
+    async def fake_download_and_process_image(url):
+        downloaded.append(url)
+        return images[url]
+
+    monkeypatch.setattr(article_images, 'download_and_process_image', fake_download_and_process_image)
+    return downloaded
+
+
+def test_images_are_prepared_once(monkeypatch):
+    downloaded = _fake_downloads(monkeypatch, {
+        'hauptbild.jpg': _processed('hauptbild.jpg', (200, 30, 30)),
+        'back.jpg': None,
+        'modell.jpg': _processed('modell.jpg', (30, 60, 170)),
+    })
+    failed = []
+    monkeypatch.setattr(article_images, 'write_failed_image', lambda *args: failed.append(args))
+    images = ArticleImages(product_id=1, image_urls=['hauptbild.jpg', 'back.jpg', 'modell.jpg'], supplier_colour='100')
+
+    async def prepare_twice():
+        first = await images.prepare()
+        second = await images.prepare()
+        return first, second
+
+    first, second = asyncio.run(prepare_twice())
+
+    assert downloaded == ['hauptbild.jpg', 'back.jpg', 'modell.jpg']
+    assert [image.url for image in first] == ['hauptbild.jpg', 'modell.jpg']
+    assert second is first
+    assert failed == [(1, '100', 'back.jpg')]
+
+    images.cleanup()
+    assert images.processed_images == []
+
+
+def test_fetches_saved_are_counted_per_attribute_call():
+    metrics.reset()
+    images = ArticleImages(product_id=1, image_urls=['hauptbild.jpg', 'back.jpg', 'modell.jpg'])
+
+    assert images.report_fetches_saved(number_of_calls=4) == 9
+    assert images.report_fetches_saved(number_of_calls=0) == 0
+    assert metrics.get_counter('image_fetches_saved') == 9
+
+
+def test_all_attribute_calls_share_one_download_per_image(monkeypatch):
+    metrics.reset()
+    monkeypatch.setattr(process_article.response_config, 'extraction_mode', 'per_attribute')
+    downloaded = _fake_downloads(monkeypatch, {
+        'hauptbild.jpg': _processed('hauptbild.jpg', (200, 30, 30)),
+        'modell.jpg': _processed('modell.jpg', (30, 60, 170)),
+    })
+    sent_images = []
+
+    async def fake_get_response(images, **kwargs):
+        sent_images.append(images)
+        return 'opt_a'
+
+    monkeypatch.setattr(get_attribute, 'get_response', fake_get_response)
+    article = {
+        'ProduktID': 1,
+        'Hauptbild': 'hauptbild.jpg',
+        'Modellbild': 'modell.jpg',
+        'Klassifikation': [{'Identifier': '11-05', 'Bezeichnung': 'D-Shirts'}],
+        'Klassifikations-Attribute': [
+            {'Identifier': identifier, 'Attributwerte': [{'Identifier': 'opt_a'}, {'Identifier': 'opt_b'}]}
+            for identifier in ('kragenform', 'aermellaenge', 'passform')
+        ],
+    }
+
+    asyncio.run(process_article.process_article(article))
+
+    assert sorted(downloaded) == ['hauptbild.jpg', 'modell.jpg']
+    assert len(sent_images) == 3
+    assert all([image.url for image in images] == ['hauptbild.jpg', 'modell.jpg'] for images in sent_images)
+    assert metrics.get_counter('image_fetches') == 2
+    assert metrics.get_counter('image_fetches_saved') == 4
@@ -0,0 +1,59 @@
+import asyncio
+
+from utils.helper import metrics
+from utils.response import process_article
+from utils.response.attribute_rules import AttributeRules
+
+
+def _article() -> dict:
+    return {
+        'ProduktID': 1,
+        'FarbID': '100',
+        'Klassifikation': [{'Identifier': '11-05', 'Bezeichnung': 'D-Hosen / D-Jeans'}],
+        'Klassifikations-Attribute': [
+            {'Identifier': 'passform', 'Attributwerte': [{'Identifier': 'regular', 'Bezeichner': 'Regular'}]},
+            {'Identifier': 'material', 'Attributwerte': [{'Identifier': 'denim'}, {'Identifier': 'leinen'}]},
+            {'Identifier': 'farbe', 'Attributwerte': [{'Identifier': 'weiss'}, {'Identifier': 'schwarz'}]},
+            {'Identifier': 'kragenform', 'Attributwerte': [{'Identifier': 'ohne'}, {'Identifier': 'stehkragen'}]},
+        ],
+    }
+
+
+def _rules() -> AttributeRules:
+    return AttributeRules(
+        category_rules={'D-Hosen / D-Jeans': {'material': 'denim', 'kragenform': 'rundhals'}},
+        supplier_field_rules={'farbe': {'field': 'FarbID', 'values': {'100': ['#FFFFFF']}}},
+    )
+
+
+def test_rules_decide_trivial_attributes_with_a_reason():
+    rules = _rules()
+    article = _article()
+    passform, material, farbe, kragenform = article['Klassifikations-Attribute']
+
+    # A single allowed Attributwert does not decide the attribute, "None" is a valid answer as well
+    assert rules.resolve(article, passform) is None
+    assert rules.resolve(article, material).rule == 'category_implied'
+    assert 'D-Hosen / D-Jeans' in rules.resolve(article, material).reason
+    assert rules.resolve(article, farbe).answer == ['#FFFFFF']
+    # 'rundhals' is not an allowed option of kragenform, the LLM is asked
+    assert rules.resolve(article, kragenform) is None
+
+
+def test_rule_decisions_skip_the_llm(monkeypatch):
+    metrics.reset()
+    monkeypatch.setattr(process_article, 'attribute_rules', _rules())
+    sent = []
+
+    async def fake_process_attributes(attributes, **kwargs):
+        sent.extend(attribut['Identifier'] for attribut in attributes)
+        return len(attributes)
+
+    monkeypatch.setattr(process_article, '_process_attributes', fake_process_attributes)
+    article = asyncio.run(process_article.process_article(_article()))
+
+    assert sent == ['passform', 'kragenform']
+    assert [attribut.get(process_article.RESULT_KEY) for attribut in article['Klassifikations-Attribute'][1:3]] == [
+        'denim', ['#FFFFFF']
+    ]
+    assert metrics.snapshot()['gauges']['attribute_rules_share'] == 0.5
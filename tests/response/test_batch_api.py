@@ -0,0 +1,238 @@
+import asyncio
+import json
+import threading
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+from utils.helper.journal import ProcessingJournal
+from utils.response import batch_api
+from utils.response.article_images import ArticleImages
+from utils.response.preprocess_images import ProcessedImage
+
+
+class StubBatchAPIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the OpenAI files and batches endpoints. Every request of a batch is answered with the
+    first option of its prompt (or a fixed hex code for colour requests).
+    """
+
+    files = {}
+    batches = {}
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+
+        if self.path == '/v1/files':
+            message = BytesParser().parsebytes(
+                f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf-8') + body
+            )
+            file_part = next(part for part in message.get_payload() if part.get_filename())
+            file_id = f'file-{uuid.uuid4().hex}'
+            self.files[file_id] = file_part.get_payload(decode=True)
+            self._send_json({'id': file_id, 'object': 'file', 'bytes': len(self.files[file_id]), 'created_at': 0,
+                             'filename': file_part.get_filename(), 'purpose': 'batch', 'status': 'processed'})
+
+        elif self.path == '/v1/batches':
+            request = json.loads(body)
+            output_lines = []
+            for line in self.files[request['input_file_id']].decode('utf-8').splitlines():
+                batch_request = json.loads(line)
+                is_color = batch_request['body']['response_format']['json_schema']['name'] == 'ResponseColor'
+                answer = ['#1E3CA0'] if is_color else 'opt_a'
+                output_lines.append(json.dumps({
+                    'id': f'resp-{uuid.uuid4().hex}',
+                    'custom_id': batch_request['custom_id'],
+                    'response': {'status_code': 200, 'body': {'choices': [{'message': {'content': json.dumps({'response': answer})}}]}},
+                    'error': None,
+                }))
+
+            output_file_id = f'file-{uuid.uuid4().hex}'
+            self.files[output_file_id] = '\n'.join(output_lines).encode('utf-8')
+
+            batch_id = f'batch-{uuid.uuid4().hex}'
+            self.batches[batch_id] = {
+                'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'], 'input_file_id': request['input_file_id'],
+                'completion_window': request['completion_window'], 'created_at': 0, 'status': 'in_progress',
+                'output_file_id': output_file_id, 'request_counts': {'total': len(output_lines), 'completed': 0, 'failed': 0},
+            }
+            self._send_json(self.batches[batch_id])
+
+    def do_GET(self):
+        if self.path.startswith('/v1/batches/'):
+            batch = self.batches[self.path.rsplit('/', 1)[-1]]
+            # The first poll reports "in_progress", the next one "completed"
+            response = dict(batch)
+            batch['status'] = 'completed'
+            self._send_json(response)
+
+        elif self.path.startswith('/v1/files/') and self.path.endswith('/content'):
+            content = self.files[self.path.split('/')[3]]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+
+def _article(product_id: int) -> dict:
+    return {
+        'ProduktID': product_id,
+        'Geschlecht': 'Damen',
+        'Klassifikation': [{'Identifier': '11-02-01-14-0020', 'Bezeichnung': 'D-Hosen / D-Freizeithosen'}],
+        'Klassifikations-Attribute': [
+            {'Identifier': 'kragenform', 'Bezeichner': 'Kragenform', 'Orientierung': '',
+             'Attributwerte': [{'Identifier': 'opt_a', 'Bezeichner': 'A'}, {'Identifier': 'opt_b', 'Bezeichner': 'B'}]},
+            {'Identifier': 'farbe', 'Bezeichner': 'Farbe', 'Orientierung': '', 'Attributwerte': []},
+        ],
+    }
+
+
+def _article_images(product_id: int) -> ArticleImages:
+    article_images = ArticleImages(product_id=product_id, image_urls=['https://example.com/image.jpg'])
+    article_images._processed_images = [ProcessedImage(url='https://example.com/image.jpg', jpeg_bytes=b'jpeg', width=1, height=1)]
+    return article_images
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = ProcessingJournal(tmp_path / 'journal.sqlite')
+    monkeypatch.setattr(batch_api, 'journal', journal)
+    return journal
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBatchAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def test_batch_api_round_trip_against_stub_server(journal, stub_server):
+    server = stub_server
+    articles = [(f'article_{i}.json', _article(i), _article_images(i)) for i in range(3)]
+
+    async def run():
+        client = openai.AsyncOpenAI(api_key='test', base_url=f'http://127.0.0.1:{server.server_address[1]}/v1')
+        try:
+            requests = batch_api.build_batch_requests(articles)
+            return requests, await batch_api.run_batch(requests, client=client, poll_interval=0)
+        finally:
+            await client.close()
+
+    requests, results = asyncio.run(run())
+
+    assert len(requests) == 6
+    assert requests[0]['custom_id'] == 'article_0.json::0'
+    assert requests[0]['body']['messages'][1]['content'][1]['image_url']['url'].startswith('data:image/jpeg;base64,')
+
+    batch_api.merge_batch_results(articles, results)
+
+    for _, article, _ in articles:
+        attributes = article['Klassifikations-Attribute']
+        assert attributes[0]['Ausgewaehlter Attributwert (Result)'] == 'opt_a'
+        assert attributes[1]['Ausgewaehlter Attributwert (Result)'] == ['#1E3CA0']
+
+
+def test_interrupted_batches_are_resumed_instead_of_submitted_again(journal, stub_server):
+    articles = [(f'article_{i}.json', _article(i), _article_images(i)) for i in range(2)]
+    requests = batch_api.build_batch_requests(articles)
+    submitted_before = len(StubBatchAPIHandler.batches)
+
+    async def run(should_stop=None):
+        client = openai.AsyncOpenAI(api_key='test', base_url=f'http://127.0.0.1:{stub_server.server_address[1]}/v1')
+        try:
+            return await batch_api.run_batch(requests, client=client, poll_interval=0, should_stop=should_stop)
+        finally:
+            await client.close()
+
+    # Shutdown while the batch is running: polling stops, the batch stays in the journal
+    with pytest.raises(batch_api.BatchInterrupted):
+        asyncio.run(run(should_stop=lambda: True))
+    assert len(journal.pending_batches()) == 1
+
+    # After the restart the same batch is polled
+    results = asyncio.run(run())
+
+    assert len(StubBatchAPIHandler.batches) == submitted_before + 1
+    assert set(results) == {request['custom_id'] for request in requests}
+    assert journal.pending_batches() == []
+
+
+def test_requests_are_split_by_count_and_size():
+    requests = [{'custom_id': f'a.json::{i}', 'body': 'x' * 100} for i in range(5)]
+
+    assert [len(chunk) for chunk in batch_api.chunk_requests(requests, max_requests=2, max_bytes=10_000)] == [2, 2, 1]
+    assert [len(chunk) for chunk in batch_api.chunk_requests(requests, max_requests=100, max_bytes=300)] == [2, 2, 1]
+    assert batch_api.chunk_requests([], max_requests=2, max_bytes=300) == []
+
+
+def test_large_jobs_are_submitted_as_several_batches(journal, stub_server, monkeypatch):
+    monkeypatch.setattr(batch_api.batch_api_config, 'max_requests_per_file', 4)
+    articles = [(f'article_{i}.json', _article(i), _article_images(i)) for i in range(3)]
+    requests = batch_api.build_batch_requests(articles)
+    submitted_before = len(StubBatchAPIHandler.batches)
+
+    async def run():
+        client = openai.AsyncOpenAI(api_key='test', base_url=f'http://127.0.0.1:{stub_server.server_address[1]}/v1')
+        try:
+            return await batch_api.run_batch(requests, client=client, poll_interval=0)
+        finally:
+            await client.close()
+
+    results = asyncio.run(run())
+
+    assert len(StubBatchAPIHandler.batches) == submitted_before + 2
+    assert set(results) == {request['custom_id'] for request in requests}
+    assert journal.pending_batches() == []
+
+
+def test_only_missing_requests_are_submitted_after_a_restart(journal, stub_server):
+    articles = [(f'article_{i}.json', _article(i), _article_images(i)) for i in range(3)]
+    requests = batch_api.build_batch_requests(articles)
+
+    async def run(requests, should_stop=None):
+        client = openai.AsyncOpenAI(api_key='test', base_url=f'http://127.0.0.1:{stub_server.server_address[1]}/v1')
+        try:
+            return await batch_api.run_batch(requests, client=client, poll_interval=0, should_stop=should_stop)
+        finally:
+            await client.close()
+
+    # The first run submits the first two articles and is interrupted
+    with pytest.raises(batch_api.BatchInterrupted):
+        asyncio.run(run(requests[:4], should_stop=lambda: True))
+    submitted_before = len(StubBatchAPIHandler.batches)
+
+    # After the restart a different set of files is claimed: the recorded batch is reused, only the third article is submitted
+    results = asyncio.run(run(requests[2:]))
+
+    assert len(StubBatchAPIHandler.batches) == submitted_before + 1
+    submitted = StubBatchAPIHandler.files[list(StubBatchAPIHandler.batches.values())[-1]['input_file_id']].decode('utf-8')
+    assert [json.loads(line)['custom_id'] for line in submitted.splitlines()] == ['article_2.json::0', 'article_2.json::1']
+    assert set(results) == {request['custom_id'] for request in requests[2:]}
+    assert journal.pending_batches() == []
+
+
+def test_merge_batch_results_marks_missing_results_as_none():
+    articles = [('article_0.json', _article(0), _article_images(0))]
+
+    batch_api.merge_batch_results(articles, {'article_0.json::0': json.dumps({'response': 'opt_b'})})
+
+    attributes = articles[0][1]['Klassifikations-Attribute']
+    assert attributes[0]['Ausgewaehlter Attributwert (Result)'] == 'opt_b'
+    assert attributes[1]['Ausgewaehlter Attributwert (Result)'] is None
@@ -0,0 +1,101 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utils.response.colour_engine import ColourEngine
+from utils.response.preprocess_images import ProcessedImage
+
+
+def _freisteller(*colours, size=(300, 400)) -> ProcessedImage:
+    """
+    A cut-out shot: white background, the product as vertical stripes of the given colours.
+    """
+    image = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    width = 160 // len(colours)
+    for i, colour in enumerate(colours):
+        draw.rectangle([70 + i * width, 60, 70 + (i + 1) * width - 1, 340], fill=colour)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=95)
+    return ProcessedImage(url=f'https://example.com/{colours}.jpg', jpeg_bytes=buffer.getvalue(), width=size[0], height=size[1])
+
+
+def _modellbild(colour, size=(300, 400)) -> ProcessedImage:
+    """
+    A photo with a non-uniform background: the product in the centre, surrounded by skin tones and noise.
+    """
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+    pixels[size[1] // 6: size[1] - size[1] // 6, size[0] // 4: size[0] - size[0] // 4] = (225, 180, 150)
+    pixels[size[1] // 3: size[1] - size[1] // 3, size[0] // 3: size[0] - size[0] // 3] = colour
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=95)
+    return ProcessedImage(url=f'https://example.com/model-{colour}.jpg', jpeg_bytes=buffer.getvalue(), width=size[0], height=size[1])
+
+
+def test_background_of_freisteller_is_masked():
+    engine = ColourEngine(modes={'farbe': 'local'})
+
+    analysis = engine.analyse([_freisteller((30, 60, 170)), _freisteller((30, 60, 170))])
+
+    assert len(analysis.hex_codes) == 1
+    red, green, blue = (int(analysis.dominant_hex[i:i + 2], 16) for i in (1, 3, 5))
+    assert abs(red - 30) < 15 and abs(green - 60) < 15 and abs(blue - 170) < 15
+    assert analysis.confidence > 0.9
+
+
+def test_multi_coloured_product_and_nearest_option():
+    engine = ColourEngine(modes={'farbe': 'local', 'farbHex': 'local'})
+
+    analysis = engine.analyse([_freisteller((200, 30, 30), (200, 30, 30), (20, 20, 20))])
+
+    assert len(analysis.hex_codes) == 2
+    assert analysis.shares[0] > analysis.shares[1]
+    assert engine.answer('farbe', analysis) == analysis.hex_codes
+    assert engine.nearest_option(analysis.dominant_hex, {'1': 'Schwarz', '2': 'Dunkelrot', '3': 'Blau'}) == '2'
+    assert engine.answer('farbHex', analysis) == analysis.dominant_hex
+
+
+def test_low_confidence_is_verified_by_the_llm():
+    engine = ColourEngine(modes={'farbe': 'local_verify'}, min_confidence=0.6)
+
+    # The images disagree on the dominant colour
+    analysis = engine.analyse([_freisteller((200, 30, 30)), _freisteller((30, 60, 170)), _freisteller((40, 140, 60))])
+
+    assert analysis.confidence < 0.6
+    assert engine.resolve('farbe', analysis) == (False, None)
+    assert engine.resolve('kragenform', analysis) == (False, None)
+
+
+def test_confidence_is_the_share_of_the_dominant_colour():
+    engine = ColourEngine(modes={'farbHex': 'local_verify'}, min_confidence=0.6)
+
+    # A single image agrees with itself, the confidence still depends on how clearly one colour dominates
+    analysis = engine.analyse([_freisteller((200, 30, 30), (20, 20, 20))])
+
+    assert len(analysis.hex_codes) == 2
+    assert analysis.confidence < 0.6
+    assert engine.resolve('farbHex', analysis) == (False, None)
+
+
+def test_photos_without_a_masked_background_are_left_to_the_llm():
+    engine = ColourEngine(modes={'farbe': 'local_verify'}, min_confidence=0.6)
+
+    analysis = engine.analyse([_modellbild((30, 60, 170))])
+
+    assert analysis.confidence == 0.0
+    assert engine.resolve('farbe', analysis) == (False, None)
+
+
+def test_modellbild_is_ignored_next_to_a_freisteller():
+    engine = ColourEngine(modes={'farbe': 'local'})
+
+    analysis = engine.analyse([_freisteller((30, 60, 170)), _modellbild((240, 210, 40))])
+
+    assert len(analysis.hex_codes) == 1
+    blue = int(analysis.dominant_hex[5:7], 16)
+    assert blue > 140
+    assert analysis.confidence > 0.9
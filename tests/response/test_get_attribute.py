@@ -0,0 +1,166 @@
+import asyncio
+import io
+import json
+import sqlite3
+from types import SimpleNamespace
+
+import pydantic
+import pytest
+from PIL import Image
+
+from utils.response import get_attribute
+from utils.response.adaptive_concurrency import AdaptiveConcurrencyController
+from utils.response.get_attribute import (
+    Response,
+    ResponseColor,
+    get_max_completion_tokens,
+    get_response_model,
+)
+from utils.response.preprocess_images import ProcessedImage
+from utils.response.response_cache import ResponseCache
+
+
+def test_response_model_is_an_enum_of_the_options():
+    response_model = get_response_model('kragenform', {'stehkragen': 'Stehkragen', 'reverskragen': 'Reverskragen'})
+
+    schema = response_model.model_json_schema()
+    assert schema['properties']['response']['enum'] == ['stehkragen', 'reverskragen', 'None']
+    assert response_model.model_validate_json('{"response": "None"}').response == 'None'
+    with pytest.raises(pydantic.ValidationError):
+        response_model.model_validate_json('{"response": "rundhals"}')
+
+
+def test_response_models_are_cached_by_option_set():
+    first = get_response_model('kragenform', {'a': 'A', 'b': 'B'})
+
+    assert get_response_model('aermellaenge', {'b': 'Bezeichnung B', 'a': 'Bezeichnung A'}) is first
+    assert get_response_model('kragenform', {'a': 'A', 'c': 'C'}) is not first
+    assert get_response_model('farbe', {'a': 'A'}) is ResponseColor
+    assert get_response_model('farbHex', None) is Response
+
+
+def test_enum_answers_get_a_smaller_completion_budget(monkeypatch):
+    monkeypatch.setattr(get_attribute.openai_config, 'max_completion_tokens', 200)
+
+    assert get_max_completion_tokens('kragenform', {'stehkragen': 'Stehkragen'}) < 200
+    assert get_max_completion_tokens('farbe', {'blau': 'Blau'}) == 200
+    assert get_max_completion_tokens('farbHex', None) == 200
+
+
+def test_cache_hits_do_not_rewrite_the_entry(tmp_path, monkeypatch):
+    cache = ResponseCache(db_path=tmp_path / 'responses.sqlite')
+    monkeypatch.setattr(get_attribute, 'response_cache', cache)
+    calls = []
+
+    async def fake_call_llm(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='{"response": "stehkragen"}'))])
+
+    monkeypatch.setattr(get_attribute, '_call_llm', fake_call_llm)
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 30, 30)).save(buffer, format='JPEG')
+    images = [ProcessedImage(url='https://cdn/1.jpg', jpeg_bytes=buffer.getvalue(), width=64, height=64)]
+
+    def _get_response():
+        return asyncio.run(
+            get_attribute.get_response(
+                attribute_id='kragenform',
+                product_id=1,
+                image_urls=['https://cdn/1.jpg'],
+                possible_options={'stehkragen': 'Stehkragen', 'rundhals': 'Rundhals'},
+                images=images,
+            )
+        )
+
+    def _created_at():
+        with sqlite3.connect(cache.db_path) as connection:
+            return connection.execute('SELECT created_at FROM responses').fetchall()
+
+    assert _get_response() == 'stehkragen'
+    created_at = _created_at()
+    assert _get_response() == 'stehkragen'
+
+    assert len(calls) == 1
+    assert cache.hits == 1
+    assert _created_at() == created_at
+
+
+def _multi_attributes() -> list:
+    return [
+        {'Identifier': 'kragenform', 'Bezeichner': 'Kragenform', 'Orientierung': '',
+         'Attributwerte': [{'Identifier': 'stehkragen', 'Bezeichner': 'Stehkragen'}, {'Identifier': 'rundhals', 'Bezeichner': 'Rundhals'}]},
+        {'Identifier': 'aermellaenge', 'Bezeichner': 'Ärmellänge', 'Orientierung': '',
+         'Attributwerte': [{'Identifier': 'kurz', 'Bezeichner': 'Kurzarm'}, {'Identifier': 'lang', 'Bezeichner': 'Langarm'}]},
+    ]
+
+
+def _images() -> list:
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 30, 30)).save(buffer, format='JPEG')
+    return [ProcessedImage(url='https://cdn/1.jpg', jpeg_bytes=buffer.getvalue(), width=64, height=64)]
+
+
+def test_multi_attribute_schema_has_an_enum_per_attribute():
+    response_model = get_attribute._build_multi_attribute_model(_multi_attributes())
+
+    schema = response_model.model_json_schema()
+    assert schema['properties']['kragenform']['enum'] == ['stehkragen', 'rundhals', 'None']
+    assert schema['properties']['aermellaenge']['enum'] == ['kurz', 'lang', 'None']
+    assert sorted(schema['required']) == ['aermellaenge', 'kragenform']
+    parsed = response_model.model_validate_json('{"kragenform": "rundhals", "aermellaenge": "None"}')
+    assert parsed.model_dump(by_alias=True) == {'kragenform': 'rundhals', 'aermellaenge': 'None'}
+
+
+def test_invalid_multi_attribute_answers_are_dropped_per_attribute(stub_llm):
+    client = stub_llm(lambda request: json.dumps({'kragenform': 'rundhals', 'aermellaenge': 'dreiviertel'}))
+
+    def _get_multi_attribute_response():
+        return asyncio.run(
+            get_attribute.get_multi_attribute_response(attributes=_multi_attributes(), product_id=1, images=_images())
+        )
+
+    assert _get_multi_attribute_response() == {'kragenform': 'rundhals'}
+    assert client.requests[0]['response_format'].__name__ == 'MultiAttributeResponse'
+
+    # Incomplete answers are not cached, the next call asks again
+    assert _get_multi_attribute_response() == {'kragenform': 'rundhals'}
+    assert len(client.requests) == 2
+
+
+def test_unparsable_multi_attribute_answers_return_no_results(stub_llm):
+    stub_llm(lambda request: 'kragenform: rundhals')
+
+    assert asyncio.run(
+        get_attribute.get_multi_attribute_response(attributes=_multi_attributes(), product_id=1, images=_images())
+    ) == {}
+
+
+def test_rate_limit_tokens_are_reserved_once_a_slot_is_free(stub_llm, monkeypatch):
+    events = []
+
+    def answer(request):
+        events.append('call')
+        return '{"response": "rundhals"}'
+
+    class RecordingRateLimiter:
+        async def acquire(self, tokens):
+            events.append('tokens')
+
+        def update_from_headers(self, headers):
+            pass
+
+    stub_llm(answer)
+    monkeypatch.setattr(get_attribute, 'llm_concurrency', AdaptiveConcurrencyController(initial_limit=1, adaptive=False))
+    monkeypatch.setattr(get_attribute, 'rate_limiter', RecordingRateLimiter())
+
+    async def run():
+        await asyncio.gather(*(
+            get_attribute._call_llm(client=get_attribute.llm_client.get_client(), content=[], is_color=False, estimated_tokens=100)
+            for _ in range(3)
+        ))
+
+    asyncio.run(run())
+
+    # With one slot, the tokens of a call are only reserved after the previous call has finished
+    assert events == ['tokens', 'call'] * 3
@@ -0,0 +1,99 @@
+import asyncio
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from utils.response import preprocess_images
+from utils.response.image_cache import ImageCache
+from utils.response.image_fetcher import AsyncImageFetcher
+
+
+def _jpeg() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (800, 600), (30, 60, 170)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+class StubCDNHandler(BaseHTTPRequestHandler):
+    """
+    Serves one image with an ETag and answers conditional requests with 304.
+    """
+
+    content = _jpeg()
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+
+def test_images_are_served_from_the_cache_and_revalidated(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCDNHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/image.jpg'
+
+    cache = ImageCache(cache_dir=tmp_path, revalidate_after=3600)
+    monkeypatch.setattr(preprocess_images, 'image_cache', cache)
+    monkeypatch.setattr(preprocess_images, 'image_fetcher', AsyncImageFetcher())
+
+    try:
+        first = asyncio.run(preprocess_images.download_and_process_image(url))
+        second = asyncio.run(preprocess_images.download_and_process_image(url))
+
+        # Stale entries are revalidated with the ETag, the server answers 304
+        cache.revalidate_after = 0
+        third = asyncio.run(preprocess_images.download_and_process_image(url))
+    finally:
+        server.shutdown()
+
+    assert first.jpeg_bytes == second.jpeg_bytes == third.jpeg_bytes
+    assert (first.width, first.height) == (second.width, second.height) == (500, 375)
+    assert StubCDNHandler.requests == [None, '"v1"']
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    cache = ImageCache(cache_dir=tmp_path, max_bytes=250)
+
+    for url in ('a', 'b'):
+        cache.store(url, raw=b'r' * 50, etag=None, last_modified=None, processing_key='k', processed=b'p' * 50, width=1, height=1)
+    cache.lookup('a')
+    cache.store('c', raw=b'r' * 50, etag=None, last_modified=None, processing_key='k', processed=b'p' * 50, width=1, height=1)
+
+    assert cache.lookup('b') is None
+    assert cache.read_processed(cache.lookup('a'), 'k') == b'p' * 50
+    assert cache.read_processed(cache.lookup('c'), 'other settings') is None
+    assert sorted(path.name for path in tmp_path.glob('*.raw')) == sorted(cache._paths(url)[0].name for url in ('a', 'c'))
+
+
+def test_image_cache_failures_fall_back_to_an_uncached_download(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCDNHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/image.jpg'
+
+    # A corrupt index: every lookup and store fails
+    (tmp_path / 'index.sqlite').write_bytes(b'not a database' * 100)
+    monkeypatch.setattr(preprocess_images, 'image_cache', ImageCache(cache_dir=tmp_path))
+    monkeypatch.setattr(preprocess_images, 'image_fetcher', AsyncImageFetcher())
+
+    try:
+        processed = asyncio.run(preprocess_images.download_and_process_image(url))
+    finally:
+        server.shutdown()
+
+    assert processed is not None and processed.width == 500
@@ -0,0 +1,85 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utils.response import preprocess_images
+from utils.response.image_hash import dhash, hamming_distance, pixel_difference
+from utils.response.preprocess_images import ProcessedImage, deduplicate_images
+
+
+def _photo(seed: int, size=(500, 375), quality: int = 90) -> bytes:
+    """
+    A smooth random picture (the same seed always gives the same picture).
+    """
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 255, (6, 8, 3), dtype=np.uint8))
+    buffer = io.BytesIO()
+    small.resize(size, Image.Resampling.BICUBIC).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def _shirt(neckline: str = 'round', sleeves: bool = True, colour=(200, 30, 30), quality: int = 90) -> bytes:
+    """
+    A cut-out shirt on a white background.
+    """
+    image = Image.new('RGB', (375, 500), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((100, 80, 275, 460), fill=colour)
+    if sleeves:
+        draw.polygon([(100, 80), (30, 220), (70, 240), (100, 160)], fill=colour)
+        draw.polygon([(275, 80), (345, 220), (305, 240), (275, 160)], fill=colour)
+    if neckline == 'round':
+        draw.ellipse((150, 50, 225, 120), fill=(255, 255, 255))
+    else:
+        draw.polygon([(150, 80), (225, 80), (187, 170)], fill=(255, 255, 255))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def _image(url: str, jpeg_bytes: bytes) -> ProcessedImage:
+    image = Image.open(io.BytesIO(jpeg_bytes))
+    return ProcessedImage(url=url, jpeg_bytes=jpeg_bytes, width=image.width, height=image.height)
+
+
+def test_recompressed_copies_are_close_and_other_pictures_are_not():
+    original = dhash(_photo(1))
+
+    assert hamming_distance(original, dhash(_photo(1, quality=60))) <= 4
+    assert hamming_distance(original, dhash(_photo(1, size=(400, 300)))) <= 4
+    assert hamming_distance(original, dhash(_photo(2))) > 10
+
+
+def test_pixel_difference_tells_apart_what_the_dhash_does_not():
+    original = _shirt()
+
+    assert pixel_difference(original, _shirt(quality=60)) < 3
+    assert pixel_difference(original, _shirt(neckline='v')) > 20
+    assert pixel_difference(original, _shirt(sleeves=False)) > 20
+    assert pixel_difference(original, _shirt(colour=(30, 60, 200))) > 20
+    assert pixel_difference(original, _photo(1)) == float('inf')
+
+
+def test_only_verified_duplicates_within_a_request_are_dropped(monkeypatch):
+    # Even with a loose dHash threshold the pixel comparison decides
+    monkeypatch.setattr(preprocess_images.image_dedup_config, 'max_distance', 8)
+    images = [
+        _image('hauptbild.jpg', _shirt()),
+        _image('freisteller_back.jpg', _shirt(neckline='v')),
+        _image('copy.jpg', _shirt(quality=70)),
+        _image('blue.jpg', _shirt(colour=(30, 60, 200))),
+        _image('sleeveless.jpg', _shirt(sleeves=False)),
+    ]
+
+    assert [image.url for image in deduplicate_images(images)] == [
+        'hauptbild.jpg', 'freisteller_back.jpg', 'blue.jpg', 'sleeveless.jpg'
+    ]
+
+
+def test_identical_images_are_dropped_with_the_default_threshold():
+    shirt = _shirt()
+    images = [_image('hauptbild.jpg', shirt), _image('freisteller_back.jpg', shirt), _image('v.jpg', _shirt(neckline='v'))]
+
+    assert [image.url for image in deduplicate_images(images)] == ['hauptbild.jpg', 'v.jpg']
@@ -0,0 +1,75 @@
+import io
+
+from PIL import Image
+
+from utils.response.article_images import ArticleImages
+from utils.response.get_attribute import build_attribute_content
+from utils.response.image_policy import ImagePolicies, ImagePolicy, _parse_policies
+from utils.response.preprocess_images import ProcessedImage
+
+
+def _image(url: str, size=(375, 500)) -> ProcessedImage:
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, format='JPEG')
+    return ProcessedImage(url=url, jpeg_bytes=buffer.getvalue(), width=size[0], height=size[1])
+
+
+def _article_images() -> ArticleImages:
+    urls = ['haupt.jpg', 'back.jpg', 'modell.jpg']
+    article_images = ArticleImages(
+        product_id=1,
+        image_urls=urls,
+        image_roles={'haupt.jpg': 'Hauptbild', 'back.jpg': 'Freisteller Back', 'modell.jpg': 'Modellbild'},
+    )
+    article_images._processed_images = [_image(url) for url in urls]
+    return article_images
+
+
+def test_policy_lookup_by_identifier_orientation_and_default():
+    policies = ImagePolicies(_parse_policies(
+        '{"farbe": {"images": ["Hauptbild"], "detail": "low"},'
+        ' "orientierung:kragen": {"detail": "high", "crop": [0, 0, 1, 0.5]},'
+        ' "default": {"max_size": 400},'
+        ' "broken": {"images": ["Rueckansicht"]}}'
+    ))
+
+    assert policies.for_attribute({'Identifier': 'farbe'}).detail == 'low'
+    assert policies.for_attribute({'Identifier': 'kragenform', 'Orientierung': 'Kragen / Ausschnitt'}).crop == (0.0, 0.0, 1.0, 0.5)
+    assert policies.for_attribute({'Identifier': 'saumabschluss', 'Orientierung': 'unten'}).max_size == 400
+    assert 'broken' not in policies.policies
+
+
+def test_selected_images_are_cropped_and_sent_with_the_detail_hint():
+    article_images = _article_images()
+    policy = ImagePolicy(images=('Hauptbild', 'Modellbild'), detail='high', crop=(0.0, 0.0, 1.0, 0.5))
+
+    images = article_images.select_images(policy)
+    content = build_attribute_content(attribute_id='kragenform', images=images, image_detail=policy.detail)
+
+    assert [(img.url, img.width, img.height) for img in images] == [('haupt.jpg', 375, 250), ('modell.jpg', 375, 250)]
+    assert article_images.select_images(policy)[0] is images[0]
+    assert [part['image_url']['detail'] for part in content if part['type'] == 'image_url'] == ['high', 'high']
+
+
+def test_token_savings_are_counted_per_attribute():
+    article_images = _article_images()
+    policies = ImagePolicies({'farbe': ImagePolicy(images=('Hauptbild',), max_size=256, detail='low')}, model_name='gpt-4.1-mini')
+
+    images = article_images.select_images(policies.for_attribute({'Identifier': 'farbe'}))
+    saved = policies.report_savings('farbe', article_images.processed_images, images, 'low')
+
+    # Three 375x500 images (12x16 patches * 1.62 = 312 tokens each) against one 192x256 image (6x8 patches * 1.62 = 78 tokens),
+    # the detail hint does not change the count of patch based models
+    assert len(images) == 1 and max(images[0].width, images[0].height) == 256
+    assert saved == 3 * 312 - 78
+    assert policies.tokens_saved == {'farbe': saved}
+
+
+def test_low_detail_savings_on_tile_models():
+    article_images = _article_images()
+    policies = ImagePolicies({'farbe': ImagePolicy(images=('Hauptbild',), max_size=256, detail='low')}, model_name='gpt-4.1')
+
+    images = article_images.select_images(policies.for_attribute({'Identifier': 'farbe'}))
+
+    # Three images with 255 tokens each (one tile) against one low detail image (85 tokens)
+    assert policies.report_savings('farbe', article_images.processed_images, images, 'low') == 3 * 255 - 85
@@ -0,0 +1,54 @@
+import asyncio
+
+from utils.response.llm import LLM
+
+
+def test_clients_are_closed_with_their_event_loop():
+    llm = LLM(api_key='test', model_name='gpt-4.1-mini')
+
+    async def get_client():
+        return llm.get_client()
+
+    first = asyncio.run(get_client())
+    second = asyncio.run(get_client())
+
+    assert first is not second
+    assert first.is_closed()
+    assert second.is_closed()
+
+
+def test_one_client_per_event_loop():
+    llm = LLM(api_key='test', model_name='gpt-4.1-mini')
+
+    async def use_twice():
+        first = llm.get_client()
+        second = llm.get_client()
+        await llm.aclose()
+        return first, second
+
+    first, second = asyncio.run(use_twice())
+
+    assert first is second
+    assert first.is_closed()
+
+
+def test_client_of_an_unfinished_loop_is_closed_when_the_loop_shuts_down():
+    llm = LLM(api_key='test', model_name='gpt-4.1-mini')
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.sleep(0))
+
+        async def get_client():
+            return llm.get_client()
+
+        first = loop.run_until_complete(get_client())
+
+        # The first loop is not running anymore, the client stays open until the loop shuts down
+        second = asyncio.run(get_client())
+        assert not first.is_closed()
+        assert second.is_closed()
+
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        assert first.is_closed()
+    finally:
+        loop.close()
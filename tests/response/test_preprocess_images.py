@@ -0,0 +1,65 @@
+import asyncio
+import io
+
+import numpy as np
+from PIL import Image
+
+from utils.response import preprocess_images
+from utils.response.image_cache import ImageCache
+from utils.response.image_fetcher import AsyncImageFetcher
+from utils.response.preprocess_images import ImageProcessor, _process_image
+
+
+def _jpeg(width: int, height: int, mode: str = 'RGB') -> bytes:
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x * 255 // width, y * 255 // height, np.full_like(x, 128)], axis=-1).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).convert(mode).save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def _pixels(processed) -> np.ndarray:
+    return np.asarray(Image.open(io.BytesIO(processed.jpeg_bytes)), dtype=float)
+
+
+def test_fast_decode_matches_the_full_decode(monkeypatch):
+    for mode in ('RGB', 'CMYK', 'L'):
+        content = _jpeg(2400, 3200, mode)
+
+        monkeypatch.setattr(preprocess_images.image_preprocess_config, 'fast_decode', False)
+        full = _process_image(content, url='full')
+        monkeypatch.setattr(preprocess_images.image_preprocess_config, 'fast_decode', True)
+        fast = _process_image(content, url='fast')
+
+        assert (fast.width, fast.height) == (full.width, full.height) == (375, 500)
+        assert Image.open(io.BytesIO(fast.jpeg_bytes)).mode == 'RGB'
+        assert np.abs(_pixels(fast) - _pixels(full)).mean() < 3
+
+
+def test_small_images_are_not_resized():
+    processed = _process_image(_jpeg(200, 100), url='small')
+
+    assert (processed.width, processed.height) == (200, 100)
+
+
+def test_executors_produce_the_same_image():
+    content = _jpeg(1200, 900)
+    expected = _process_image(content, url='inline')
+
+    for executor in ('inline', 'thread', 'process'):
+        processor = ImageProcessor(executor=executor, workers=2)
+        try:
+            processed = asyncio.run(processor.process(content, url='image'))
+        finally:
+            processor.shutdown()
+
+        assert processed.jpeg_bytes == expected.jpeg_bytes
+        assert (processed.url, processed.width, processed.height) == ('image', 500, 375)
+
+
+def test_malformed_urls_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocess_images, 'image_cache', ImageCache(cache_dir=tmp_path))
+    monkeypatch.setattr(preprocess_images, 'image_fetcher', AsyncImageFetcher())
+
+    assert asyncio.run(preprocess_images.download_and_process_image('http://[::1')) is None
+    assert asyncio.run(preprocess_images.download_and_process_image('http://exa mple.com/\x00.jpg')) is None
@@ -0,0 +1,105 @@
+import asyncio
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from utils.response import process_article
+from utils.response.article_images import ArticleImages
+from utils.response.preprocess_images import ProcessedImage
+
+
+def test_sequential_attributes_stop_on_shutdown(monkeypatch):
+    monkeypatch.setattr(process_article.concurrency_config, 'concurrent_attributes', False)
+    attributes = [{'Identifier': 'kragenform'}, {'Identifier': 'aermellaenge'}, {'Identifier': 'passform'}]
+    sent = []
+
+    async def fake_process_attribute(attribut, **kwargs):
+        sent.append(attribut['Identifier'])
+        return 1
+
+    monkeypatch.setattr(process_article, '_process_attribute', fake_process_attribute)
+
+    with pytest.raises(process_article.ArticleProcessingInterrupted, match='aermellaenge'):
+        asyncio.run(
+            process_article._process_attributes(
+                article={'ProduktID': 1},
+                attributes=attributes,
+                article_images=None,
+                product_category='',
+                target_group='',
+                should_stop=lambda: len(sent) == 1,
+            )
+        )
+
+    assert sent == ['kragenform']
+
+
+def _multi_attribute_article() -> tuple[dict, ArticleImages]:
+    article = {
+        'ProduktID': 1,
+        'Hauptbild': 'https://cdn/1.jpg',
+        'Klassifikation': [{'Identifier': '11-05', 'Bezeichnung': 'D-Shirts'}],
+        'Klassifikations-Attribute': [
+            {'Identifier': 'kragenform', 'Bezeichner': 'Kragenform', 'Orientierung': '',
+             'Attributwerte': [{'Identifier': 'stehkragen', 'Bezeichner': 'Stehkragen'}, {'Identifier': 'rundhals', 'Bezeichner': 'Rundhals'}]},
+            {'Identifier': 'aermellaenge', 'Bezeichner': 'Ärmellänge', 'Orientierung': '',
+             'Attributwerte': [{'Identifier': 'kurz', 'Bezeichner': 'Kurzarm'}, {'Identifier': 'lang', 'Bezeichner': 'Langarm'}]},
+            {'Identifier': 'farbe', 'Bezeichner': 'Farbe', 'Orientierung': '', 'Attributwerte': []},
+        ],
+    }
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 30, 30)).save(buffer, format='JPEG')
+    article_images = ArticleImages(product_id=1, image_urls=['https://cdn/1.jpg'])
+    article_images._processed_images = [ProcessedImage(url='https://cdn/1.jpg', jpeg_bytes=buffer.getvalue(), width=64, height=64)]
+    article_images._is_prepared = True
+    return article, article_images
+
+
+def _single_answer(request) -> str:
+    if request['response_format'].__name__ == 'ResponseColor':
+        return json.dumps({'response': ['#C81E1E']})
+    return json.dumps({'response': 'None'})
+
+
+def _results(article: dict) -> list:
+    return [attribut.get(process_article.RESULT_KEY) for attribut in article['Klassifikations-Attribute']]
+
+
+@pytest.fixture
+def multi_attribute_mode(monkeypatch):
+    monkeypatch.setattr(process_article.response_config, 'extraction_mode', 'multi_attribute')
+
+
+def test_multi_attribute_call_answers_the_valid_attributes(multi_attribute_mode, stub_llm):
+    def answer(request):
+        if request['response_format'].__name__ == 'MultiAttributeResponse':
+            return json.dumps({'kragenform': 'rundhals', 'aermellaenge': 'dreiviertel'})
+        return _single_answer(request)
+
+    client = stub_llm(answer)
+    article, article_images = _multi_attribute_article()
+
+    asyncio.run(process_article.process_article(article, article_images=article_images))
+
+    # The invalid answer and the colour attribute are asked one by one
+    assert [request['response_format'].__name__ for request in client.requests].count('MultiAttributeResponse') == 1
+    assert len(client.requests) == 3
+    assert _results(article) == ['rundhals', 'None', ['#C81E1E']]
+
+
+def test_failed_multi_attribute_call_falls_back_to_single_calls(multi_attribute_mode, stub_llm):
+    def answer(request):
+        if request['response_format'].__name__ == 'MultiAttributeResponse':
+            raise RuntimeError('request timed out')
+        return _single_answer(request)
+
+    client = stub_llm(answer)
+    article, article_images = _multi_attribute_article()
+
+    asyncio.run(process_article.process_article(article, article_images=article_images))
+
+    assert len(client.requests) == 4
+    assert _results(article) == ['None', 'None', ['#C81E1E']]
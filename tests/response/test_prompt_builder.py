@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from utils.helper import metrics
+from utils.response.get_attribute import build_attribute_content
+from utils.response.preprocess_images import ProcessedImage
+from utils.response.prompt_builder import record_usage
+
+
+def test_attribute_requests_of_an_article_share_the_prefix():
+    images = [
+        ProcessedImage(url='https://example.com/1.jpg', jpeg_bytes=b'first', width=1, height=1),
+        ProcessedImage(url='https://example.com/2.jpg', jpeg_bytes=b'second', width=1, height=1),
+    ]
+    contents = [
+        build_attribute_content(
+            attribute_id=attribute_id,
+            images=images,
+            attribute_description=attribute_id.capitalize(),
+            possible_options=options,
+            product_category='D-Hosen / D-Freizeithosen',
+            target_group='Damen',
+        )
+        for attribute_id, options in [('kragenform', {'stehkragen': 'Stehkragen'}), ('farbe', None)]
+    ]
+
+    # Product context and images first, the attribute question last
+    assert contents[0][:-1] == contents[1][:-1]
+    assert 'D-Hosen / D-Freizeithosen' in contents[0][0]['text']
+    assert [part['type'] for part in contents[0]] == ['text', 'image_url', 'image_url', 'text']
+    assert 'kragenform' in contents[0][-1]['text']
+
+
+def test_cached_prompt_tokens_are_counted():
+    metrics.reset()
+
+    record_usage(SimpleNamespace(prompt_tokens=1000, prompt_tokens_details=SimpleNamespace(cached_tokens=768)))
+    record_usage({'prompt_tokens': 1000, 'prompt_tokens_details': {'cached_tokens': 0}})
+    record_usage(SimpleNamespace(prompt_tokens=500, prompt_tokens_details=None))
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['llm_prompt_tokens'] == 2500
+    assert snapshot['counters']['llm_cached_prompt_tokens'] == 768
+    assert snapshot['gauges']['llm_cached_prompt_token_share'] == 768 / 2500
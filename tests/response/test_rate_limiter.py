@@ -0,0 +1,61 @@
+import asyncio
+import math
+import time
+
+from utils.response.rate_limiter import RateLimiter, _parse_reset
+from utils.response.token_estimation import estimate_image_tokens
+
+
+def test_estimate_image_tokens_from_processed_dimensions():
+    assert estimate_image_tokens(500, 500, model_name='gpt-4.1') == 85 + 170
+    assert estimate_image_tokens(500, 375, detail='low', model_name='gpt-4o-2024-08-06') == 85
+    # 2048x1024 -> shortest side scaled to 768 -> 1536x768 -> 3x2 tiles
+    assert estimate_image_tokens(2048, 1024, model_name='gpt-4.1') == 85 + 170 * 6
+    assert estimate_image_tokens(500, 500, detail='low', model_name='gpt-4o-mini') == 2833
+
+
+def test_estimate_image_tokens_of_patch_models():
+    # 500x500 -> 16x16 patches of 32px -> 256 * 1.62
+    assert estimate_image_tokens(500, 500, model_name='gpt-4.1-mini-2025-04-14') == 415
+    assert estimate_image_tokens(500, 500, detail='low', model_name='gpt-4.1-mini') == 415
+    assert estimate_image_tokens(500, 500, model_name='gpt-4.1-nano') == math.ceil(256 * 2.46)
+    # 1800x2400 -> 57x75 patches (> 1536) -> scaled down to 1056x1408 -> 33x44 patches
+    assert estimate_image_tokens(1800, 2400, model_name='gpt-4.1-mini') == math.ceil(33 * 44 * 1.62)
+
+
+def test_parse_reset_durations():
+    assert _parse_reset('1s') == 1
+    assert _parse_reset('6m0s') == 360
+    assert _parse_reset('20ms') == 0.02
+    assert _parse_reset('') is None
+
+
+def test_acquire_delays_calls_over_the_token_budget():
+    # 600 tokens per minute -> 10 tokens per second
+    rate_limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=600)
+
+    async def run():
+        await rate_limiter.acquire(600)
+        start = time.monotonic()
+        await rate_limiter.acquire(3)
+        return time.monotonic() - start
+
+    assert 0.2 <= asyncio.run(run()) < 1.0
+
+
+def test_update_from_headers_applies_the_stricter_provider_budget():
+    rate_limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=100_000)
+
+    rate_limiter.update_from_headers({
+        'x-ratelimit-limit-requests': '60',
+        'x-ratelimit-remaining-requests': '0',
+        'x-ratelimit-reset-requests': '2s',
+        'x-ratelimit-limit-tokens': '30000',
+        'x-ratelimit-remaining-tokens': '29000',
+        'x-ratelimit-reset-tokens': '2s',
+    })
+
+    assert rate_limiter.requests.capacity == 60
+    assert rate_limiter.tokens.capacity == 30000
+    assert rate_limiter.tokens.available <= 29000
+    assert 2.5 < rate_limiter.requests.wait_time(1) <= 3.0